@@ -0,0 +1,187 @@
+import argparse
+import json
+import os
+import shutil
+import sys
+import tempfile
+import timeit
+from typing import Callable, Dict, List, Tuple
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from PIL import Image  # noqa: E402
+
+from constants import PageCount  # noqa: E402
+from models import Story  # noqa: E402
+from pages.story import get_flipbook_html  # noqa: E402
+from utils import (  # noqa: E402
+    classify_image_aspect,
+    get_b64_for_image_path,
+    to_kebab_case,
+)
+
+LUNA_STORY = (
+    ".data/stories/luna-and-the-whispering-locket/luna-and-the-whispering-locket.json"
+)
+BASELINE_PATH = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), "baseline.json"
+)
+# Baselines of absolute seconds had no version, they can't be compared with
+# calibrated ratios
+BASELINE_VERSION = 2
+PAGE_COUNT_PAGES = {
+    PageCount.TENish: 10,
+    PageCount.TWENTYish: 20,
+    PageCount.THIRTYish: 30,
+}
+
+
+# Per-view CPU work, timed against the bundled Luna story and synthetic stories
+# of every PageCount. Fails on slowdowns against benchmarks/baseline.json, which
+# is machine specific and not committed, `--save-baseline` records it. Timings
+# are kept relative to a calibration loop run in the same process, so a busier
+# or throttled machine does not read as a regression.
+def make_synthetic_story(luna: Story, page_count: PageCount, base_dir: str) -> Story:
+    story = luna.model_copy(deep=True)
+    story.title = f"Synthetic {page_count.name}"
+    story.page_count = page_count
+    pages = PAGE_COUNT_PAGES[page_count]
+    story.pages = [luna.pages[i % len(luna.pages)].model_copy() for i in range(pages)]
+    story_path = os.path.join(base_dir, f"{to_kebab_case(story.title)}.json")
+    story.save(story_path)
+    return story
+
+
+def get_benchmarks(base_dir: str) -> List[Tuple[str, Callable]]:
+    luna = Story.load(LUNA_STORY)
+    image_path = luna.pages[0].image_path
+    image = Image.open(image_path)
+    image.load()
+
+    benchmarks = [
+        ("utils.get_b64_for_image_path", lambda: get_b64_for_image_path(image_path)),
+        ("utils.classify_image_aspect", lambda: classify_image_aspect(image)),
+        ("utils.to_kebab_case", lambda: to_kebab_case(luna.title)),
+    ]
+    stories = [("luna", luna, LUNA_STORY)]
+    for page_count in PageCount:
+        story = make_synthetic_story(luna, page_count, base_dir)
+        story_path = os.path.join(base_dir, f"{to_kebab_case(story.title)}.json")
+        stories.append((f"{PAGE_COUNT_PAGES[page_count]}p", story, story_path))
+
+    for name, story, story_path in stories:
+        save_path = os.path.join(base_dir, f"save-{name}.json")
+        benchmarks.extend(
+            [
+                (f"Story.load[{name}]", lambda path=story_path: Story.load(path)),
+                (
+                    f"Story.save[{name}]",
+                    lambda s=story, path=save_path: s.save(path),
+                ),
+                (f"Story.get_orientation[{name}]", story.get_orientation),
+                (f"Story.get_missing_assets[{name}]", story.get_missing_assets),
+                (
+                    f"flipbook_html[{name}]",
+                    lambda s=story: get_flipbook_html.__wrapped__(
+                        s.get_revision(),
+                        600,
+                        tuple(f"media/{i}.jpg" for i in range(len(s.pages) + 1)),
+                        s,
+                    ),
+                ),
+            ]
+        )
+    return benchmarks
+
+
+def calibrate():
+    sorted(str(i) for i in range(1000))
+
+
+def time_benchmark(fn: Callable, repeat: int) -> Tuple[float, float]:
+    # Runs alternate with the calibration loop, the best of each is kept
+    timer = timeit.Timer(fn)
+    number, _ = timer.autorange()
+    calibration_timer = timeit.Timer(calibrate)
+    calibration_number, _ = calibration_timer.autorange()
+    seconds, calibration_seconds = [], []
+    for _ in range(repeat):
+        seconds.append(timer.timeit(number) / number)
+        calibration_seconds.append(
+            calibration_timer.timeit(calibration_number) / calibration_number
+        )
+    return min(seconds), min(calibration_seconds)
+
+
+def load_baseline() -> Dict[str, float]:
+    if not os.path.exists(BASELINE_PATH):
+        return {}
+    with open(BASELINE_PATH, "r") as f:
+        baseline = json.load(f)
+    if baseline.get("version") != BASELINE_VERSION:
+        print(f"Ignoring the baseline at {BASELINE_PATH}, it is in an older format")
+        return {}
+    return baseline["benchmarks"]
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--save-baseline",
+        "--update",
+        action="store_true",
+        help="Record the baseline of this machine",
+    )
+    parser.add_argument(
+        "--max-regression",
+        type=float,
+        default=float(os.getenv("BENCHMARK_MAX_REGRESSION", "0.25")),
+        help="Allowed slowdown against the baseline, 0.25 is 25%%",
+    )
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--filter", default="", help="Only run matching benchmarks")
+    args = parser.parse_args()
+
+    baseline = load_baseline()
+    if not baseline and not args.save_baseline:
+        print(f"No usable baseline at {BASELINE_PATH}, record one with --save-baseline")
+    results = {}
+    regressions = []
+    base_dir = tempfile.mkdtemp(prefix="hot-paths-")
+    try:
+        for name, fn in get_benchmarks(base_dir):
+            if args.filter not in name:
+                continue
+            seconds, calibration_seconds = time_benchmark(fn, args.repeat)
+            results[name] = seconds / calibration_seconds
+            line = f"{name:<40} {seconds * 1e6:12.1f} us"
+            if name in baseline:
+                change = results[name] / baseline[name] - 1
+                line += f" {change:+8.1%}"
+                if change > args.max_regression:
+                    regressions.append(name)
+                    line += "  REGRESSION"
+            print(line)
+    finally:
+        shutil.rmtree(base_dir)
+
+    if args.save_baseline:
+        with open(BASELINE_PATH, "w") as f:
+            json.dump(
+                {"version": BASELINE_VERSION, "benchmarks": {**baseline, **results}},
+                f,
+                indent=2,
+                sort_keys=True,
+            )
+        print(f"Baseline written to {BASELINE_PATH}")
+        return 0
+    if regressions:
+        print(
+            f"{len(regressions)} benchmark(s) regressed by more than {args.max_regression:.0%}"
+        )
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
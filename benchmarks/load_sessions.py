@@ -0,0 +1,251 @@
+import argparse
+import gc
+import os
+import shutil
+import statistics
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+from typing import Dict, List
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIR)
+os.environ.setdefault("GEMINI_API_KEY", "load-test")
+
+from google.genai import types  # noqa: E402
+from PIL import Image  # noqa: E402
+from streamlit.testing.v1 import AppTest  # noqa: E402
+
+import gemini  # noqa: E402
+from constants import Session  # noqa: E402
+from images import get_image_executor  # noqa: E402
+from models import Story  # noqa: E402
+from utils import to_kebab_case  # noqa: E402
+
+LUNA_STORY_DIR = os.path.join(
+    REPO_DIR, ".data", "stories", "luna-and-the-whispering-locket"
+)
+
+
+# Drives N concurrent AppTest sessions through main.py against a fake Gemini
+# backend and reports rerun latency, memory, threads and throughput per N.
+# AppTest mocks a process wide Streamlit runtime per run, so overlapping runs
+# occasionally log "Runtime hasn't been created" while tearing down. Those
+# tracebacks do not fail the session.
+
+
+# Stands in for the Gemini API: sleeps for a model-like latency and answers
+# with the bundled Luna story or a plain image.
+class FakeModels:
+    def __init__(self, text_latency: float, image_latency: float):
+        self.text_latency = text_latency
+        self.image_latency = image_latency
+        self.story = Story.load(
+            os.path.join(LUNA_STORY_DIR, "luna-and-the-whispering-locket.json")
+        )
+        for record in [self.story.character_sheet, self.story.cover_image]:
+            record.image_path = None
+        for page in self.story.pages:
+            page.image_path = None
+        output = BytesIO()
+        Image.new("RGB", (768, 1024), "orange").save(output, format="JPEG")
+        self.image_data = output.getvalue()
+        self.calls = 0
+        self.lock = threading.Lock()
+
+    def generate_content(self, model, contents, config=None):
+        with self.lock:
+            self.calls += 1
+        if config and config.get("response_schema"):
+            time.sleep(self.text_latency)
+            return types.GenerateContentResponse(
+                parsed=self.story.model_copy(deep=True)
+            )
+        time.sleep(self.image_latency)
+        return types.GenerateContentResponse(
+            candidates=[
+                types.Candidate(
+                    content=types.Content(
+                        role="model",
+                        parts=[
+                            types.Part.from_bytes(
+                                data=self.image_data, mime_type="image/jpeg"
+                            )
+                        ],
+                    )
+                )
+            ]
+        )
+
+
+class FakeClient:
+    def __init__(self, text_latency: float, image_latency: float):
+        self.models = FakeModels(text_latency, image_latency)
+
+
+def get_rss_bytes() -> int:
+    with open("/proc/self/status") as f:
+        for line in f:
+            if line.startswith("VmRSS:"):
+                return int(line.split()[1]) * 1024
+    return 0
+
+
+class SessionDriver:
+    def __init__(self, timeout: float):
+        self.app = AppTest.from_file(
+            os.path.join(REPO_DIR, "main.py"), default_timeout=timeout
+        )
+        self.latencies: List[float] = []
+
+    def run(self):
+        start = time.perf_counter()
+        self.app.run()
+        self.latencies.append(time.perf_counter() - start)
+        if self.app.exception:
+            raise RuntimeError(self.app.exception[0].message)
+
+    def open_story_page(self, story: Story):
+        # AppTest can only switch to file pages, story pages are callables
+        # registered under the story's url path.
+        url_path = to_kebab_case(story.title)
+        for page_hash, info in self.app._registered_pages.items():
+            if info.get("url_pathname") == url_path:
+                self.app._page_hash = page_hash
+                return
+        raise RuntimeError(f"No page for story {story.title!r}")
+
+    def click(self, label: str):
+        for button in self.app.button:
+            if button.label == label:
+                button.click()
+                return self.run()
+        raise RuntimeError(f"No button {label!r}")
+
+    # Create a story, generate all of its assets, then open the flipbook
+    def run_journey(self, poll_seconds: float):
+        self.run()
+        self.app.switch_page("pages/create.py")
+        self.run()
+        self.click("Auto-Fill Example")
+        self.click("Generate Story")
+        while self.app.session_state[Session.CREATE_STORY_STATE] is not None:
+            self.run()
+        self.open_story_page(self.app.session_state[Session.ALL_STORIES][-1])
+        self.app.session_state["story_tab"] = "Generate Assets"
+        self.run()
+        self.click("Generate All Assets")
+        while (self.app.session_state[Session.ASSET_JOBS] or {}).values():
+            time.sleep(poll_seconds)
+            self.run()
+        self.app.session_state["story_tab"] = "View Story"
+        self.run()
+
+
+def percentile(values: List[float], fraction: float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+
+def run_load(sessions: int, args) -> Dict[str, float]:
+    gc.collect()
+    rss_before = get_rss_bytes()
+    peak_threads = threading.active_count()
+    drivers = [SessionDriver(args.timeout) for _ in range(sessions)]
+    stop = threading.Event()
+
+    def sample_threads():
+        nonlocal peak_threads
+        while not stop.wait(0.1):
+            peak_threads = max(peak_threads, threading.active_count())
+
+    sampler = threading.Thread(target=sample_threads, daemon=True)
+    sampler.start()
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=sessions) as executor:
+        futures = [
+            executor.submit(driver.run_journey, args.poll_seconds) for driver in drivers
+        ]
+        errors = [future.exception() for future in futures]
+    elapsed = time.perf_counter() - start
+    stop.set()
+    sampler.join()
+
+    latencies = [latency for driver in drivers for latency in driver.latencies]
+    failed = [error for error in errors if error]
+    for error in failed[:3]:
+        print(f"  session failed: {error}")
+    return {
+        "sessions": sessions,
+        "failed": len(failed),
+        "reruns": len(latencies),
+        "p50_ms": statistics.median(latencies) * 1000,
+        "p95_ms": percentile(latencies, 0.95) * 1000,
+        "p99_ms": percentile(latencies, 0.99) * 1000,
+        "rss_per_session_mb": (get_rss_bytes() - rss_before) / sessions / 2**20,
+        "peak_threads": peak_threads,
+        "journeys_per_min": (sessions - len(failed)) / elapsed * 60,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sessions", default="1,2,4,8", help="Session counts to run")
+    parser.add_argument("--text-latency", type=float, default=2.0)
+    parser.add_argument("--image-latency", type=float, default=1.0)
+    parser.add_argument("--poll-seconds", type=float, default=1.0)
+    parser.add_argument("--timeout", type=float, default=120)
+    args = parser.parse_args()
+
+    # Every run starts from an empty data directory with only the Luna story
+    work_dir = tempfile.mkdtemp(prefix="load-sessions-")
+    shutil.copytree(
+        LUNA_STORY_DIR,
+        os.path.join(work_dir, ".data", "stories", os.path.basename(LUNA_STORY_DIR)),
+    )
+    os.symlink(os.path.join(REPO_DIR, "static"), os.path.join(work_dir, "static"))
+    os.chdir(work_dir)
+    gemini.CLIENT = FakeClient(args.text_latency, args.image_latency)
+
+    columns = [
+        "sessions",
+        "failed",
+        "reruns",
+        "p50_ms",
+        "p95_ms",
+        "p99_ms",
+        "rss_per_session_mb",
+        "peak_threads",
+        "journeys_per_min",
+    ]
+    results = []
+    try:
+        # Imports, caches and thread pools are paid once, not per session
+        SessionDriver(args.timeout).run_journey(args.poll_seconds)
+        for sessions in [int(count) for count in args.sessions.split(",")]:
+            results.append(run_load(sessions, args))
+    finally:
+        get_image_executor().shutdown()
+        os.chdir(REPO_DIR)
+        shutil.rmtree(work_dir)
+
+    # Printed last, the app itself logs plenty while the sessions run
+    print(" ".join(f"{column:>18}" for column in columns))
+    for result in results:
+        print(
+            " ".join(
+                (
+                    f"{result[column]:>18.1f}"
+                    if isinstance(result[column], float)
+                    else f"{result[column]:>18}"
+                )
+                for column in columns
+            )
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,106 @@
+import argparse
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import models  # noqa: E402
+from models import Story, get_story_file_paths, load_stories  # noqa: E402
+
+SOURCE_STORY = (
+    ".data/stories/luna-and-the-whispering-locket/luna-and-the-whispering-locket.json"
+)
+
+
+# Compares the previous dict based (de)serialization and serial library scan
+# with the current one, on a synthetic library of copies of the sample story.
+def legacy_load(file_path: str) -> Story:
+    with open(file_path, "r") as f:
+        data = json.load(f)
+    return Story.model_validate(data)
+
+
+def legacy_save(story: Story, file_path: str):
+    with open(file_path, "w") as f:
+        json.dump(story.model_dump(), f, indent=2)
+
+
+def legacy_get_stories() -> list:
+    return [legacy_load(path) for path in get_story_file_paths()]
+
+
+def build_library(base_dir: str, count: int) -> Story:
+    story = Story.load(SOURCE_STORY)
+    for i in range(count):
+        story_dir = os.path.join(base_dir, f"story-{i}")
+        os.makedirs(story_dir)
+        story.title = f"Story {i}"
+        story.save(os.path.join(story_dir, f"story-{i}.json"))
+    return story
+
+
+def measure(name: str, fn, repeat: int = 3) -> float:
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        timings.append(time.perf_counter() - start)
+    best = min(timings)
+    print(f"{name:<40} {best * 1000:10.1f} ms")
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--count", type=int, default=10_000)
+    args = parser.parse_args()
+
+    base_dir = tempfile.mkdtemp(prefix="story-library-")
+    models.STORIES_BASE_DIR = base_dir
+    try:
+        print(f"Building a library of {args.count} stories in {base_dir}")
+        story = build_library(base_dir, args.count)
+        sample_path = os.path.join(base_dir, "story-0", "story-0.json")
+        saves = max(1, args.count // 10)
+        print(f"{'':<40} {'best of 3':>13}")
+
+        legacy = measure("get_stories (json.load, serial)", legacy_get_stories)
+        current = measure(
+            "get_stories (validate_json, threads)",
+            lambda: load_stories(get_story_file_paths()),
+        )
+        print(f"{'speedup':<40} {legacy / current:10.2f} x")
+
+        legacy = measure(
+            f"{saves} x load (json.load)",
+            lambda: [legacy_load(sample_path) for _ in range(saves)],
+        )
+        current = measure(
+            f"{saves} x load (validate_json)",
+            lambda: [Story.load(sample_path) for _ in range(saves)],
+        )
+        print(f"{'speedup':<40} {legacy / current:10.2f} x")
+
+        target_path = os.path.join(base_dir, "story-0", "target.json")
+        legacy = measure(
+            f"{saves} x save (json.dump, indent)",
+            lambda: [legacy_save(story, target_path) for _ in range(saves)],
+        )
+        current = measure(
+            f"{saves} x save (dump_json, indent)",
+            lambda: [story.save(target_path) for _ in range(saves)],
+        )
+        print(f"{'speedup':<40} {legacy / current:10.2f} x")
+        compact_bytes = len(story.model_dump_json())
+        indented_bytes = len(story.model_dump_json(indent=2))
+        print(f"{'compact / indented size':<40} {compact_bytes / indented_bytes:10.2f}")
+    finally:
+        shutil.rmtree(base_dir)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,85 @@
+import os
+import shutil
+import threading
+import time
+from typing import Iterable, List
+
+from constants import BLOBS_DIR, BLOB_GC_GRACE_SECONDS
+from images import get_file_hash
+
+
+# Rendered images are stored once under their content hash and shared by every
+# story. The files next to the story JSON are hardlinks into the store, so
+# switching versions is a rename and identical renders take no extra space.
+def get_blob_path(digest: str, extension: str) -> str:
+    return os.path.join(BLOBS_DIR, digest[:2], f"{digest}{extension}")
+
+
+def get_blob_name(blob_path: str) -> str:
+    return os.path.basename(blob_path)
+
+
+def get_blob_path_from_name(blob_name: str) -> str:
+    return os.path.join(BLOBS_DIR, blob_name[:2], blob_name)
+
+
+def link_file(source_path: str, target_path: str):
+    # Link next to the target then rename over it, so readers never see a gap
+    temp_path = f"{target_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    try:
+        os.link(source_path, temp_path)
+    except OSError:
+        # Different filesystem or no hardlink support, fall back to a copy
+        shutil.copyfile(source_path, temp_path)
+    os.replace(temp_path, target_path)
+    if os.path.exists(temp_path):
+        # rename() is a no-op when both names already link to the same file
+        os.remove(temp_path)
+
+
+def store_file(file_path: str) -> str:
+    digest = get_file_hash(file_path)
+    blob_path = get_blob_path(digest, os.path.splitext(file_path)[1])
+    os.makedirs(os.path.dirname(blob_path), exist_ok=True)
+    if os.path.exists(blob_path):
+        # Same pixels as an earlier render, point the file at the stored copy
+        link_file(blob_path, file_path)
+        os.utime(blob_path)
+    else:
+        link_file(file_path, blob_path)
+    return get_blob_name(blob_path)
+
+
+def restore_file(blob_name: str, file_path: str) -> str:
+    link_file(get_blob_path_from_name(blob_name), file_path)
+    return file_path
+
+
+def list_blobs() -> List[str]:
+    blob_paths = []
+    if not os.path.exists(BLOBS_DIR):
+        return blob_paths
+    for prefix in os.listdir(BLOBS_DIR):
+        prefix_dir = os.path.join(BLOBS_DIR, prefix)
+        if os.path.isdir(prefix_dir):
+            blob_paths.extend(
+                os.path.join(prefix_dir, blob_name)
+                for blob_name in os.listdir(prefix_dir)
+            )
+    return blob_paths
+
+
+def collect_garbage(referenced_blob_names: Iterable[str]) -> List[str]:
+    referenced = set(referenced_blob_names)
+    now = time.time()
+    removed = []
+    for blob_path in list_blobs():
+        if get_blob_name(blob_path) in referenced or blob_path.endswith(".tmp"):
+            continue
+        stat = os.stat(blob_path)
+        # A render may have stored the blob without having saved the story yet
+        if stat.st_nlink > 1 or now - stat.st_mtime < BLOB_GC_GRACE_SECONDS:
+            continue
+        os.remove(blob_path)
+        removed.append(blob_path)
+    return removed
@@ -0,0 +1,303 @@
+import argparse
+import json
+import os
+import threading
+import time
+import uuid
+from dataclasses import dataclass
+from io import BytesIO
+from typing import Callable, Dict, Iterator, List, Optional
+
+from google.genai import types
+from PIL import Image
+
+from constants import (
+    BULK_BATCH_BACKEND,
+    BULK_BATCH_DIR,
+    BULK_BATCH_MAX_BYTES,
+    BULK_FAKE_IMAGE_SIZE,
+    BULK_POLL_SECONDS,
+    GEMINI_IMAGE_GENERATION_MODEL,
+    Asset,
+    Priority,
+)
+from gemini import CLIENT, generate_image, get_generated_image, get_image_part
+from images import GeneratedImage
+from log import get_logger
+from models import Story, get_story_file_paths
+from scheduler import set_scheduling
+
+logger = get_logger(__name__)
+
+BATCH_DONE_STATES = {
+    types.JobState.JOB_STATE_SUCCEEDED,
+    types.JobState.JOB_STATE_PARTIALLY_SUCCEEDED,
+    types.JobState.JOB_STATE_FAILED,
+    types.JobState.JOB_STATE_CANCELLED,
+    types.JobState.JOB_STATE_EXPIRED,
+}
+
+# Everything else is rendered from the character sheet, so the sheets of all
+# stories go out in a first wave and the rest once they are in.
+BULK_WAVES = [
+    lambda asset: asset == Asset.CHARACTER_SHEET,
+    lambda asset: asset != Asset.CHARACTER_SHEET,
+]
+
+
+@dataclass
+class BulkItem:
+    story_path: str
+    asset: str
+    prompt: str
+    reference_image_path: Optional[str]
+    fingerprint: str
+
+    def get_size(self) -> int:
+        size = len(self.prompt.encode("utf-8"))
+        if self.reference_image_path:
+            # Inline images are sent base64 encoded
+            size += os.path.getsize(self.reference_image_path) * 4 // 3
+        return size
+
+
+# Uses the provider's batch API, billed and rate limited apart from the
+# interactive calls.
+class GeminiBatchBackend:
+    def submit(self, items: List[BulkItem]) -> str:
+        requests = []
+        for item in items:
+            parts = [types.Part.from_text(text=item.prompt)]
+            if item.reference_image_path:
+                parts.append(get_image_part(item.reference_image_path))
+            requests.append(
+                types.InlinedRequest(
+                    contents=[types.Content(role="user", parts=parts)],
+                    metadata={"asset": item.asset},
+                )
+            )
+        batch = CLIENT.batches.create(
+            model=GEMINI_IMAGE_GENERATION_MODEL,
+            src=requests,
+            config={"display_name": f"bulk-{len(items)}-{uuid.uuid4().hex[:8]}"},
+        )
+        return batch.name
+
+    def poll(self, name: str) -> Optional[List[Optional[GeneratedImage]]]:
+        batch = CLIENT.batches.get(name=name)
+        if batch.state not in BATCH_DONE_STATES:
+            return None
+        if not batch.dest or not batch.dest.inlined_responses:
+            logger.warning("bulk.batch_failed", batch=name, state=batch.state)
+            return []
+        results = []
+        for response in batch.dest.inlined_responses:
+            if response.response and response.response.candidates:
+                results.append(get_generated_image(response.response))
+            else:
+                results.append(None)
+        return results
+
+
+def generate_fake_image(prompt: str, **kwargs) -> Optional[GeneratedImage]:
+    buffer = BytesIO()
+    Image.new("RGB", BULK_FAKE_IMAGE_SIZE, "lightgray").save(buffer, format="JPEG")
+    return GeneratedImage(data=buffer.getvalue(), mime_type="image/jpeg")
+
+
+# Stand-in for testing without the batch API. Requests are written to a batch
+# directory and a background thread answers them, by default through the
+# regular model calls at batch priority, writing the images and the state next
+# to them.
+class LocalBatchBackend:
+    def __init__(
+        self, generate: Callable[..., Optional[GeneratedImage]] = generate_image
+    ):
+        self.generate = generate
+
+    def get_batch_dir(self, name: str) -> str:
+        return os.path.join(BULK_BATCH_DIR, name)
+
+    def write_state(self, name: str, state: types.JobState, results: List):
+        state_path = os.path.join(self.get_batch_dir(name), "state.json")
+        with open(f"{state_path}.tmp", "w") as f:
+            json.dump({"state": state.value, "results": results}, f)
+        os.replace(f"{state_path}.tmp", state_path)
+
+    def submit(self, items: List[BulkItem]) -> str:
+        name = uuid.uuid4().hex
+        os.makedirs(self.get_batch_dir(name))
+        with open(os.path.join(self.get_batch_dir(name), "requests.jsonl"), "w") as f:
+            for item in items:
+                f.write(
+                    json.dumps(
+                        {
+                            "prompt": item.prompt,
+                            "reference_image_path": item.reference_image_path,
+                        }
+                    )
+                    + "\n"
+                )
+        self.write_state(name, types.JobState.JOB_STATE_PENDING, [])
+        threading.Thread(
+            target=self.run_batch, args=(name,), name=f"batch-{name}", daemon=True
+        ).start()
+        return name
+
+    def run_batch(self, name: str):
+        set_scheduling("bulk", Priority.BATCH)
+        self.write_state(name, types.JobState.JOB_STATE_RUNNING, [])
+        batch_dir = self.get_batch_dir(name)
+        results = []
+        with open(os.path.join(batch_dir, "requests.jsonl"), "r") as f:
+            for index, line in enumerate(f):
+                request = json.loads(line)
+                try:
+                    image = self.generate(
+                        prompt=request["prompt"],
+                        reference_image_path=request["reference_image_path"],
+                    )
+                except Exception as e:
+                    logger.warning("bulk.request_failed", batch=name, error=e)
+                    image = None
+                if image is None:
+                    results.append(None)
+                    continue
+                image_path = os.path.join(batch_dir, f"{index}{image.extension}")
+                image.save(image_path)
+                results.append({"path": image_path, "mime_type": image.mime_type})
+        self.write_state(name, types.JobState.JOB_STATE_SUCCEEDED, results)
+
+    def poll(self, name: str) -> Optional[List[Optional[GeneratedImage]]]:
+        with open(os.path.join(self.get_batch_dir(name), "state.json"), "r") as f:
+            state = json.load(f)
+        if types.JobState(state["state"]) not in BATCH_DONE_STATES:
+            return None
+        results = []
+        for result in state["results"]:
+            if result is None:
+                results.append(None)
+                continue
+            with open(result["path"], "rb") as f:
+                results.append(
+                    GeneratedImage(data=f.read(), mime_type=result["mime_type"])
+                )
+        return results
+
+
+BATCH_BACKENDS = {
+    "gemini": GeminiBatchBackend,
+    "local": LocalBatchBackend,
+    "fake": lambda: LocalBatchBackend(generate=generate_fake_image),
+}
+
+
+def get_bulk_item(story: Story, asset: str) -> BulkItem:
+    return BulkItem(
+        story_path=story.get_story_file_path(),
+        asset=asset,
+        prompt=story.get_asset_prompt(asset),
+        reference_image_path=story.get_asset_reference_image_path(asset),
+        fingerprint=story.get_asset_fingerprint(asset),
+    )
+
+
+def chunk_items(items: List[BulkItem]) -> Iterator[List[BulkItem]]:
+    chunk, chunk_size = [], 0
+    for item in items:
+        size = item.get_size()
+        if chunk and chunk_size + size > BULK_BATCH_MAX_BYTES:
+            yield chunk
+            chunk, chunk_size = [], 0
+        chunk.append(item)
+        chunk_size += size
+    if chunk:
+        yield chunk
+
+
+def apply_results(
+    stories: Dict[str, Story],
+    items: List[BulkItem],
+    results: List[Optional[GeneratedImage]],
+) -> int:
+    applied = 0
+    for index, item in enumerate(items):
+        image = results[index] if index < len(results) else None
+        story = stories[item.story_path]
+        if image is None:
+            logger.warning("asset.failed", story=story.title, asset=item.asset)
+            continue
+        # Same lease and versioning as an interactive render of the asset
+        story.run_asset_generation(
+            item.asset,
+            lambda item=item, image=image: story.apply_generated_image(
+                item.asset, image, item.fingerprint
+            ),
+        )
+        applied += 1
+    return applied
+
+
+def run_wave(
+    backend, stories: Dict[str, Story], items: List[BulkItem], poll_seconds: float
+) -> int:
+    batches = {backend.submit(chunk): chunk for chunk in chunk_items(items)}
+    logger.info("bulk.wave_submitted", requests=len(items), batches=len(batches))
+    applied = 0
+    while batches:
+        time.sleep(poll_seconds)
+        for name, chunk in list(batches.items()):
+            results = backend.poll(name)
+            if results is None:
+                continue
+            applied += apply_results(stories, chunk, results)
+            del batches[name]
+            logger.info("bulk.batch_done", batch=name, pending=len(batches))
+    return applied
+
+
+def run_bulk_render(
+    story_paths: List[str],
+    backend_name: str = BULK_BATCH_BACKEND,
+    force: bool = False,
+    poll_seconds: float = BULK_POLL_SECONDS,
+) -> int:
+    backend = BATCH_BACKENDS[backend_name]()
+    stories = {story_path: Story.load(story_path) for story_path in story_paths}
+    assets = {
+        story_path: story.get_assets() if force else story.get_stale_assets()
+        for story_path, story in stories.items()
+    }
+    applied = 0
+    for in_wave in BULK_WAVES:
+        items = []
+        for story_path, story in stories.items():
+            for asset in filter(in_wave, assets[story_path]):
+                if (
+                    asset != Asset.CHARACTER_SHEET
+                    and not story.character_sheet.image_path
+                ):
+                    logger.warning("bulk.no_character_sheet", story=story.title)
+                    break
+                items.append(get_bulk_item(story, asset))
+        if items:
+            applied += run_wave(backend, stories, items, poll_seconds)
+    logger.info("bulk.done", stories=len(stories), applied=applied)
+    return applied
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("story_paths", nargs="*", help="Story JSON files, all if empty")
+    parser.add_argument(
+        "--backend", choices=list(BATCH_BACKENDS), default=BULK_BATCH_BACKEND
+    )
+    parser.add_argument("--force", action="store_true", help="Re-render every asset")
+    parser.add_argument("--poll-seconds", type=float, default=BULK_POLL_SECONDS)
+    args = parser.parse_args()
+    run_bulk_render(
+        args.story_paths or get_story_file_paths(),
+        backend_name=args.backend,
+        force=args.force,
+        poll_seconds=args.poll_seconds,
+    )
@@ -0,0 +1,88 @@
+import hashlib
+import json
+import os
+import time
+from typing import Optional
+
+from constants import (
+    TEXT_CACHE_DIR,
+    TEXT_CACHE_ENABLED,
+    TEXT_CACHE_MAX_ENTRIES,
+    TEXT_CACHE_TTL_SECONDS,
+)
+
+
+def normalize_prompt(prompt: str) -> str:
+    return " ".join(prompt.split())
+
+
+def get_text_cache_key(
+    model_name: str, system_prompt: str, user_prompt: str, schema: Optional[dict]
+) -> str:
+    key_data = json.dumps(
+        {
+            "model": model_name,
+            "system_prompt": normalize_prompt(system_prompt),
+            "user_prompt": normalize_prompt(user_prompt),
+            "schema": schema,
+        },
+        sort_keys=True,
+    )
+    return hashlib.sha256(key_data.encode("utf-8")).hexdigest()
+
+
+def get_text_cache_path(key: str) -> str:
+    return os.path.join(TEXT_CACHE_DIR, f"{key}.json")
+
+
+def get_cached_text(key: str) -> Optional[str]:
+    if not TEXT_CACHE_ENABLED:
+        return None
+    cache_path = get_text_cache_path(key)
+    try:
+        if time.time() - os.path.getmtime(cache_path) > TEXT_CACHE_TTL_SECONDS:
+            os.remove(cache_path)
+            return None
+        with open(cache_path, "r") as f:
+            text = f.read()
+        os.utime(cache_path)  # Mark as recently used for eviction
+        return text
+    except FileNotFoundError:
+        return None
+
+
+def set_cached_text(key: str, text: str):
+    if not TEXT_CACHE_ENABLED:
+        return
+    os.makedirs(TEXT_CACHE_DIR, exist_ok=True)
+    cache_path = get_text_cache_path(key)
+    temp_path = f"{cache_path}.{os.getpid()}.tmp"
+    with open(temp_path, "w") as f:
+        f.write(text)
+    os.replace(temp_path, cache_path)
+    evict_text_cache()
+
+
+def evict_text_cache():
+    entries = []
+    now = time.time()
+    for file_name in os.listdir(TEXT_CACHE_DIR):
+        if not file_name.endswith(".json"):
+            continue
+        cache_path = os.path.join(TEXT_CACHE_DIR, file_name)
+        try:
+            mtime = os.path.getmtime(cache_path)
+            if now - mtime > TEXT_CACHE_TTL_SECONDS:
+                os.remove(cache_path)
+            else:
+                entries.append((mtime, cache_path))
+        except FileNotFoundError:
+            continue
+    # Least recently used entries go first
+    for _, cache_path in sorted(entries)[
+        : max(0, len(entries) - TEXT_CACHE_MAX_ENTRIES)
+    ]:
+        try:
+            os.remove(cache_path)
+        except FileNotFoundError:
+            pass
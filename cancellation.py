@@ -0,0 +1,81 @@
+import threading
+import time
+from typing import Dict, Optional, Tuple
+
+
+class GenerationCancelled(Exception):
+    pass
+
+
+# Cooperative cancellation with an optional deadline. Child tokens are cancelled
+# with their parent and never outlive the parent's deadline.
+class CancellationToken:
+    def __init__(
+        self,
+        timeout: Optional[float] = None,
+        parent: Optional["CancellationToken"] = None,
+        created_at: Optional[float] = None,
+    ):
+        self.parent = parent
+        self.created_at = created_at or (parent.created_at if parent else time.time())
+        deadlines = [
+            deadline
+            for deadline in [
+                time.time() + timeout if timeout is not None else None,
+                parent.deadline if parent else None,
+            ]
+            if deadline is not None
+        ]
+        self.deadline: Optional[float] = min(deadlines) if deadlines else None
+        self.reason: Optional[str] = None
+        self._cancelled = threading.Event()
+
+    def child(self, timeout: Optional[float] = None) -> "CancellationToken":
+        return CancellationToken(timeout=timeout, parent=self)
+
+    def cancel(self, reason: str = "cancelled"):
+        self.reason = self.reason or reason
+        self._cancelled.set()
+
+    def is_cancelled(self) -> bool:
+        if self._cancelled.is_set():
+            return True
+        if self.deadline is not None and time.time() >= self.deadline:
+            self.cancel("deadline exceeded")
+            return True
+        if self.parent and self.parent.is_cancelled():
+            self.cancel(self.parent.reason)
+            return True
+        return False
+
+    def remaining(self) -> Optional[float]:
+        if self.deadline is None:
+            return None
+        return max(0.0, self.deadline - time.time())
+
+    def raise_if_cancelled(self):
+        if self.is_cancelled():
+            raise GenerationCancelled(self.reason)
+
+
+_ACTIVE_TOKENS: Dict[Tuple[str, ...], CancellationToken] = {}
+_ACTIVE_TOKENS_LOCK = threading.Lock()
+
+
+def supersede(key: Tuple[str, ...], token: CancellationToken):
+    # Only the most recent request for a key keeps running. A request that is
+    # older than the one already registered cancels itself instead.
+    with _ACTIVE_TOKENS_LOCK:
+        active_token = _ACTIVE_TOKENS.get(key)
+        if active_token is not None and active_token is not token:
+            if active_token.created_at > token.created_at:
+                token.cancel("superseded")
+                return
+            active_token.cancel("superseded")
+        _ACTIVE_TOKENS[key] = token
+
+
+def release(key: Tuple[str, ...], token: CancellationToken):
+    with _ACTIVE_TOKENS_LOCK:
+        if _ACTIVE_TOKENS.get(key) is token:
+            del _ACTIVE_TOKENS[key]
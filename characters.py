@@ -0,0 +1,125 @@
+import hashlib
+import json
+import os
+import re
+import threading
+import time
+from difflib import SequenceMatcher
+from typing import List, Optional
+
+from pydantic import BaseModel, ValidationError
+
+from blobs import get_blob_path_from_name
+from constants import CHARACTER_PROMPT_SIMILARITY, CHARACTERS_DIR
+from images import get_file_hash
+
+
+# Accepted character sheets, shared across stories. A sheet is found again by
+# the protagonist photo, the art style and the protagonist details the user
+# typed, so a returning family starts a new book with the sheet they accepted.
+class CharacterEntry(BaseModel):
+    key: str
+    blob: str  # File name in the blob store
+    characters: List[str] = []  # Normalized names of the characters on the sheet
+    prompt: str = ""  # Normalized character sheet prompt the sheet was drawn from
+    story_title: str
+    updated_at: float
+
+
+def normalize_description(text: str) -> str:
+    return " ".join(re.sub(r"[^\w\s]", " ", text.lower()).split())
+
+
+def normalize_characters(characters: List[str]) -> List[str]:
+    return sorted({normalize_description(name) for name in characters} - {""})
+
+
+def has_entry_characters(
+    entry: CharacterEntry, characters: List[str], character_sheet_prompt: str
+) -> bool:
+    # The accepted sheet serves the story as-is when everyone in it is drawn
+    names = normalize_characters(characters)
+    if names and entry.characters:
+        return set(names) <= set(entry.characters)
+    # Without names only the prompts are left, which the model words
+    # differently on every run
+    similarity = SequenceMatcher(
+        None,
+        entry.prompt.split(),
+        normalize_description(character_sheet_prompt).split(),
+    ).ratio()
+    return similarity >= CHARACTER_PROMPT_SIMILARITY
+
+
+def get_character_key(
+    protagonist_image_path: Optional[str],
+    style: str,
+    protagonist_details: Optional[str],
+) -> Optional[str]:
+    if not protagonist_image_path or not protagonist_details:
+        return None
+    if not os.path.exists(protagonist_image_path):
+        return None
+    key_data = json.dumps(
+        {
+            "protagonist_image": get_file_hash(protagonist_image_path),
+            "style": style,
+            "protagonist_details": normalize_description(protagonist_details),
+        },
+        sort_keys=True,
+    )
+    return hashlib.sha256(key_data.encode("utf-8")).hexdigest()
+
+
+def get_character_entry_path(key: str) -> str:
+    return os.path.join(CHARACTERS_DIR, f"{key}.json")
+
+
+def find_character_entry(key: Optional[str]) -> Optional[CharacterEntry]:
+    if not key:
+        return None
+    try:
+        with open(get_character_entry_path(key), "rb") as f:
+            entry = CharacterEntry.model_validate_json(f.read())
+    except (FileNotFoundError, ValidationError):
+        return None
+    if not os.path.exists(get_blob_path_from_name(entry.blob)):
+        return None
+    return entry
+
+
+def save_character_entry(
+    key: str,
+    blob: str,
+    characters: List[str],
+    character_sheet_prompt: str,
+    story_title: str,
+) -> CharacterEntry:
+    # The most recently accepted sheet wins
+    entry = CharacterEntry(
+        key=key,
+        blob=blob,
+        characters=normalize_characters(characters),
+        prompt=normalize_description(character_sheet_prompt),
+        story_title=story_title,
+        updated_at=time.time(),
+    )
+    os.makedirs(CHARACTERS_DIR, exist_ok=True)
+    entry_path = get_character_entry_path(key)
+    temp_path = f"{entry_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(temp_path, "wb") as f:
+        f.write(entry.model_dump_json().encode("utf-8"))
+    os.replace(temp_path, entry_path)
+    return entry
+
+
+def get_character_blob_names() -> List[str]:
+    if not os.path.exists(CHARACTERS_DIR):
+        return []
+    blob_names = []
+    for file_name in os.listdir(CHARACTERS_DIR):
+        if file_name.endswith(".json"):
+            entry = find_character_entry(file_name[: -len(".json")])
+            if entry:
+                blob_names.append(entry.blob)
+    return blob_names
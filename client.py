@@ -0,0 +1,142 @@
+import http.client
+import json
+import threading
+import time
+from typing import Callable, Optional
+from urllib.parse import urlparse
+
+from constants import JOB_POLL_SECONDS, WORKER_URL
+from jobs import (
+    CreateStoryRequest,
+    Job,
+    RenderAssetsRequest,
+    cancel_job,
+    get_job,
+    submit_create_story,
+    submit_render_assets,
+)
+
+
+# Runs generation jobs inside the Streamlit process
+class LocalGenerationClient:
+    def create_story(self, request: CreateStoryRequest) -> Job:
+        return submit_create_story(request)
+
+    def render_assets(self, request: RenderAssetsRequest) -> Job:
+        return submit_render_assets(request)
+
+    def get_job(self, job_id: str) -> Optional[Job]:
+        return get_job(job_id)
+
+    def cancel_job(self, job_id: str) -> Optional[Job]:
+        return cancel_job(job_id)
+
+
+# Talks to a standalone `worker.py` service
+class HttpGenerationClient:
+    def __init__(self, base_url: str, timeout: float = 30):
+        url = urlparse(base_url)
+        self.host = url.hostname
+        self.port = url.port or 80
+        self.timeout = timeout
+        # One keep-alive connection per Streamlit script thread
+        self.connections = threading.local()
+
+    def get_connection(self) -> http.client.HTTPConnection:
+        connection = getattr(self.connections, "connection", None)
+        if connection is None:
+            connection = http.client.HTTPConnection(
+                self.host, self.port, timeout=self.timeout
+            )
+            self.connections.connection = connection
+        return connection
+
+    def close_connection(self):
+        connection = getattr(self.connections, "connection", None)
+        if connection is not None:
+            connection.close()
+            self.connections.connection = None
+
+    def request(self, method: str, path: str, body: Optional[str] = None) -> dict:
+        if method != "GET":
+            # Not retried, so it goes out on a fresh connection rather than one
+            # the worker may have closed while idle
+            self.close_connection()
+        for attempt in range(2):
+            connection = self.get_connection()
+            try:
+                connection.request(
+                    method,
+                    path,
+                    body=body,
+                    headers={"Content-Type": "application/json"},
+                )
+                response = connection.getresponse()
+                data = json.loads(response.read() or b"null")
+                if response.status >= 400:
+                    raise RuntimeError(f"Worker returned {response.status}: {data}")
+                return data
+            except (http.client.HTTPException, ConnectionError):
+                # The worker may have closed an idle keep-alive connection. Only
+                # reads are sent again, a submission may have created its job.
+                self.close_connection()
+                if attempt or method != "GET":
+                    raise
+
+    def create_story(self, request: CreateStoryRequest) -> Job:
+        return Job.model_validate(
+            self.request("POST", "/stories", request.model_dump_json())
+        )
+
+    def render_assets(self, request: RenderAssetsRequest) -> Job:
+        return Job.model_validate(
+            self.request("POST", "/assets", request.model_dump_json())
+        )
+
+    def get_job(self, job_id: str) -> Optional[Job]:
+        try:
+            return Job.model_validate(self.request("GET", f"/jobs/{job_id}"))
+        except RuntimeError:
+            return None
+
+    def cancel_job(self, job_id: str) -> Optional[Job]:
+        try:
+            return Job.model_validate(self.request("POST", f"/jobs/{job_id}/cancel"))
+        except RuntimeError:
+            return None
+
+
+_CLIENT = HttpGenerationClient(WORKER_URL) if WORKER_URL else LocalGenerationClient()
+
+
+def get_generation_client():
+    return _CLIENT
+
+
+def wait_for_job(
+    job_id: str, on_progress: Optional[Callable[[str], None]] = None
+) -> Optional[Job]:
+    try:
+        return poll_job(job_id, on_progress)
+    except BaseException:
+        # Streamlit interrupts the script on reruns and navigation, nobody is
+        # going to look at the result anymore.
+        get_generation_client().cancel_job(job_id)
+        raise
+
+
+def poll_job(
+    job_id: str, on_progress: Optional[Callable[[str], None]] = None
+) -> Optional[Job]:
+    reported = 0
+    while True:
+        job = get_generation_client().get_job(job_id)
+        if job is None:
+            return None
+        if on_progress:
+            for message in job.progress[reported:]:
+                on_progress(message)
+        reported = len(job.progress)
+        if job.is_finished():
+            return job
+        time.sleep(JOB_POLL_SECONDS)
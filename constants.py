@@ -1,11 +1,99 @@
+import os
 from collections import namedtuple
 from enum import Enum
 
 STORIES_BASE_DIR = ".data/stories"
+# Set STORY_JSON_COMPACT=1 to save stories without indentation
+STORY_JSON_INDENT = None if os.getenv("STORY_JSON_COMPACT") == "1" else 2
+STORY_LOAD_MAX_WORKERS = 16  # Threads used to load a cold story library
+STORY_LOAD_PARALLEL_THRESHOLD = 32  # Smaller libraries are loaded serially
+# "auto" watches the stories with the native file events of the OS, "poll" always polls
+STORY_WATCH_MODE = os.getenv("STORY_WATCH_MODE", "auto")
+STORY_WATCH_POLL_SECONDS = 2
+STORY_INDEX_REFRESH_SECONDS = 5  # How often open sessions check for library changes
+BLOBS_DIR = ".data/blobs"  # Content-addressed renders shared by all stories
+BLOB_GC_GRACE_SECONDS = 60 * 60  # Unreferenced blobs younger than this are kept
+# Between garbage collections of the blob store, 0 turns them off
+BLOB_GC_INTERVAL_SECONDS = int(os.getenv("BLOB_GC_INTERVAL_SECONDS", str(6 * 60 * 60)))
+UPLOADS_DIR = ".data/uploads"  # Normalized reference images, one per content hash
+UPLOAD_IMAGE_MAX_SIZE = 1536  # Longest side of a stored reference image
+UPLOAD_IMAGE_QUALITY = 90
+CHARACTERS_DIR = ".data/characters"  # Accepted character sheets shared across stories
+# "auto" puts a matching accepted sheet into new stories, "offer" only offers it
+CHARACTER_SHEET_REUSE = os.getenv("CHARACTER_SHEET_REUSE", "auto")
+# Word overlap of two sheet prompts taken as the same cast, when names are missing
+CHARACTER_PROMPT_SIMILARITY = 0.6
+TEXT_CACHE_DIR = ".data/cache/text"
+EXPORTS_DIR = ".data/exports"  # PDF/EPUB downloads, one per story revision
+EXPORT_IMAGES_DIR = ".data/exports/images"  # Page sized JPEGs shared by exports
+EXPORT_DPI = 144  # Orientation pixels per inch of exported page
+EXPORT_IMAGE_QUALITY = 85
+EXPORT_TEXT_BAND = 0.22  # Share of the page height kept for the page text
+TEXT_CACHE_ENABLED = True  # Set to False to always call the model
+TEXT_CACHE_TTL_SECONDS = 7 * 24 * 60 * 60
+TEXT_CACHE_MAX_ENTRIES = 512
+LOCKS_DIR = ".data/locks"
+# Leases and job records, shared by all replicas mounting .data
+LEASES_DB_PATH = ".data/leases.sqlite3"
+LEASE_TTL_SECONDS = 120  # Leases not renewed within this time are taken over
+LEASE_POLL_SECONDS = 2
+JOB_MAX_WORKERS = 8  # Concurrent batch and speculative jobs per process
+# Jobs a user waits on run on their own threads, so batch jobs never hold them all
+INTERACTIVE_JOB_MAX_WORKERS = 4
+JOB_HISTORY_MAX = 256  # Finished jobs kept around for status queries
+JOB_POLL_SECONDS = 1  # Also how often running jobs save their progress
+# Unfinished jobs not saved within this time lost their worker and count as failed
+JOB_ORPHANED_SECONDS = 30
+STORY_DEADLINE_SECONDS = 5 * 60  # Deadline for generating the story text
+ASSET_DEADLINE_SECONDS = 3 * 60  # Deadline for rendering a single asset
+BOOK_DEADLINE_SECONDS = 45 * 60  # Deadline for a whole asset generation job
+GEMINI_MAX_CONCURRENCY = 8  # Concurrent model calls per process
+USER_MAX_CONCURRENCY = 2  # Concurrent model calls per user/session
+INTERACTIVE_RESERVED_SLOTS = 2  # Model call slots batch work never takes
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+LOG_FORMAT = os.getenv("LOG_FORMAT", "text")  # "text" or "json"
+# Characters of a prompt kept in debug logs, 0 keeps only its hash and length
+LOG_PROMPT_MAX_CHARS = int(os.getenv("LOG_PROMPT_MAX_CHARS", "80"))
+LOG_QUEUE_MAX = 10000  # Records waiting to be written before new ones are dropped
+LOG_SAMPLE_RATES = {"main.rerun": 0.1, "locks.waiting": 0.1}  # Fraction kept
+# Pages rendered ahead once the character sheet is accepted, off (0) by default
+SPECULATIVE_PREFETCH_PAGES = int(os.getenv("SPECULATIVE_PREFETCH_PAGES", "0"))
+SPECULATION_BUDGET_PER_USER = 4  # Speculative pages in flight or not yet claimed
+SPECULATION_TTL_SECONDS = 15 * 60  # Unclaimed prefetched pages stop counting after
+# "gemini" uses the provider's batch API, "local" the file based stand-in and
+# "fake" the stand-in answering with placeholder images instead of model calls
+BULK_BATCH_BACKEND = os.getenv("BULK_BATCH_BACKEND", "gemini")
+BULK_FAKE_IMAGE_SIZE = (512, 512)
+BULK_BATCH_DIR = ".data/batches"  # Requests and results of local batches
+BULK_BATCH_MAX_BYTES = 16 * 1024 * 1024  # Inline batch requests are capped at 20MB
+BULK_POLL_SECONDS = 60
+WORKER_URL = os.getenv("WORKER_URL")  # Unset runs generation jobs in-process
+WORKER_HOST = os.getenv("WORKER_HOST", "0.0.0.0")
+WORKER_PORT = int(os.getenv("WORKER_PORT", "8600"))
 GEMINI_IMAGE_GENERATION_MODEL = "models/gemini-2.5-flash-image-preview"
 GEMINI_TEXT_GENERATION_MODEL_FAST = "models/gemini-2.5-flash"
 GEMINI_TEXT_GENERATION_MODEL_ACCURATE = "models/gemini-2.5-pro"
 INTEGRATE_TEXT_IN_IMAGE = True  # Whether to integrate text in image generation (for better text rendering in images)
+CHAT_SESSION_HISTORY_TURNS = 10  # Page turns kept in the illustration chat, as text
+CHAT_SESSIONS_DIR = ".data/sessions"  # Illustration chat history, one per story
+IMAGE_OUTPUT_FORMAT = None  # None keeps the model's bytes as-is, e.g. "JPEG" to explicitly transcode generated images
+IMAGE_TRANSCODE_QUALITY = 90
+IMAGE_TRANSCODE_PROGRESSIVE = True
+IMAGE_EXECUTOR_MAX_WORKERS = 2  # Processes shared by all sessions for image transforms
+IMAGE_EXECUTOR_MAX_QUEUED = 16  # Pending image tasks before callers block
+IMAGE_MAX_OPEN_HANDLES = 4  # Images a process holds open (and decodes) at once
+# Records allocations with tracemalloc and adds the diagnostics page
+MEMORY_PROFILING = os.getenv("MEMORY_PROFILING") == "1"
+MEMORY_PROFILING_FRAMES = 5  # Stack frames kept per traced allocation
+DIAGNOSTICS_TOP_ALLOCATIONS = 25
+FLIPBOOK_WIDTH_BUCKETS = (360, 480, 600, 800, 1000)  # Snapped flipbook widths
+FLIPBOOK_WIDTH_MAX_AGE_SECONDS = 60  # Measure again to follow window resizes
+FLIPBOOK_CACHE_MAX_ENTRIES = 32  # Rendered flipbooks kept in memory per process
+FLIPBOOK_PREFETCH_PAGES = 2  # Pages loaded on either side of the current spread
+FLIPBOOK_IMAGE_CACHE_MAX_ENTRIES = 128  # Page images kept for the media endpoint
+PREVIEW_IMAGE_SIZE = 1024  # Longest side of the asset preview in the story page
+PREVIEW_CACHE_MAX_ENTRIES = 64
+IMAGE_PLACEHOLDER_SIZE = 24  # Longest edge (px) of the low-res placeholder previews
 
 
 class PageCount(str, Enum):
@@ -37,7 +125,6 @@ class Key:
     ART_STYLE = "key_art_style"
     PAGE_COUNT = "key_page_count"
     PROTAGONIST_IMAGE = "key_protagonist_image"
-    PROTAGONIST_IMAGE_DISPLAY = "key_protagonist_image_display"
     GENERATE_ASSETS_SELECTED_ASSET = "key_generate_assets_selected_asset"
 
 
@@ -48,6 +135,46 @@ class Session:
     CHARACTER_SHEET_ASSET_VALUE = "session_character_sheet_asset_value"
     COVER_IMAGE_ASSET_VALUE = "session_cover_image_asset_value"
     PAGE_ILLUSTRATION_ASSET_VALUES = "session_page_illustration_asset_values"
+    FLIPBOOK_WIDTH = "session_flipbook_width"
+    ASSET_JOBS = "session_asset_jobs"
+    PROTAGONIST_IMAGE_HASH = "session_protagonist_image_hash"
+    TOASTS = "session_toasts"
+    ASSET_JOB_SUBMITTED = "session_asset_job_submitted"
+    STORIES_VERSION = "session_stories_version"
+
+
+class RenderMode(str, Enum):
+    STATELESS = "stateless"  # Every illustration is an independent request
+    CHAT = "chat"  # Illustrations are follow-up turns of one session per story
+
+
+# Chat sends the cover along with the sheet in every request, so it is opt-in
+ILLUSTRATION_RENDER_MODE = RenderMode(
+    os.getenv("ILLUSTRATION_RENDER_MODE", RenderMode.STATELESS.value)
+)
+
+
+class Priority(str, Enum):
+    INTERACTIVE = "interactive"  # A user is waiting on this single request
+    BATCH = "batch"  # Bulk work such as rendering all assets of a book
+    SPECULATIVE = "speculative"  # Rendered ahead of time, nobody waits on it
+
+
+class ExportFormat(str, Enum):
+    PDF = "pdf"
+    EPUB = "epub"
+
+
+EXPORT_MIME_TYPES = {
+    ExportFormat.PDF: "application/pdf",
+    ExportFormat.EPUB: "application/epub+zip",
+}
+
+
+class Asset:
+    CHARACTER_SHEET = "Character Sheet"
+    COVER_IMAGE = "Cover Image"
+    PAGE = "Page"  # Page assets are identified as "Page {page_number}"
 
 
 class Orientation(str, Enum):
@@ -135,6 +262,11 @@ HTML_TEMPLATE = """
             margin-top: 5px;
             margin-bottom: 5px;
             min-height: 200px;
+            transition: filter 0.3s;
+        }
+
+        .page-image.placeholder {
+            filter: blur(8px);
         }
 
         .page-text {
@@ -209,11 +341,51 @@ HTML_TEMPLATE = """
         const CONFIG = {
             width: {{WIDTH}},
             height: {{HEIGHT}},
+            prefetch: {{PREFETCH}},
             pages: {{PAGES_DATA}}
         };
 
         document.addEventListener('DOMContentLoaded', function() {
             const flipbookElement = document.getElementById('flipbook');
+            const imageElements = {};
+            const loadingImages = {};
+
+            const backgroundFor = (source) => source ? `url('${source}')` : 'none';
+
+            // Only the current spread plus the prefetch window holds full images,
+            // every other page shows its low-res placeholder.
+            const updateLoadedImages = (currentIndex) => {
+                const first = currentIndex - CONFIG.prefetch;
+                const last = currentIndex + 1 + CONFIG.prefetch;
+                Object.entries(imageElements).forEach(([key, element]) => {
+                    const index = Number(key);
+                    const pageData = CONFIG.pages[index];
+                    if (index >= first && index <= last) {
+                        if (element.dataset.loaded || loadingImages[index]) {
+                            return;
+                        }
+                        const image = new Image();
+                        loadingImages[index] = image;
+                        image.onload = () => {
+                            if (loadingImages[index] !== image) {
+                                return;
+                            }
+                            delete loadingImages[index];
+                            element.style.backgroundImage = backgroundFor(pageData.image);
+                            element.classList.remove('placeholder');
+                            element.dataset.loaded = 'true';
+                        };
+                        image.src = pageData.image;
+                    } else {
+                        delete loadingImages[index];
+                        if (element.dataset.loaded) {
+                            element.style.backgroundImage = backgroundFor(pageData.placeholder);
+                            element.classList.add('placeholder');
+                            delete element.dataset.loaded;
+                        }
+                    }
+                });
+            };
 
             CONFIG.pages.forEach((pageData, index) => {
                 const pageDiv = document.createElement('div');
@@ -221,13 +393,17 @@ HTML_TEMPLATE = """
 
                 const content = `
                     <div class="page-content">
-                        ${pageData.image ? `<div class="page-image" style="background-image: url('${pageData.image}')"></div>` : ''}
+                        ${pageData.image ? `<div class="page-image placeholder" data-index="${index}" style="background-image: ${backgroundFor(pageData.placeholder)}"></div>` : ''}
                         ${pageData.text ? `<div class="page-text">${pageData.text}</div>` : ''}
                         <div class="page-footer">${index + 1}</div>
                     </div>
                 `;
 
                 pageDiv.innerHTML = content;
+                const imageElement = pageDiv.querySelector('.page-image');
+                if (imageElement) {
+                    imageElements[index] = imageElement;
+                }
                 flipbookElement.appendChild(pageDiv);
             });
 
@@ -263,9 +439,11 @@ HTML_TEMPLATE = """
 
             pageFlip.on('flip', () => {
                 updatePageInfo();
+                updateLoadedImages(pageFlip.getCurrentPageIndex());
             });
 
             updatePageInfo();
+            updateLoadedImages(pageFlip.getCurrentPageIndex());
         });
     </script>
 </body>
@@ -0,0 +1,396 @@
+import html
+import os
+import shutil
+import textwrap
+import zipfile
+from datetime import datetime, timezone
+from typing import BinaryIO, Iterator, List, Optional, Tuple
+
+from constants import (
+    EXPORT_DPI,
+    EXPORT_IMAGE_QUALITY,
+    EXPORT_IMAGES_DIR,
+    EXPORT_TEXT_BAND,
+    EXPORTS_DIR,
+    ORIENTATION_DETAILS_LOOKUP,
+    ExportFormat,
+)
+from images import get_file_hash, make_export_image, open_image, run_image_task
+from locks import single_flight
+from log import get_logger
+from models import Story
+from utils import to_kebab_case
+
+logger = get_logger(__name__)
+
+# Exports are written one page at a time. Only the current page's image is
+# ever open, page images are copied into the output in chunks, so memory does
+# not grow with the page count.
+
+
+class ExportPage:
+    def __init__(self, image_path: Optional[str], text: str, is_cover: bool = False):
+        self.image_path = image_path
+        self.text = text
+        self.is_cover = is_cover
+
+
+def get_export_pages(story: Story) -> Iterator[ExportPage]:
+    yield ExportPage(story.cover_image.image_path, "", is_cover=True)
+    for page in story.pages:
+        yield ExportPage(page.image_path, page.text or "")
+
+
+def get_page_size(story: Story) -> Tuple[int, int]:
+    details = ORIENTATION_DETAILS_LOOKUP[story.get_orientation()]
+    return details.width, details.height
+
+
+def get_image_box(page: ExportPage, width: int, height: int) -> Tuple[int, int]:
+    if page.is_cover:
+        return width, height
+    return width, int(height * (1 - EXPORT_TEXT_BAND))
+
+
+def get_export_image(
+    image_path: Optional[str], max_width: int, max_height: int
+) -> Optional[Tuple[str, int, int]]:
+    if not image_path or not os.path.exists(image_path):
+        return None
+    # Derivatives are keyed by content, so every export and revision of the
+    # same render shares one file.
+    output_path = os.path.join(
+        EXPORT_IMAGES_DIR,
+        f"{get_file_hash(image_path)}-{max_width}x{max_height}.jpeg",
+    )
+    if os.path.exists(output_path):
+        with open_image(output_path) as image:
+            return output_path, image.width, image.height
+    os.makedirs(EXPORT_IMAGES_DIR, exist_ok=True)
+    return run_image_task(
+        make_export_image,
+        image_path,
+        output_path,
+        max_width,
+        max_height,
+        EXPORT_IMAGE_QUALITY,
+    )
+
+
+def escape_pdf_text(text: str) -> bytes:
+    text = text.replace("\\", "\\\\").replace("(", "\\(").replace(")", "\\)")
+    return text.encode("cp1252", "replace")
+
+
+def layout_text(text: str, width: float, height: float) -> Tuple[float, List[str]]:
+    # Shrinks the font until the wrapped text fits the band. Helvetica glyphs
+    # average about half the font size in width.
+    font_size = min(width, height * 4) / 24
+    while True:
+        lines = textwrap.wrap(text, width=max(1, int(width / (font_size * 0.5))))
+        if len(lines) * font_size * 1.3 <= height or font_size <= 6:
+            return font_size, lines
+        font_size *= 0.9
+
+
+class PdfWriter:
+    CATALOG, PAGES, FONT, INFO = 1, 2, 3, 4
+
+    def __init__(self, output: BinaryIO):
+        self.output = output
+        self.position = 0
+        self.offsets = {}
+        self.next_object = 5
+        self.page_objects: List[int] = []
+        self.write(b"%PDF-1.4\n%\xe2\xe3\xcf\xd3\n")
+
+    def write(self, data: bytes):
+        self.output.write(data)
+        self.position += len(data)
+
+    def allocate(self) -> int:
+        number = self.next_object
+        self.next_object += 1
+        return number
+
+    def write_object(self, number: int, body: bytes):
+        self.offsets[number] = self.position
+        self.write(b"%d 0 obj\n%s\nendobj\n" % (number, body))
+
+    def write_image(self, number: int, image_path: str, width: int, height: int):
+        length = os.path.getsize(image_path)
+        self.offsets[number] = self.position
+        self.write(
+            b"%d 0 obj\n<< /Type /XObject /Subtype /Image /Width %d /Height %d "
+            b"/ColorSpace /DeviceRGB /BitsPerComponent 8 /Filter /DCTDecode "
+            b"/Length %d >>\nstream\n" % (number, width, height, length)
+        )
+        # JPEG data goes into the PDF as is, DCTDecode is the JPEG codec
+        with open(image_path, "rb") as f:
+            shutil.copyfileobj(f, self.output)
+        self.position += length
+        self.write(b"\nendstream\nendobj\n")
+
+    def add_page(
+        self,
+        page: ExportPage,
+        image: Optional[Tuple[str, int, int]],
+        width: int,
+        height: int,
+    ):
+        scale = 72 / EXPORT_DPI
+        page_width, page_height = width * scale, height * scale
+        box_width, box_height = get_image_box(page, width, height)
+        box_width, box_height = box_width * scale, box_height * scale
+        content = b""
+        resources = b"/Font << /F1 %d 0 R >>" % self.FONT
+        if image:
+            image_object = self.allocate()
+            self.write_image(image_object, *image)
+            _, image_width, image_height = image
+            fit = min(box_width / image_width, box_height / image_height)
+            draw_width, draw_height = image_width * fit, image_height * fit
+            x = (page_width - draw_width) / 2
+            y = page_height - box_height + (box_height - draw_height) / 2
+            content += b"q %.2f 0 0 %.2f %.2f %.2f cm /Im0 Do Q\n" % (
+                draw_width,
+                draw_height,
+                x,
+                y,
+            )
+            resources += b" /XObject << /Im0 %d 0 R >>" % image_object
+        if page.text:
+            margin = page_width * 0.06
+            band_height = page_height - box_height - margin
+            font_size, lines = layout_text(
+                page.text, page_width - 2 * margin, band_height
+            )
+            content += b"BT /F1 %.2f Tf %.2f TL %.2f %.2f Td\n" % (
+                font_size,
+                font_size * 1.3,
+                margin,
+                page_height - box_height - font_size * 1.3,
+            )
+            for line in lines:
+                content += b"(%s) Tj T*\n" % escape_pdf_text(line)
+            content += b"ET\n"
+
+        content_object = self.allocate()
+        self.write_object(
+            content_object,
+            b"<< /Length %d >>\nstream\n%s\nendstream" % (len(content), content),
+        )
+        page_object = self.allocate()
+        self.write_object(
+            page_object,
+            b"<< /Type /Page /Parent %d 0 R /MediaBox [0 0 %.2f %.2f] "
+            b"/Resources << %s >> /Contents %d 0 R >>"
+            % (self.PAGES, page_width, page_height, resources, content_object),
+        )
+        self.page_objects.append(page_object)
+
+    def close(self, title: str):
+        self.write_object(
+            self.FONT,
+            b"<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica "
+            b"/Encoding /WinAnsiEncoding >>",
+        )
+        kids = b" ".join(b"%d 0 R" % number for number in self.page_objects)
+        self.write_object(
+            self.PAGES,
+            b"<< /Type /Pages /Kids [%s] /Count %d >>" % (kids, len(self.page_objects)),
+        )
+        self.write_object(self.INFO, b"<< /Title (%s) >>" % escape_pdf_text(title))
+        self.write_object(
+            self.CATALOG, b"<< /Type /Catalog /Pages %d 0 R >>" % self.PAGES
+        )
+
+        xref_position = self.position
+        self.write(b"xref\n0 %d\n0000000000 65535 f \n" % self.next_object)
+        for number in range(1, self.next_object):
+            self.write(b"%010d 00000 n \n" % self.offsets[number])
+        self.write(
+            b"trailer\n<< /Size %d /Root %d 0 R /Info %d 0 R >>\nstartxref\n%d\n%%%%EOF\n"
+            % (self.next_object, self.CATALOG, self.INFO, xref_position)
+        )
+
+
+def write_pdf(story: Story, output: BinaryIO):
+    width, height = get_page_size(story)
+    writer = PdfWriter(output)
+    for page in get_export_pages(story):
+        image = get_export_image(page.image_path, *get_image_box(page, width, height))
+        writer.add_page(page, image, width, height)
+    writer.close(story.title)
+
+
+EPUB_CONTAINER = """<?xml version="1.0" encoding="UTF-8"?>
+<container version="1.0" xmlns="urn:oasis:names:tc:opendocument:xmlns:container">
+  <rootfiles>
+    <rootfile full-path="OEBPS/content.opf" media-type="application/oebps-package+xml"/>
+  </rootfiles>
+</container>
+"""
+
+EPUB_STYLE = """
+body { margin: 0; font-family: sans-serif; }
+.image { height: {{IMAGE_HEIGHT}}px; display: flex; align-items: center; justify-content: center; }
+.image img { max-width: 100%; max-height: 100%; }
+p { margin: 0 6%; font-size: {{FONT_SIZE}}px; line-height: 1.3; }
+"""
+
+
+def get_epub_page(title: str, width: int, height: int, body: str) -> str:
+    return f"""<?xml version="1.0" encoding="UTF-8"?>
+<!DOCTYPE html>
+<html xmlns="http://www.w3.org/1999/xhtml" xmlns:epub="http://www.idpf.org/2007/ops">
+<head>
+  <meta charset="UTF-8"/>
+  <meta name="viewport" content="width={width}, height={height}"/>
+  <title>{html.escape(title)}</title>
+  <link rel="stylesheet" type="text/css" href="style.css"/>
+</head>
+<body>
+{body}
+</body>
+</html>
+"""
+
+
+def write_epub(story: Story, output: BinaryIO):
+    width, height = get_page_size(story)
+    title = html.escape(story.title)
+    manifest = [
+        '<item id="nav" href="nav.xhtml" media-type="application/xhtml+xml" properties="nav"/>'
+    ]
+    manifest.append('<item id="style" href="style.css" media-type="text/css"/>')
+    spine = []
+    with zipfile.ZipFile(output, "w", zipfile.ZIP_DEFLATED) as epub:
+        # The mimetype entry must come first and be stored uncompressed
+        epub.writestr("mimetype", "application/epub+zip", zipfile.ZIP_STORED)
+        epub.writestr("META-INF/container.xml", EPUB_CONTAINER)
+        epub.writestr(
+            "OEBPS/style.css",
+            EPUB_STYLE.replace(
+                "{{IMAGE_HEIGHT}}", str(int(height * (1 - EXPORT_TEXT_BAND)))
+            ).replace("{{FONT_SIZE}}", str(min(width, height) // 24)),
+        )
+        for index, page in enumerate(get_export_pages(story)):
+            name = "cover" if page.is_cover else f"page_{index}"
+            image = get_export_image(
+                page.image_path, *get_image_box(page, width, height)
+            )
+            body = ""
+            if image:
+                image_path, _, _ = image
+                # JPEGs are already compressed, store them as they are
+                with (
+                    open(image_path, "rb") as source,
+                    epub.open(
+                        zipfile.ZipInfo(f"OEBPS/images/{name}.jpeg"), "w"
+                    ) as target,
+                ):
+                    shutil.copyfileobj(source, target)
+                properties = ' properties="cover-image"' if page.is_cover else ""
+                manifest.append(
+                    f'<item id="{name}-image" href="images/{name}.jpeg" media-type="image/jpeg"{properties}/>'
+                )
+                if page.is_cover:
+                    body += f'<img src="images/{name}.jpeg" alt="{title}" style="width: 100%; height: 100%; object-fit: contain;"/>\n'
+                else:
+                    body += f'<div class="image"><img src="images/{name}.jpeg" alt=""/></div>\n'
+            if page.text:
+                body += f"<p>{html.escape(page.text)}</p>\n"
+            epub.writestr(
+                f"OEBPS/{name}.xhtml",
+                get_epub_page(story.title, width, height, body),
+            )
+            manifest.append(
+                f'<item id="{name}" href="{name}.xhtml" media-type="application/xhtml+xml"/>'
+            )
+            spine.append(f'<itemref idref="{name}"/>')
+
+        epub.writestr(
+            "OEBPS/nav.xhtml",
+            get_epub_page(
+                story.title,
+                width,
+                height,
+                f'<nav epub:type="toc"><ol><li><a href="cover.xhtml">{title}</a></li></ol></nav>',
+            ),
+        )
+        modified = datetime.now(timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ")
+        newline = "\n    "
+        epub.writestr(
+            "OEBPS/content.opf",
+            f"""<?xml version="1.0" encoding="UTF-8"?>
+<package xmlns="http://www.idpf.org/2007/opf" version="3.0" unique-identifier="id">
+  <metadata xmlns:dc="http://purl.org/dc/elements/1.1/">
+    <dc:identifier id="id">urn:story:{html.escape(to_kebab_case(story.title))}</dc:identifier>
+    <dc:title>{title}</dc:title>
+    <dc:language>en</dc:language>
+    <meta property="dcterms:modified">{modified}</meta>
+    <meta property="rendition:layout">pre-paginated</meta>
+    <meta property="rendition:spread">none</meta>
+  </metadata>
+  <manifest>
+    {newline.join(manifest)}
+  </manifest>
+  <spine>
+    {newline.join(spine)}
+  </spine>
+</package>
+""",
+        )
+
+
+EXPORT_WRITERS = {
+    ExportFormat.PDF: write_pdf,
+    ExportFormat.EPUB: write_epub,
+}
+
+
+def get_export_name(story: Story) -> str:
+    return to_kebab_case(story.title)
+
+
+def get_export_path(story: Story, export_format: ExportFormat, revision: str) -> str:
+    return os.path.join(
+        EXPORTS_DIR, f"{get_export_name(story)}-{revision[:16]}.{export_format.value}"
+    )
+
+
+def remove_stale_exports(story: Story, export_format: ExportFormat, export_path: str):
+    for file_name in os.listdir(EXPORTS_DIR):
+        name, _, extension = file_name.rpartition(".")
+        if (
+            extension == export_format.value
+            and name.rpartition("-")[0] == get_export_name(story)
+            and os.path.join(EXPORTS_DIR, file_name) != export_path
+        ):
+            os.remove(os.path.join(EXPORTS_DIR, file_name))
+
+
+def export_story(story: Story, export_format: ExportFormat) -> str:
+    export_path = get_export_path(story, export_format, story.get_revision())
+
+    def write_export() -> str:
+        if os.path.exists(export_path):
+            return export_path
+        os.makedirs(EXPORTS_DIR, exist_ok=True)
+        temp_path = f"{export_path}.{os.getpid()}.tmp"
+        with open(temp_path, "wb") as f:
+            EXPORT_WRITERS[export_format](story, f)
+        os.replace(temp_path, export_path)
+        remove_stale_exports(story, export_format, export_path)
+        logger.info("export.written", path=export_path, pages=len(story.pages))
+        return export_path
+
+    if os.path.exists(export_path):
+        return export_path
+    return single_flight(("export", export_path), write_export)
+
+
+def read_export(story: Story, export_format: ExportFormat) -> bytes:
+    with open(export_story(story, export_format), "rb") as f:
+        return f.read()
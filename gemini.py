@@ -1,18 +1,55 @@
+import hashlib
+import json
+import mimetypes
 import os
-from io import BytesIO
-from typing import Optional
+import threading
+from typing import List, Optional
 
 from dotenv import load_dotenv
 from google import genai
 from google.genai import types
-from PIL import Image
-from PIL.ImageFile import ImageFile
 from pydantic import BaseModel
 
-from constants import GEMINI_IMAGE_GENERATION_MODEL, GEMINI_TEXT_GENERATION_MODEL_FAST
+from cache import get_cached_text, get_text_cache_key, set_cached_text
+from cancellation import CancellationToken
+from constants import (
+    CHAT_SESSION_HISTORY_TURNS,
+    GEMINI_IMAGE_GENERATION_MODEL,
+    GEMINI_TEXT_GENERATION_MODEL_FAST,
+)
+from images import GeneratedImage, get_file_hash
+from log import Prompt, get_logger
+from scheduler import SCHEDULER, get_scheduling
 
 load_dotenv()
 CLIENT = genai.Client(api_key=os.getenv("GEMINI_API_KEY"))
+logger = get_logger(__name__)
+
+
+def generate_content(
+    token: Optional[CancellationToken] = None, **kwargs
+) -> types.GenerateContentResponse:
+    # The request can not be interrupted once sent. The deadline bounds it via
+    # the HTTP timeout and a response that arrives after all is returned, it is
+    # paid for. Callers decide whether it still applies.
+    user_id, priority = get_scheduling()
+    with SCHEDULER.slot(user_id, priority, token=token):
+        if token:
+            token.raise_if_cancelled()
+            remaining = token.remaining()
+            if remaining is not None:
+                kwargs["config"] = {
+                    **(kwargs.get("config") or {}),
+                    "http_options": types.HttpOptions(
+                        timeout=max(1000, int(remaining * 1000))
+                    ),
+                }
+        try:
+            return CLIENT.models.generate_content(**kwargs)
+        except Exception:
+            if token:
+                token.raise_if_cancelled()
+            raise
 
 
 def generate_text(
@@ -20,39 +57,186 @@ def generate_text(
     user_prompt: str,
     model_name: str = GEMINI_TEXT_GENERATION_MODEL_FAST,
     target_model: BaseModel = None,
+    use_cache: bool = True,
+    token: Optional[CancellationToken] = None,
 ) -> Optional[BaseModel]:
     config = {"response_mime_type": "application/json", "response_schema": target_model}
 
+    cache_key = None
+    if use_cache and target_model:
+        cache_key = get_text_cache_key(
+            model_name=model_name,
+            system_prompt=system_prompt,
+            user_prompt=user_prompt,
+            schema=target_model.model_json_schema(),
+        )
+        cached_text = get_cached_text(cache_key)
+        if cached_text:
+            logger.info("generate_text.cached", model=model_name)
+            return target_model.model_validate_json(cached_text)
+
     contents = [
         types.Content(role="model", parts=[types.Part.from_text(text=system_prompt)]),
         types.Content(role="user", parts=[types.Part.from_text(text=user_prompt)]),
     ]
-    print(f"(generate_text)Generating story with model: {model_name}")
-    print(f"(generate_text)System Prompt: {system_prompt}")
-    print(f"(generate_text)User Prompt: {user_prompt}")
-    response = CLIENT.models.generate_content(
-        model=model_name, contents=contents, config=config
+    logger.info("generate_text.started", model=model_name)
+    logger.debug(
+        "generate_text.prompt",
+        system_prompt=Prompt(system_prompt),
+        user_prompt=Prompt(user_prompt),
+    )
+    response = generate_content(
+        token=token, model=model_name, contents=contents, config=config
     )
-    print(f"(generate_text)Completed story generation.")
+    logger.info("generate_text.completed", model=model_name)
+    if cache_key and response.parsed:
+        set_cached_text(cache_key, response.parsed.model_dump_json())
     return response.parsed
 
 
 def generate_image(
     prompt: str,
     model_name: str = GEMINI_IMAGE_GENERATION_MODEL,
-    reference_image: Optional[ImageFile] = None,
-) -> Optional[ImageFile]:
-    print(f"(generate_image)Generating image with model: {model_name}")
-    print(f"(generate_image)Prompt: {prompt}")
-    print(f"(generate_image)Reference Image: {bool(reference_image)}")
-
-    response = CLIENT.models.generate_content(
+    reference_image_path: Optional[str] = None,
+    token: Optional[CancellationToken] = None,
+) -> Optional[GeneratedImage]:
+    logger.info(
+        "generate_image.started",
         model=model_name,
-        contents=[prompt, reference_image] if reference_image else [prompt],
+        reference_image=bool(reference_image_path),
     )
+    logger.debug("generate_image.prompt", prompt=Prompt(prompt))
+
+    # The file bytes are sent as they are, the image is never decoded here
+    contents = [prompt]
+    if reference_image_path:
+        contents.append(get_image_part(reference_image_path))
+    response = generate_content(token=token, model=model_name, contents=contents)
+
+    return get_generated_image(response)
+
 
+def get_generated_image(
+    response: types.GenerateContentResponse,
+) -> Optional[GeneratedImage]:
     for part in response.candidates[0].content.parts:
         if part.text is not None:
-            print(part.text)
+            logger.debug("generate_image.text", text=Prompt(part.text))
         elif part.inline_data is not None:
-            return Image.open(BytesIO(part.inline_data.data))
+            return GeneratedImage(
+                data=part.inline_data.data, mime_type=part.inline_data.mime_type
+            )
+    return None
+
+
+def get_image_part(image_path: str) -> types.Part:
+    mime_type = mimetypes.guess_type(image_path)[0] or "image/jpeg"
+    with open(image_path, "rb") as f:
+        return types.Part.from_bytes(data=f.read(), mime_type=mime_type)
+
+
+# Multi-turn image generation. The seed (character sheet and style) is sent
+# as the opening turn of every request so the model keeps the same context for
+# all pages. Past turns are kept as text only, resending their images would
+# multiply the input per page. Only successful turns are recorded, so a failed
+# turn can simply be retried. With a `session_path` the history outlives the job
+# and is reset when the seed changes.
+class ImageChatSession:
+    def __init__(
+        self,
+        seed_prompt: str,
+        seed_image_paths: List[str],
+        model_name: str = GEMINI_IMAGE_GENERATION_MODEL,
+        history_turns: int = CHAT_SESSION_HISTORY_TURNS,
+        session_path: Optional[str] = None,
+    ):
+        self.model_name = model_name
+        self.history_turns = history_turns
+        self.session_path = session_path
+        self.seed_key = hashlib.sha256(
+            json.dumps(
+                [seed_prompt, *[get_file_hash(path) for path in seed_image_paths]]
+            ).encode("utf-8")
+        ).hexdigest()
+        self.lock = threading.Lock()
+        self.seed: List[types.Content] = [
+            types.Content(
+                role="user",
+                parts=[
+                    types.Part.from_text(text=seed_prompt),
+                    *[get_image_part(image_path) for image_path in seed_image_paths],
+                ],
+            ),
+            types.Content(
+                role="model",
+                parts=[
+                    types.Part.from_text(
+                        text="Understood. I will keep the characters and style consistent for every page."
+                    )
+                ],
+            ),
+        ]
+        self.turns: List[types.Content] = self.load_turns()
+
+    def load_turns(self) -> List[types.Content]:
+        if not self.session_path or not os.path.exists(self.session_path):
+            return []
+        with open(self.session_path, "r") as f:
+            data = json.load(f)
+        if data["seed_key"] != self.seed_key:
+            return []
+        return [types.Content.model_validate(turn) for turn in data["turns"]]
+
+    def save_turns(self):
+        if not self.session_path:
+            return
+        os.makedirs(os.path.dirname(self.session_path), exist_ok=True)
+        temp_path = f"{self.session_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(temp_path, "w") as f:
+            json.dump(
+                {
+                    "seed_key": self.seed_key,
+                    "turns": [
+                        turn.model_dump(mode="json", exclude_none=True)
+                        for turn in self.turns
+                    ],
+                },
+                f,
+            )
+        os.replace(temp_path, self.session_path)
+
+    def get_history(self) -> List[types.Content]:
+        # Keep the seed plus the last few (user, model) turn pairs
+        recent_turns = (
+            self.turns[-2 * self.history_turns :] if self.history_turns else []
+        )
+        return self.seed + recent_turns
+
+    def generate_image(
+        self, prompt: str, token: Optional[CancellationToken] = None
+    ) -> Optional[GeneratedImage]:
+        logger.info("chat_session.turn", turn=len(self.turns) // 2 + 1)
+        logger.debug("chat_session.prompt", prompt=Prompt(prompt))
+        user_turn = types.Content(
+            role="user", parts=[types.Part.from_text(text=prompt)]
+        )
+        response = generate_content(
+            token=token,
+            model=self.model_name,
+            contents=[*self.get_history(), user_turn],
+        )
+        generated_image = get_generated_image(response)
+        if generated_image:
+            model_parts = [
+                types.Part.from_text(text=part.text)
+                for part in response.candidates[0].content.parts
+                if part.text
+            ]
+            model_turn = types.Content(
+                role="model",
+                parts=model_parts or [types.Part.from_text(text="Page illustrated.")],
+            )
+            with self.lock:
+                self.turns += [user_turn, model_turn]
+                self.save_turns()
+        return generated_image
@@ -0,0 +1,277 @@
+import base64
+import functools
+import hashlib
+import mimetypes
+import multiprocessing
+import os
+import threading
+from concurrent.futures import Future, ProcessPoolExecutor
+from contextlib import contextmanager
+from io import BytesIO
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple, Union
+
+from PIL import Image, ImageOps
+
+from constants import (
+    IMAGE_EXECUTOR_MAX_QUEUED,
+    IMAGE_EXECUTOR_MAX_WORKERS,
+    IMAGE_MAX_OPEN_HANDLES,
+    IMAGE_OUTPUT_FORMAT,
+    IMAGE_PLACEHOLDER_SIZE,
+    IMAGE_TRANSCODE_PROGRESSIVE,
+    IMAGE_TRANSCODE_QUALITY,
+)
+
+FORMAT_TO_MIME_TYPE = {
+    "JPEG": "image/jpeg",
+    "PNG": "image/png",
+    "WEBP": "image/webp",
+}
+MIME_TYPE_TO_EXTENSION = {
+    "image/jpeg": ".jpeg",
+    "image/png": ".png",
+    "image/webp": ".webp",
+}
+
+# Image transforms are CPU heavy and hold the GIL, so they run in a process pool
+# shared by every session instead of on the Streamlit script threads.
+_IMAGE_EXECUTOR: Optional[ProcessPoolExecutor] = None
+_IMAGE_EXECUTOR_LOCK = threading.Lock()
+_IMAGE_EXECUTOR_SLOTS = threading.BoundedSemaphore(
+    IMAGE_EXECUTOR_MAX_WORKERS + IMAGE_EXECUTOR_MAX_QUEUED
+)
+
+
+# Every image opened by the app goes through open_image, which closes it on
+# exit and bounds how many images a process holds open, and so decodes, at once.
+_IMAGE_HANDLE_SLOTS = threading.BoundedSemaphore(IMAGE_MAX_OPEN_HANDLES)
+_IMAGE_HANDLE_STATS = {"open": 0, "peak": 0, "opened": 0}
+_IMAGE_HANDLE_STATS_LOCK = threading.Lock()
+
+
+@contextmanager
+def open_image(source: Union[str, bytes]) -> Iterator[Image.Image]:
+    with _IMAGE_HANDLE_SLOTS:
+        with _IMAGE_HANDLE_STATS_LOCK:
+            _IMAGE_HANDLE_STATS["open"] += 1
+            _IMAGE_HANDLE_STATS["opened"] += 1
+            _IMAGE_HANDLE_STATS["peak"] = max(
+                _IMAGE_HANDLE_STATS["peak"], _IMAGE_HANDLE_STATS["open"]
+            )
+        try:
+            with Image.open(
+                BytesIO(source) if isinstance(source, bytes) else source
+            ) as image:
+                yield image
+        finally:
+            with _IMAGE_HANDLE_STATS_LOCK:
+                _IMAGE_HANDLE_STATS["open"] -= 1
+
+
+def get_image_handle_stats() -> Dict[str, int]:
+    with _IMAGE_HANDLE_STATS_LOCK:
+        return dict(_IMAGE_HANDLE_STATS)
+
+
+def get_image_executor() -> ProcessPoolExecutor:
+    global _IMAGE_EXECUTOR
+    with _IMAGE_EXECUTOR_LOCK:
+        if _IMAGE_EXECUTOR is None:
+            # "spawn" avoids forking the multi-threaded Streamlit server.
+            _IMAGE_EXECUTOR = ProcessPoolExecutor(
+                max_workers=IMAGE_EXECUTOR_MAX_WORKERS,
+                mp_context=multiprocessing.get_context("spawn"),
+            )
+        return _IMAGE_EXECUTOR
+
+
+def submit_image_task(fn: Callable, *args: Any) -> Future:
+    # Blocks the caller once the pool is saturated, so the queue stays bounded.
+    _IMAGE_EXECUTOR_SLOTS.acquire()
+    try:
+        future = get_image_executor().submit(fn, *args)
+    except Exception:
+        _IMAGE_EXECUTOR_SLOTS.release()
+        raise
+    future.add_done_callback(lambda _: _IMAGE_EXECUTOR_SLOTS.release())
+    return future
+
+
+def run_image_task(fn: Callable, *args: Any) -> Any:
+    return submit_image_task(fn, *args).result()
+
+
+def read_image_sizes(image_paths: List[str]) -> List[Tuple[int, int]]:
+    sizes = []
+    for image_path in image_paths:
+        with open_image(image_path) as image:
+            sizes.append(image.size)
+    return sizes
+
+
+def hash_file(file_path: str) -> str:
+    digest = hashlib.sha256()
+    with open(file_path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+@functools.lru_cache(maxsize=1024)
+def _get_file_hash(file_path: str, mtime_ns: int, size: int) -> str:
+    return run_image_task(hash_file, file_path)
+
+
+def get_file_hash(file_path: str) -> str:
+    stat = os.stat(file_path)
+    return _get_file_hash(file_path, stat.st_mtime_ns, stat.st_size)
+
+
+def encode_file_b64(file_path: str) -> str:
+    with open(file_path, "rb") as f:
+        return base64.b64encode(f.read()).decode("utf-8")
+
+
+def normalize_image_bytes(data: bytes, max_size: int, quality: int) -> bytes:
+    with open_image(data) as image:
+        image.draft("RGB", (max_size, max_size))  # Cheap JPEG downscale on decode
+        # Phone cameras store the rotation in EXIF instead of the pixels
+        image = ImageOps.exif_transpose(image).convert("RGB")
+        image.thumbnail((max_size, max_size))
+        output = BytesIO()
+        image.save(output, format="JPEG", quality=quality)
+        return output.getvalue()
+
+
+def resize_image_bytes(data: bytes, max_size: int, image_format: str) -> bytes:
+    with open_image(data) as image:
+        image.thumbnail((max_size, max_size))
+        if image_format == "JPEG" and image.mode not in ("RGB", "L"):
+            image = image.convert("RGB")
+        output = BytesIO()
+        image.save(output, format=image_format)
+        return output.getvalue()
+
+
+def make_image_placeholder(image_path: str, max_size: int) -> str:
+    with open_image(image_path) as image:
+        image.draft("RGB", (max_size, max_size))  # Cheap JPEG downscale on decode
+        image = image.convert("RGB")
+        image.thumbnail((max_size, max_size))
+        output = BytesIO()
+        image.save(output, format="JPEG", quality=60)
+    encoded = base64.b64encode(output.getvalue()).decode("utf-8")
+    return f"data:image/jpeg;base64,{encoded}"
+
+
+def make_export_image(
+    image_path: str, output_path: str, max_width: int, max_height: int, quality: int
+) -> Tuple[str, int, int]:
+    # Baseline RGB JPEGs that already fit are embedded as they are
+    with open_image(image_path) as image:
+        if (
+            image.format == "JPEG"
+            and image.mode == "RGB"
+            and not image.info.get("progressive")
+            and image.width <= max_width
+            and image.height <= max_height
+        ):
+            return image_path, image.width, image.height
+        image.draft("RGB", (max_width, max_height))
+        image = image.convert("RGB")
+        image.thumbnail((max_width, max_height))
+        temp_path = f"{output_path}.{os.getpid()}.tmp"
+        image.save(temp_path, format="JPEG", quality=quality)
+        os.replace(temp_path, output_path)
+        return output_path, image.width, image.height
+
+
+def transcode_image_bytes(
+    data: bytes, image_format: str, quality: int, progressive: bool
+) -> bytes:
+    with open_image(data) as image:
+        if image_format == "JPEG" and image.mode not in ("RGB", "L"):
+            image = image.convert("RGB")
+        output = BytesIO()
+        image.save(
+            output, format=image_format, quality=quality, progressive=progressive
+        )
+        return output.getvalue()
+
+
+# Raw image bytes as returned by the model. Decoding only happens on demand.
+class GeneratedImage:
+    def __init__(self, data: bytes, mime_type: str):
+        self.data = data
+        self.mime_type = mime_type
+        self._size: Optional[Tuple[int, int]] = None
+
+    @property
+    def extension(self) -> str:
+        return MIME_TYPE_TO_EXTENSION.get(self.mime_type) or (
+            mimetypes.guess_extension(self.mime_type) or ".bin"
+        )
+
+    @property
+    def size(self) -> Tuple[int, int]:
+        if self._size is None:
+            # Opening only parses the header, the pixel data is not decoded.
+            with open_image(self.data) as image:
+                self._size = image.size
+        return self._size
+
+    @property
+    def width(self) -> int:
+        return self.size[0]
+
+    @property
+    def height(self) -> int:
+        return self.size[1]
+
+    def matches(self, path: str) -> bool:
+        mime_type, _ = mimetypes.guess_type(path)
+        return mime_type == self.mime_type
+
+    def save(self, path: str) -> str:
+        if not self.matches(path):
+            raise ValueError(
+                f"Image is {self.mime_type}, refusing to implicitly transcode to {path}. Use transcode() first."
+            )
+        # The path may be a hardlink into the blob store, replace it instead of
+        # writing through it.
+        temp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(temp_path, "wb") as f:
+            f.write(self.data)
+        os.replace(temp_path, path)
+        return path
+
+    def transcode(
+        self,
+        image_format: str,
+        quality: int = IMAGE_TRANSCODE_QUALITY,
+        progressive: bool = IMAGE_TRANSCODE_PROGRESSIVE,
+    ) -> "GeneratedImage":
+        mime_type = FORMAT_TO_MIME_TYPE[image_format]
+        if mime_type == self.mime_type:
+            return self
+        data = run_image_task(
+            transcode_image_bytes, self.data, image_format, quality, progressive
+        )
+        return GeneratedImage(data=data, mime_type=mime_type)
+
+
+def get_image_placeholder(image_path: str) -> str:
+    return run_image_task(make_image_placeholder, image_path, IMAGE_PLACEHOLDER_SIZE)
+
+
+def save_generated_image(image: GeneratedImage, path_stem: str) -> str:
+    if IMAGE_OUTPUT_FORMAT:
+        image = image.transcode(IMAGE_OUTPUT_FORMAT)
+    path = f"{path_stem}{image.extension}"
+    image.save(path)
+    # A regeneration may have changed the format, drop the stale sibling files.
+    for extension in MIME_TYPE_TO_EXTENSION.values():
+        stale_path = f"{path_stem}{extension}"
+        if stale_path != path and os.path.exists(stale_path):
+            os.remove(stale_path)
+    return path
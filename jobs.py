@@ -0,0 +1,475 @@
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from enum import Enum
+from typing import Any, Callable, Dict, List, Optional, Set, Tuple
+
+from pydantic import BaseModel
+
+from cancellation import CancellationToken, GenerationCancelled
+from constants import (
+    BOOK_DEADLINE_SECONDS,
+    CHARACTER_SHEET_REUSE,
+    INTERACTIVE_JOB_MAX_WORKERS,
+    JOB_HISTORY_MAX,
+    JOB_MAX_WORKERS,
+    JOB_ORPHANED_SECONDS,
+    JOB_POLL_SECONDS,
+    LEASES_DB_PATH,
+    SPECULATION_BUDGET_PER_USER,
+    SPECULATION_TTL_SECONDS,
+    SPECULATIVE_PREFETCH_PAGES,
+    STORY_DEADLINE_SECONDS,
+    Asset,
+    Audience,
+    PageCount,
+    Priority,
+    Style,
+)
+from leases import OWNER_ID
+from log import get_logger
+from models import Story
+from scheduler import set_scheduling
+from uploads import get_upload_path
+
+logger = get_logger(__name__)
+
+
+class JobStatus(str, Enum):
+    QUEUED = "queued"
+    RUNNING = "running"
+    DONE = "done"
+    FAILED = "failed"
+    CANCELLED = "cancelled"
+
+
+class Job(BaseModel):
+    id: str
+    kind: str
+    status: JobStatus = JobStatus.QUEUED
+    progress: List[str] = []
+    result: Optional[Any] = None
+    error: Optional[str] = None
+
+    def is_finished(self) -> bool:
+        return self.status in (JobStatus.DONE, JobStatus.FAILED, JobStatus.CANCELLED)
+
+
+class CreateStoryRequest(BaseModel):
+    protagonist_details: str
+    premise: str
+    audience: Audience
+    style: Style
+    page_count: PageCount
+    protagonist_image_hash: Optional[str] = None  # See uploads.ingest_image
+    user_id: Optional[str] = None
+
+
+class RenderAssetsRequest(BaseModel):
+    story_path: str
+    assets: Optional[List[str]] = None  # None renders every stale asset
+    force: bool = False
+    session_id: Optional[str] = None  # Newer requests of a session supersede older
+    priority: Priority = Priority.BATCH
+
+
+JOB_EXECUTOR = ThreadPoolExecutor(max_workers=JOB_MAX_WORKERS, thread_name_prefix="job")
+INTERACTIVE_JOB_EXECUTOR = ThreadPoolExecutor(
+    max_workers=INTERACTIVE_JOB_MAX_WORKERS, thread_name_prefix="interactive-job"
+)
+# Jobs running in this process. Every replica reads the others' from the store.
+_JOBS: Dict[str, Job] = {}
+_JOB_TOKENS: Dict[str, CancellationToken] = {}
+_JOBS_LOCK = threading.Lock()
+_JOB_HEARTBEAT: Optional[threading.Thread] = None
+
+# Pages rendered ahead of the user, keyed by (session_id, story_path). Rendered
+# pages are kept with the time they were done, until claimed or expired.
+_SPECULATION_JOBS: Dict[Tuple[str, str], str] = {}
+_SPECULATING: Dict[Tuple[str, str], Set[str]] = {}
+_SPECULATED: Dict[Tuple[str, str], Dict[str, float]] = {}
+_SPECULATION_LOCK = threading.Lock()
+
+
+def get_connection() -> sqlite3.Connection:
+    os.makedirs(os.path.dirname(LEASES_DB_PATH), exist_ok=True)
+    connection = sqlite3.connect(LEASES_DB_PATH, timeout=30, isolation_level=None)
+    connection.execute(
+        """
+        CREATE TABLE IF NOT EXISTS jobs (
+            id TEXT PRIMARY KEY,
+            owner TEXT NOT NULL,
+            finished INTEGER NOT NULL,
+            cancel_requested INTEGER NOT NULL DEFAULT 0,
+            updated_at REAL NOT NULL,
+            data TEXT NOT NULL
+        )
+        """
+    )
+    return connection
+
+
+def save_job(job: Job) -> bool:
+    # Returns whether another replica asked to cancel the job
+    connection = get_connection()
+    try:
+        row = connection.execute(
+            """
+            INSERT INTO jobs (id, owner, finished, updated_at, data)
+            VALUES (?, ?, ?, ?, ?)
+            ON CONFLICT (id) DO UPDATE SET
+                finished = excluded.finished,
+                updated_at = excluded.updated_at,
+                data = excluded.data
+            RETURNING cancel_requested
+            """,
+            (job.id, OWNER_ID, job.is_finished(), time.time(), job.model_dump_json()),
+        ).fetchone()
+        return bool(row[0])
+    finally:
+        connection.close()
+
+
+def forget_old_jobs():
+    connection = get_connection()
+    try:
+        connection.execute(
+            """
+            DELETE FROM jobs WHERE id IN (
+                SELECT id FROM jobs WHERE finished OR updated_at < ?
+                ORDER BY updated_at DESC LIMIT -1 OFFSET ?
+            )
+            """,
+            (time.time() - JOB_ORPHANED_SECONDS, JOB_HISTORY_MAX),
+        )
+    finally:
+        connection.close()
+
+
+def get_job(job_id: str) -> Optional[Job]:
+    with _JOBS_LOCK:
+        job = _JOBS.get(job_id)
+        if job:
+            return job.model_copy(deep=True)
+    # Run by another replica, or by this one before it finished or restarted
+    connection = get_connection()
+    try:
+        row = connection.execute(
+            "SELECT finished, updated_at, data FROM jobs WHERE id = ?", (job_id,)
+        ).fetchone()
+    finally:
+        connection.close()
+    if row is None:
+        return None
+    finished, updated_at, data = row
+    job = Job.model_validate_json(data)
+    if not finished and updated_at < time.time() - JOB_ORPHANED_SECONDS:
+        job.status = JobStatus.FAILED
+        job.error = "The worker running this job stopped."
+    return job
+
+
+def cancel_job(job_id: str) -> Optional[Job]:
+    with _JOBS_LOCK:
+        token = _JOB_TOKENS.get(job_id)
+    if token:
+        logger.info("job.cancelling", job_id=job_id)
+        token.cancel()
+    else:
+        # The replica running it picks this up when it next saves the job
+        connection = get_connection()
+        try:
+            connection.execute(
+                "UPDATE jobs SET cancel_requested = 1 WHERE id = ? AND NOT finished",
+                (job_id,),
+            )
+        finally:
+            connection.close()
+    return get_job(job_id)
+
+
+def run_job_heartbeat():
+    while True:
+        time.sleep(JOB_POLL_SECONDS)
+        with _JOBS_LOCK:
+            jobs = list(_JOBS.values())
+        for job in jobs:
+            try:
+                cancel_requested = save_job(job)
+            except sqlite3.Error:
+                logger.exception("job.save_failed", job_id=job.id)
+                continue
+            with _JOBS_LOCK:
+                token = _JOB_TOKENS.get(job.id)
+            if cancel_requested and token and not token.is_cancelled():
+                logger.info("job.cancelling", job_id=job.id)
+                token.cancel()
+
+
+def start_job_heartbeat():
+    global _JOB_HEARTBEAT
+    with _JOBS_LOCK:
+        if _JOB_HEARTBEAT is not None:
+            return
+        _JOB_HEARTBEAT = threading.Thread(
+            target=run_job_heartbeat, name="job-heartbeat", daemon=True
+        )
+        _JOB_HEARTBEAT.start()
+
+
+def submit_job(
+    kind: str,
+    fn: Callable[[Job, CancellationToken], Any],
+    timeout: float,
+    priority: Priority = Priority.BATCH,
+) -> Job:
+    job = Job(id=uuid.uuid4().hex, kind=kind)
+    token = CancellationToken(timeout=timeout)
+    save_job(job)
+    forget_old_jobs()
+    with _JOBS_LOCK:
+        _JOBS[job.id] = job
+        _JOB_TOKENS[job.id] = token
+    start_job_heartbeat()
+
+    def run():
+        job.status = JobStatus.RUNNING
+        try:
+            token.raise_if_cancelled()
+            job.result = fn(job, token)
+            job.status = JobStatus.DONE
+        except GenerationCancelled as e:
+            logger.info("job.stopped", job_id=job.id, kind=kind, reason=e)
+            job.error = str(e)
+            job.status = JobStatus.CANCELLED
+        except Exception as e:
+            logger.exception("job.failed", job_id=job.id, kind=kind)
+            job.error = str(e)
+            job.status = JobStatus.FAILED
+        finally:
+            save_job(job)
+            with _JOBS_LOCK:
+                _JOBS.pop(job.id, None)
+                _JOB_TOKENS.pop(job.id, None)
+
+    if priority == Priority.INTERACTIVE:
+        INTERACTIVE_JOB_EXECUTOR.submit(run)
+    else:
+        JOB_EXECUTOR.submit(run)
+    return job.model_copy(deep=True)
+
+
+def run_create_story(
+    job: Job, token: CancellationToken, request: CreateStoryRequest
+) -> str:
+    set_scheduling(request.user_id, Priority.INTERACTIVE)
+    story = Story.generate_story(
+        protagonist_details=request.protagonist_details,
+        premise=request.premise,
+        audience=request.audience,
+        style=request.style,
+        page_count=request.page_count,
+        protagonist_image_path=(
+            get_upload_path(request.protagonist_image_hash)
+            if request.protagonist_image_hash
+            else None
+        ),
+        user_id=request.user_id,
+        token=token,
+    )
+    job.progress.append(f"Story '{story.title}' generated.")
+    if CHARACTER_SHEET_REUSE != "off":
+        entry = story.link_character_library(reuse=CHARACTER_SHEET_REUSE == "auto")
+        if entry:
+            if story.character_sheet.image_path:
+                outcome = "reused."
+            elif CHARACTER_SHEET_REUSE == "auto":
+                outcome = (
+                    "will be extended with the other characters of this story "
+                    "when the sheet is generated."
+                )
+            else:
+                outcome = "available."
+            job.progress.append(f"Character sheet of '{entry.story_title}' {outcome}")
+    return story.get_story_file_path()
+
+
+def run_render_assets(
+    job: Job, token: CancellationToken, request: RenderAssetsRequest
+) -> Dict[str, Optional[str]]:
+    set_scheduling(request.session_id, request.priority)
+    story = Story.load(request.story_path)
+    assets = request.assets
+    if assets is None:
+        assets = story.get_assets() if request.force else story.get_stale_assets()
+    if not assets:
+        job.progress.append("All assets are up to date.")
+    if Asset.CHARACTER_SHEET in assets:
+        # Pages rendered ahead would be drawn from the old sheet
+        cancel_speculation(request.session_id, request.story_path)
+    elif request.assets is None:
+        # Rendering everything missing covers the pages rendered ahead as well
+        release_speculated_assets(request.session_id, request.story_path)
+    image_paths = {}
+    for asset in claim_speculated_assets(request.session_id, story, assets):
+        image_paths[asset] = story.get_asset_record(asset).image_path
+        job.progress.append(f"{asset} generated.")
+    for asset, image_path in story.generate_assets(
+        [asset for asset in assets if asset not in image_paths],
+        token=token,
+        owner=request.session_id,
+    ):
+        image_paths[asset] = image_path
+        job.progress.append(
+            f"{asset} generated." if image_path else f"Failed to generate {asset}."
+        )
+    rendered_from_sheet = any(
+        image_path
+        for asset, image_path in image_paths.items()
+        if asset != Asset.CHARACTER_SHEET
+    )
+    if Asset.CHARACTER_SHEET not in assets or rendered_from_sheet:
+        # Moving on from the sheet, or drawing the book from it in the same job,
+        # accepts it for this story and later ones
+        story.remember_character_sheet()
+    if Asset.CHARACTER_SHEET not in assets:
+        start_speculation(request.session_id, story)
+    return image_paths
+
+
+def forget_expired_speculation():
+    expired_before = time.time() - SPECULATION_TTL_SECONDS
+    for key, speculated in list(_SPECULATED.items()):
+        for asset, speculated_at in list(speculated.items()):
+            if speculated_at < expired_before:
+                del speculated[asset]
+        if not speculated:
+            del _SPECULATED[key]
+
+
+def get_speculation_budget(session_id: str) -> int:
+    used = sum(
+        len(assets)
+        for speculations in (_SPECULATING, _SPECULATED)
+        for (other_session_id, _), assets in speculations.items()
+        if other_session_id == session_id
+    )
+    return max(0, SPECULATION_BUDGET_PER_USER - used)
+
+
+def start_speculation(session_id: Optional[str], story: Story) -> Optional[Job]:
+    if not session_id or not SPECULATIVE_PREFETCH_PAGES:
+        return None
+    if story.is_asset_stale(Asset.CHARACTER_SHEET):
+        return None
+    key = (session_id, story.get_story_file_path())
+    with _SPECULATION_LOCK:
+        if key in _SPECULATION_JOBS:
+            return None
+        forget_expired_speculation()
+        claimed = _SPECULATED.get(key, {})
+        assets = [
+            asset
+            for asset in story.get_missing_assets()
+            if asset.startswith(Asset.PAGE) and asset not in claimed
+        ]
+        budget = min(SPECULATIVE_PREFETCH_PAGES, get_speculation_budget(session_id))
+        assets = assets[:budget]
+        if not assets:
+            return None
+        _SPECULATING[key] = set(assets)
+        job = submit_job(
+            "speculate_assets",
+            lambda job, token: run_speculation(job, token, key, assets),
+            timeout=BOOK_DEADLINE_SECONDS,
+        )
+        _SPECULATION_JOBS[key] = job.id
+    return job
+
+
+def run_speculation(
+    job: Job, token: CancellationToken, key: Tuple[str, str], assets: List[str]
+) -> Dict[str, Optional[str]]:
+    session_id, story_path = key
+    set_scheduling(session_id, Priority.SPECULATIVE)
+    image_paths = {}
+    try:
+        story = Story.load(story_path)
+        # No owner, so a user asking for the same page joins this render
+        for asset, image_path in story.generate_assets(
+            assets, force=False, token=token
+        ):
+            image_paths[asset] = image_path
+            with _SPECULATION_LOCK:
+                speculating = _SPECULATING.get(key, set())
+                # Gone when a user request joined this render and claimed it
+                unclaimed = asset in speculating
+                speculating.discard(asset)
+                if image_path and unclaimed and _SPECULATION_JOBS.get(key) == job.id:
+                    _SPECULATED.setdefault(key, {})[asset] = time.time()
+            job.progress.append(
+                f"{asset} prefetched." if image_path else f"Failed to prefetch {asset}."
+            )
+    finally:
+        with _SPECULATION_LOCK:
+            if _SPECULATION_JOBS.get(key) == job.id:
+                del _SPECULATION_JOBS[key]
+                _SPECULATING.pop(key, None)
+    return image_paths
+
+
+def claim_speculated_assets(
+    session_id: Optional[str], story: Story, assets: List[str]
+) -> List[str]:
+    # The first request for a prefetched page gets it, later ones regenerate it
+    key = (session_id, story.get_story_file_path())
+    with _SPECULATION_LOCK:
+        speculating = _SPECULATING.get(key)
+        if speculating:
+            # Still rendering, the request joins the render and so claims it
+            speculating.difference_update(assets)
+        speculated = _SPECULATED.get(key)
+        if not speculated:
+            return []
+        claimed = [asset for asset in assets if asset in speculated]
+        for asset in claimed:
+            del speculated[asset]
+        if not speculated:
+            del _SPECULATED[key]
+    return [asset for asset in claimed if not story.is_asset_stale(asset)]
+
+
+def release_speculated_assets(session_id: Optional[str], story_path: str):
+    with _SPECULATION_LOCK:
+        _SPECULATED.pop((session_id, story_path), None)
+
+
+def cancel_speculation(session_id: Optional[str], story_path: str):
+    key = (session_id, story_path)
+    with _SPECULATION_LOCK:
+        job_id = _SPECULATION_JOBS.pop(key, None)
+        _SPECULATING.pop(key, None)
+        _SPECULATED.pop(key, None)
+    if job_id:
+        cancel_job(job_id)
+
+
+def submit_create_story(request: CreateStoryRequest) -> Job:
+    return submit_job(
+        "create_story",
+        lambda job, token: run_create_story(job, token, request),
+        timeout=STORY_DEADLINE_SECONDS,
+        priority=Priority.INTERACTIVE,
+    )
+
+
+def submit_render_assets(request: RenderAssetsRequest) -> Job:
+    return submit_job(
+        "render_assets",
+        lambda job, token: run_render_assets(job, token, request),
+        timeout=BOOK_DEADLINE_SECONDS,
+        priority=request.priority,
+    )
@@ -0,0 +1,122 @@
+import os
+import socket
+import sqlite3
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from typing import Iterator, Optional
+
+from cancellation import CancellationToken
+from constants import LEASE_POLL_SECONDS, LEASE_TTL_SECONDS, LEASES_DB_PATH
+from log import get_logger
+
+logger = get_logger(__name__)
+
+# Identifies this replica/process as a lease owner
+OWNER_ID = f"{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex[:8]}"
+
+
+def get_connection() -> sqlite3.Connection:
+    os.makedirs(os.path.dirname(LEASES_DB_PATH), exist_ok=True)
+    connection = sqlite3.connect(LEASES_DB_PATH, timeout=30, isolation_level=None)
+    connection.execute(
+        """
+        CREATE TABLE IF NOT EXISTS leases (
+            story_path TEXT NOT NULL,
+            asset TEXT NOT NULL,
+            owner TEXT NOT NULL,
+            expires_at REAL NOT NULL,
+            PRIMARY KEY (story_path, asset)
+        )
+        """
+    )
+    return connection
+
+
+def claim_lease(story_path: str, asset: str, owner: str = OWNER_ID) -> bool:
+    now = time.time()
+    connection = get_connection()
+    try:
+        connection.execute("BEGIN IMMEDIATE")
+        row = connection.execute(
+            "SELECT owner, expires_at FROM leases WHERE story_path = ? AND asset = ?",
+            (story_path, asset),
+        ).fetchone()
+        if row and row[0] != owner and row[1] > now:
+            connection.execute("ROLLBACK")
+            return False
+        if row and row[0] != owner:
+            logger.info("lease.taken_over", asset=asset, previous_owner=row[0])
+        connection.execute(
+            "INSERT OR REPLACE INTO leases (story_path, asset, owner, expires_at) VALUES (?, ?, ?, ?)",
+            (story_path, asset, owner, now + LEASE_TTL_SECONDS),
+        )
+        connection.execute("COMMIT")
+        return True
+    finally:
+        connection.close()
+
+
+def renew_lease(story_path: str, asset: str, owner: str = OWNER_ID) -> bool:
+    connection = get_connection()
+    try:
+        cursor = connection.execute(
+            "UPDATE leases SET expires_at = ? WHERE story_path = ? AND asset = ? AND owner = ?",
+            (time.time() + LEASE_TTL_SECONDS, story_path, asset, owner),
+        )
+        return cursor.rowcount == 1
+    finally:
+        connection.close()
+
+
+def release_lease(story_path: str, asset: str, owner: str = OWNER_ID):
+    connection = get_connection()
+    try:
+        connection.execute(
+            "DELETE FROM leases WHERE story_path = ? AND asset = ? AND owner = ?",
+            (story_path, asset, owner),
+        )
+    finally:
+        connection.close()
+
+
+def is_leased_by_other(story_path: str, asset: str, owner: str = OWNER_ID) -> bool:
+    connection = get_connection()
+    try:
+        row = connection.execute(
+            "SELECT 1 FROM leases WHERE story_path = ? AND asset = ? AND owner != ? AND expires_at > ?",
+            (story_path, asset, owner, time.time()),
+        ).fetchone()
+        return row is not None
+    finally:
+        connection.close()
+
+
+@contextmanager
+def hold_lease(
+    story_path: str, asset: str, token: Optional[CancellationToken] = None
+) -> Iterator[None]:
+    # Waits while a live lease is held elsewhere, abandoned (expired) leases are
+    # taken over. The lease is kept alive by a heartbeat until released.
+    while not claim_lease(story_path, asset):
+        if token:
+            token.raise_if_cancelled()
+        time.sleep(LEASE_POLL_SECONDS)
+
+    stop_heartbeat = threading.Event()
+
+    def heartbeat():
+        while not stop_heartbeat.wait(LEASE_TTL_SECONDS / 3):
+            if not renew_lease(story_path, asset):
+                logger.warning("lease.lost", story_path=story_path, asset=asset)
+                return
+
+    heartbeat_thread = threading.Thread(target=heartbeat, daemon=True)
+    heartbeat_thread.start()
+    try:
+        yield
+    finally:
+        stop_heartbeat.set()
+        heartbeat_thread.join()
+        release_lease(story_path, asset)
@@ -0,0 +1,74 @@
+import fcntl
+import hashlib
+import os
+import threading
+from concurrent.futures import Future
+from contextlib import contextmanager
+from concurrent.futures import TimeoutError
+from typing import Callable, Dict, Iterator, Optional, Tuple, TypeVar
+
+from cancellation import CancellationToken
+from constants import LOCKS_DIR
+from log import get_logger
+
+logger = get_logger(__name__)
+
+T = TypeVar("T")
+
+_IN_FLIGHT: Dict[Tuple[str, ...], Future] = {}
+_IN_FLIGHT_LOCK = threading.Lock()
+
+
+def get_lock_path(key: Tuple[str, ...]) -> str:
+    digest = hashlib.sha256("\0".join(key).encode("utf-8")).hexdigest()
+    return os.path.join(LOCKS_DIR, f"{digest}.lock")
+
+
+@contextmanager
+def file_lock(key: Tuple[str, ...]) -> Iterator[None]:
+    # flock is held per open file, so this excludes other threads as well as
+    # other processes sharing the volume.
+    os.makedirs(LOCKS_DIR, exist_ok=True)
+    with open(get_lock_path(key), "a") as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def single_flight(
+    key: Tuple[str, ...],
+    fn: Callable[[], T],
+    token: Optional[CancellationToken] = None,
+) -> T:
+    # Callers arriving while `fn` runs for the same key wait for and share its
+    # result. Across processes the file lock serializes the calls, `fn` is
+    # expected to pick up results written by the previous holder.
+    with _IN_FLIGHT_LOCK:
+        future = _IN_FLIGHT.get(key)
+        is_leader = future is None
+        if is_leader:
+            future = Future()
+            _IN_FLIGHT[key] = future
+    if not is_leader:
+        logger.debug("locks.waiting", key=key)
+        while True:
+            if token:
+                token.raise_if_cancelled()
+            try:
+                return future.result(timeout=1)
+            except TimeoutError:
+                continue
+
+    try:
+        with file_lock(key):
+            result = fn()
+        future.set_result(result)
+        return result
+    except BaseException as e:
+        future.set_exception(e)
+        raise
+    finally:
+        with _IN_FLIGHT_LOCK:
+            del _IN_FLIGHT[key]
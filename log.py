@@ -0,0 +1,138 @@
+import atexit
+import hashlib
+import json
+import logging
+import logging.handlers
+import queue
+import random
+import sys
+import threading
+from typing import Any, Dict, Optional
+
+from constants import (
+    LOG_FORMAT,
+    LOG_LEVEL,
+    LOG_PROMPT_MAX_CHARS,
+    LOG_QUEUE_MAX,
+    LOG_SAMPLE_RATES,
+)
+
+_CONFIGURED = False
+_CONFIGURE_LOCK = threading.Lock()
+
+
+# Wraps a prompt so it is only hashed and truncated when the record is actually
+# written, on the listener thread.
+class Prompt:
+    __slots__ = ("text",)
+
+    def __init__(self, text: Optional[str]):
+        self.text = text or ""
+
+    def __str__(self) -> str:
+        digest = hashlib.sha256(self.text.encode("utf-8")).hexdigest()[:12]
+        summary = f"sha256:{digest} chars:{len(self.text)}"
+        if LOG_PROMPT_MAX_CHARS <= 0:
+            return summary
+        preview = self.text[:LOG_PROMPT_MAX_CHARS]
+        if len(self.text) > LOG_PROMPT_MAX_CHARS:
+            preview += "..."
+        return f"{summary} {preview!r}"
+
+
+def get_field_value(value: Any) -> Any:
+    if value is None or isinstance(value, (bool, int, float)):
+        return value
+    return str(value)
+
+
+class StructuredFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        fields: Dict[str, Any] = getattr(record, "fields", {})
+        if LOG_FORMAT == "json":
+            entry = {
+                "time": record.created,
+                "level": record.levelname,
+                "logger": record.name,
+                "event": record.getMessage(),
+                "thread": record.threadName,
+                **{key: get_field_value(value) for key, value in fields.items()},
+            }
+            if record.exc_info:
+                entry["exception"] = self.formatException(record.exc_info)
+            return json.dumps(entry)
+        text = f"{self.formatTime(record)} {record.levelname} {record.name} {record.getMessage()}"
+        for key, value in fields.items():
+            text += f" {key}={get_field_value(value)}"
+        if record.exc_info:
+            text += "\n" + self.formatException(record.exc_info)
+        return text
+
+
+# Request threads only put the record on a bounded queue, formatting and the
+# write to stderr happen on the listener thread. A full queue drops records.
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    dropped = 0
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        return record
+
+    def enqueue(self, record: logging.LogRecord):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            DroppingQueueHandler.dropped += 1
+
+
+def configure_logging():
+    global _CONFIGURED
+    with _CONFIGURE_LOCK:
+        if _CONFIGURED:
+            return
+        stream_handler = logging.StreamHandler(sys.stderr)
+        stream_handler.setFormatter(StructuredFormatter())
+        records = queue.Queue(maxsize=LOG_QUEUE_MAX)
+        listener = logging.handlers.QueueListener(records, stream_handler)
+        listener.start()
+        atexit.register(listener.stop)
+
+        app_logger = logging.getLogger("app")
+        app_logger.setLevel(LOG_LEVEL)
+        app_logger.addHandler(DroppingQueueHandler(records))
+        # Streamlit configures the root logger, keep our records out of it
+        app_logger.propagate = False
+        _CONFIGURED = True
+
+
+class EventLogger:
+    def __init__(self, name: str):
+        self.logger = logging.getLogger(f"app.{name}")
+
+    def log(self, level: int, event: str, exc_info: bool = False, **fields: Any):
+        # Disabled levels return before any field is formatted
+        if not self.logger.isEnabledFor(level):
+            return
+        rate = LOG_SAMPLE_RATES.get(event)
+        if rate is not None and random.random() >= rate:
+            return
+        self.logger.log(level, event, exc_info=exc_info, extra={"fields": fields})
+
+    def debug(self, event: str, **fields: Any):
+        self.log(logging.DEBUG, event, **fields)
+
+    def info(self, event: str, **fields: Any):
+        self.log(logging.INFO, event, **fields)
+
+    def warning(self, event: str, **fields: Any):
+        self.log(logging.WARNING, event, **fields)
+
+    def error(self, event: str, **fields: Any):
+        self.log(logging.ERROR, event, **fields)
+
+    def exception(self, event: str, **fields: Any):
+        self.log(logging.ERROR, event, exc_info=True, **fields)
+
+
+def get_logger(name: str) -> EventLogger:
+    configure_logging()
+    return EventLogger(name)
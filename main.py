@@ -2,10 +2,25 @@ import uuid
 
 import streamlit as st
 
-from constants import Session
-from models import Story, get_stories
+from constants import MEMORY_PROFILING, STORY_INDEX_REFRESH_SECONDS, Session
+from profiling import start_memory_profiling
+from log import get_logger
+from maintenance import start_maintenance
+from models import Story, get_stories, get_story_index_version
 from pages.story import make_story_app
-from utils import get_state, set_state, to_kebab_case
+from utils import get_state, set_state, set_states, to_kebab_case
+
+logger = get_logger(__name__)
+start_memory_profiling()
+start_maintenance()
+
+
+@st.fragment(run_every=STORY_INDEX_REFRESH_SECONDS)
+def watch_stories(user_id: str):
+    # Another session, process or replica added or removed a story. Changes
+    # within a story are picked up by its page.
+    if get_state(Session.STORIES_VERSION) != get_story_index_version(user_id):
+        st.rerun()
 
 
 def generate_session_id():
@@ -25,15 +40,21 @@ if get_state(Session.ID) is None:
 # st.write("Session ID:", get_state(Session.ID))
 
 target_page = st.query_params.get("page", None)
-print(f"Target Page: {target_page}")
+user_id = str(get_state(Session.ID))
+stories_version = get_story_index_version(user_id)
 stories: list[Story] = get_state(Session.ALL_STORIES)
-if stories is None:
-    stories = get_stories(str(get_state(Session.ID)))
-    set_state(Session.ALL_STORIES, stories)
-print(f"Loaded {len(stories)} stories from disk.")
+if stories is None or get_state(Session.STORIES_VERSION) != stories_version:
+    stories = get_stories(user_id)
+    set_states({Session.ALL_STORIES: stories, Session.STORIES_VERSION: stories_version})
+logger.debug("main.rerun", target_page=target_page, stories=len(stories))
 pages = {
     "Overview": [
         st.Page("pages/about.py", title="About"),
+        *(
+            [st.Page("pages/diagnostics.py", title="Diagnostics")]
+            if MEMORY_PROFILING
+            else []
+        ),
     ],
     "Generate Story": [
         st.Page("pages/create.py", title="Create new story"),
@@ -49,4 +70,5 @@ pages = {
 }
 
 pg = st.navigation(pages)
+watch_stories(user_id)
 pg.run()
@@ -0,0 +1,48 @@
+import threading
+import time
+from typing import Optional
+
+from constants import BLOB_GC_INTERVAL_SECONDS
+from locks import file_lock
+from log import get_logger
+from models import collect_blob_garbage
+
+logger = get_logger(__name__)
+
+_MAINTENANCE: Optional[threading.Thread] = None
+_MAINTENANCE_LOCK = threading.Lock()
+
+
+# Housekeeping of the shared data directory. The app and the worker run it
+# periodically, `python maintenance.py` runs it once. Replicas take turns
+# through the file lock.
+def run_maintenance():
+    with file_lock(("maintenance",)):
+        collect_blob_garbage()
+
+
+def run_maintenance_loop(interval: float):
+    while True:
+        time.sleep(interval)
+        try:
+            run_maintenance()
+        except Exception:
+            logger.exception("maintenance.failed")
+
+
+def start_maintenance():
+    global _MAINTENANCE
+    with _MAINTENANCE_LOCK:
+        if _MAINTENANCE is not None or not BLOB_GC_INTERVAL_SECONDS:
+            return
+        _MAINTENANCE = threading.Thread(
+            target=run_maintenance_loop,
+            args=(BLOB_GC_INTERVAL_SECONDS,),
+            name="maintenance",
+            daemon=True,
+        )
+        _MAINTENANCE.start()
+
+
+if __name__ == "__main__":
+    run_maintenance()
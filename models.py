@@ -1,31 +1,89 @@
+import hashlib
 import json
 import os
+import threading
+import time
 from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
 from enum import Enum
-from typing import List, Optional
+from typing import Callable, Dict, Iterator, List, Optional, Tuple, Union
 
-from PIL import Image
-from PIL.ImageFile import ImageFile
 from pydantic import BaseModel, Field
+from pydantic.json_schema import SkipJsonSchema
 
+from blobs import collect_garbage, get_blob_path_from_name, restore_file, store_file
+from cancellation import (
+    CancellationToken,
+    GenerationCancelled,
+    release,
+    supersede,
+)
+from characters import (
+    CharacterEntry,
+    find_character_entry,
+    get_character_blob_names,
+    get_character_key,
+    has_entry_characters,
+    save_character_entry,
+)
 from constants import (
+    ASSET_DEADLINE_SECONDS,
+    CHAT_SESSIONS_DIR,
     GEMINI_IMAGE_GENERATION_MODEL,
     GEMINI_TEXT_GENERATION_MODEL_ACCURATE,
+    ILLUSTRATION_RENDER_MODE,
     STORIES_BASE_DIR,
+    STORY_JSON_INDENT,
+    STORY_LOAD_MAX_WORKERS,
+    STORY_LOAD_PARALLEL_THRESHOLD,
+    Asset,
     Audience,
     Orientation,
     PageCount,
+    RenderMode,
     Style,
 )
-from gemini import generate_image, generate_text
+from gemini import ImageChatSession, generate_image, generate_text
+from images import (
+    GeneratedImage,
+    get_file_hash,
+    get_image_placeholder,
+    read_image_sizes,
+    run_image_task,
+    save_generated_image,
+)
+from leases import hold_lease, is_leased_by_other
+from locks import file_lock, single_flight
+from log import Prompt, get_logger
 from prompts import (
+    get_charactersheet_delta_prompt,
     get_charactersheet_image_generation_prompt,
     get_cover_image_generation_prompt,
     get_illustration_image_generation_prompt,
+    get_illustration_session_seed_prompt,
     get_story_generation_system_prompt,
     get_story_generation_user_prompt,
 )
-from utils import classify_image_aspect, to_kebab_case
+from utils import classify_aspect, to_kebab_case
+from watcher import StoryFileChange, start_watcher, subscribe
+
+
+logger = get_logger(__name__)
+
+
+def get_page_asset(page_index: int) -> str:
+    return f"{Asset.PAGE} {page_index + 1}"
+
+
+def get_asset_page_index(asset: str) -> int:
+    return int(asset.split(" ")[1]) - 1
+
+
+class AssetVersion(BaseModel):
+    blob: str  # File name in the blob store
+    fingerprint: Optional[str] = None
+    placeholder: Optional[str] = None
+    created_at: float
 
 
 class Page(BaseModel):
@@ -39,22 +97,42 @@ class Page(BaseModel):
     image_path: Optional[str] = (
         None  # Field(..., description="Path to the generated illustration image")
     )
+    # Low-res data URI shown by the flipbook until the full image is loaded
+    placeholder: SkipJsonSchema[Optional[str]] = None
+    # Hash of the generation inputs the current image was rendered from
+    fingerprint: SkipJsonSchema[Optional[str]] = None
+    # Every distinct render, `version` is the one at `image_path`
+    versions: SkipJsonSchema[List[AssetVersion]] = []
+    version: SkipJsonSchema[Optional[int]] = None
 
 
 class CharacterSheet(BaseModel):
     image_path: Optional[str] = (
         None  # Field(..., description="Path to the generated character sheet image")
     )
+    fingerprint: SkipJsonSchema[Optional[str]] = None
+    versions: SkipJsonSchema[List[AssetVersion]] = []
+    version: SkipJsonSchema[Optional[int]] = None
+    # Accepted sheet of an earlier story with the same protagonist
+    library_key: SkipJsonSchema[Optional[str]] = None
     prompt: str = Field(
         ...,
         description="Prompt for generating character sheet. This should be detailed. Include details of the protagonist interms of clothing, features, plus more. Include details of other characters in the story. This prompt will be used to generate a character sheet comprising of the full body view of the protagonist and other characters in the story.",
     )
+    characters: List[str] = Field(
+        [],
+        description="Names of all the characters on the character sheet, the protagonist first.",
+    )
 
 
 class CoverImage(BaseModel):
     image_path: Optional[str] = (
         None  # Field(..., description="Path to the generated cover image")
     )
+    placeholder: SkipJsonSchema[Optional[str]] = None
+    fingerprint: SkipJsonSchema[Optional[str]] = None
+    versions: SkipJsonSchema[List[AssetVersion]] = []
+    version: SkipJsonSchema[Optional[int]] = None
     prompt: str = Field(
         ...,
         description="Prompt for generating cover image. This should be detailed. Include all the characters in the story as a collage. Include the name of the story. This prompt will be used to generate the cover image for the story.",
@@ -69,6 +147,8 @@ class Story(BaseModel):
     user_id: Optional[str] = (
         None  # Field(None, description="ID of the user who created the story")
     )
+    # As typed by the user, the generated `protagonist` differs between runs
+    protagonist_details: SkipJsonSchema[Optional[str]] = None
     page_count: PageCount = Field(..., description="Desired length of the story")
     style: Style = Field(..., description="Art style for illustrations")
     premise: str = Field(..., description="Short summary of the story")
@@ -93,31 +173,70 @@ class Story(BaseModel):
     def get_story_file_path(self) -> str:
         return os.path.join(self.get_base_dir(), f"{to_kebab_case(self.title)}.json")
 
-    def get_character_sheet_image_path(self) -> str:
-        return os.path.join(self.get_base_dir(), "character_sheet.jpeg")
+    def get_character_sheet_image_path(self, extension: str = ".jpeg") -> str:
+        return os.path.join(self.get_base_dir(), f"character_sheet{extension}")
 
-    def get_cover_image_path(self) -> str:
-        return os.path.join(self.get_base_dir(), "cover_image.jpeg")
+    def get_cover_image_path(self, extension: str = ".jpeg") -> str:
+        return os.path.join(self.get_base_dir(), f"cover_image{extension}")
 
-    def get_illustration_image_path(self, page_index: int) -> str:
-        return os.path.join(self.get_base_dir(), f"illustration_{page_index}.jpeg")
+    def get_illustration_image_path(
+        self, page_index: int, extension: str = ".jpeg"
+    ) -> str:
+        return os.path.join(
+            self.get_base_dir(), f"illustration_{page_index}{extension}"
+        )
 
-    def get_protagonist_image_path(self) -> str:
-        return os.path.join(self.get_base_dir(), f"protagonist.jpeg")
+    def make_title_unique(self):
+        # Taken by creating the story directory, which only one caller can do
+        os.makedirs(STORIES_BASE_DIR, exist_ok=True)
+        title, suffix = self.title, 1
+        while True:
+            try:
+                os.mkdir(os.path.join(STORIES_BASE_DIR, to_kebab_case(self.title)))
+                return
+            except FileExistsError:
+                suffix += 1
+                self.title = f"{title} {suffix}"
 
     def save(self, file_path: Optional[str] = None) -> str:
         if not file_path:
             file_path = self.get_story_file_path()
-        with open(file_path, "w") as f:
-            json.dump(self.model_dump(), f, indent=2)
-        print(f"Story saved to {file_path}")
+        # Write then rename, so concurrent readers never see a partial file
+        temp_file_path = f"{file_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(temp_file_path, "wb") as f:
+            f.write(self.model_dump_json(indent=STORY_JSON_INDENT).encode("utf-8"))
+        os.replace(temp_file_path, file_path)
+        logger.debug("story.saved", path=file_path)
         return file_path
 
     @staticmethod
     def load(file_path: str) -> "Story":
-        with open(file_path, "r") as f:
-            data = json.load(f)
-        return Story.model_validate(data)
+        # Parsed and validated in one pass, without building dicts first
+        with open(file_path, "rb") as f:
+            return Story.model_validate_json(f.read())
+
+    def get_asset_paths(self) -> List[str]:
+        return [
+            image_path
+            for image_path in [
+                self.image_path,
+                self.character_sheet.image_path,
+                self.cover_image.image_path,
+                *[page.image_path for page in self.pages],
+            ]
+            if image_path
+        ]
+
+    def get_revision(self) -> str:
+        # Changes whenever the story content or any of its asset files change.
+        digest = hashlib.sha256(self.model_dump_json().encode("utf-8"))
+        for image_path in self.get_asset_paths():
+            if os.path.exists(image_path):
+                stat = os.stat(image_path)
+                digest.update(
+                    f"{image_path}:{stat.st_mtime_ns}:{stat.st_size}".encode()
+                )
+        return digest.hexdigest()
 
     @staticmethod
     def generate_story(
@@ -126,8 +245,10 @@ class Story(BaseModel):
         style: Style,
         premise: str,
         audience: Audience,
-        protagonist_image: Optional[ImageFile],
+        protagonist_image_path: Optional[str],
         user_id: Optional[str] = None,
+        use_cache: bool = True,
+        token: Optional[CancellationToken] = None,
     ) -> "Story":
         system_prompt = get_story_generation_system_prompt(
             story_schema=Story.model_json_schema()
@@ -145,123 +266,549 @@ class Story(BaseModel):
             user_prompt=user_prompt,
             model_name=GEMINI_TEXT_GENERATION_MODEL_ACCURATE,
             target_model=Story,
+            use_cache=use_cache,
+            token=token,
         )
-        if protagonist_image:
-            protagonist_image_path = story.get_protagonist_image_path()
-            protagonist_image.save(protagonist_image_path)
+        # Cached responses repeat titles, never overwrite an existing story
+        story.make_title_unique()
+        if protagonist_image_path:
+            # Shared with every other story made from the same upload
             story.image_path = protagonist_image_path
         else:
-            print("No protagonist image provided.")
+            logger.info("story.no_protagonist_image", title=story.title)
         story.user_id = user_id
+        story.protagonist_details = protagonist_details
         story.save()
         return story
 
+    def get_illustration_session(self) -> Optional[ImageChatSession]:
+        if ILLUSTRATION_RENDER_MODE != RenderMode.CHAT:
+            return None
+        return ImageChatSession(
+            seed_prompt=get_illustration_session_seed_prompt(
+                story_title=self.title, style=self.style
+            ),
+            # Only the sheet, which stateless requests send as their reference too
+            seed_image_paths=[
+                image_path
+                for image_path in [self.character_sheet.image_path]
+                if image_path and os.path.exists(image_path)
+            ],
+            # Continues where the previous job of the story left off
+            session_path=os.path.join(
+                CHAT_SESSIONS_DIR, f"{to_kebab_case(self.title)}.json"
+            ),
+        )
+
     def generate_illustrations(self, force: bool = False) -> List[Optional[str]]:
         illustration_paths = []
+        session = self.get_illustration_session()
         for i in range(len(self.pages)):
-            illustration_path = self.generate_illustration(page_index=i, force=force)
+            illustration_path = self.generate_illustration(
+                page_index=i, force=force, session=session
+            )
             illustration_paths.append(illustration_path)
         return illustration_paths
 
     def generate_illustration(
-        self, page_index: int, force: bool = False
+        self,
+        page_index: int,
+        force: bool = False,
+        session: Optional[ImageChatSession] = None,
+        token: Optional[CancellationToken] = None,
     ) -> Optional[str]:
         page = self.pages[page_index]
         if not force and page.image_path and os.path.exists(page.image_path):
-            print(
-                f"Illustration for page(index) {page_index} already exists. Skipping generation."
-            )
+            logger.debug("asset.exists", asset=get_page_asset(page_index))
             return page.image_path
-
-        illustration_image = generate_image(
-            prompt=get_illustration_image_generation_prompt(
-                image_prompt=page.illustration_prompt, image_text=page.text
-            ),
-            model_name=GEMINI_IMAGE_GENERATION_MODEL,
-            reference_image=(
-                Image.open(self.character_sheet.image_path)
-                if self.character_sheet.image_path
-                else None
-            ),
+        return self.run_asset_generation(
+            get_page_asset(page_index),
+            lambda: self.render_illustration(page_index, session=session, token=token),
+            token=token,
         )
-        if illustration_image:
-            illustration_image_path = self.get_illustration_image_path(page_index)
-            illustration_image.save(illustration_image_path)
-            page.image_path = illustration_image_path
-            self.save()
+
+    def render_illustration(
+        self,
+        page_index: int,
+        session: Optional[ImageChatSession] = None,
+        token: Optional[CancellationToken] = None,
+    ) -> Optional[str]:
+        page = self.pages[page_index]
+        asset = get_page_asset(page_index)
+        fingerprint = self.get_asset_fingerprint(asset)
+        if session:
+            illustration_image = session.generate_image(
+                self.get_asset_prompt(asset), token=token
+            )
         else:
-            print(f"Failed to generate illustration for page {page_index+1}")
+            illustration_image = generate_image(
+                prompt=self.get_asset_prompt(asset),
+                model_name=GEMINI_IMAGE_GENERATION_MODEL,
+                reference_image_path=self.character_sheet.image_path,
+                token=token,
+            )
+        if not illustration_image:
+            logger.warning("asset.failed", story=self.title, asset=asset)
+        elif self.is_render_current(asset, fingerprint, token):
+            self.apply_generated_image(asset, illustration_image, fingerprint)
         return page.image_path
 
-    def generate_cover_image(self, force: bool = False) -> Optional[str]:
+    def generate_cover_image(
+        self, force: bool = False, token: Optional[CancellationToken] = None
+    ) -> Optional[str]:
         if (
             not force
             and self.cover_image.image_path
             and os.path.exists(self.cover_image.image_path)
         ):
-            print("Cover image already exists. Skipping generation.")
+            logger.debug("asset.exists", asset=Asset.COVER_IMAGE)
             return self.cover_image.image_path
-
-        cover_image_prompt = get_cover_image_generation_prompt(
-            story_title=self.title, style=self.style
+        return self.run_asset_generation(
+            Asset.COVER_IMAGE, lambda: self.render_cover_image(token=token), token=token
         )
-        print(cover_image_prompt)
+
+    def render_cover_image(
+        self, token: Optional[CancellationToken] = None
+    ) -> Optional[str]:
+        cover_image_prompt = self.get_asset_prompt(Asset.COVER_IMAGE)
+        logger.debug("asset.prompt", prompt=Prompt(cover_image_prompt))
+        fingerprint = self.get_asset_fingerprint(Asset.COVER_IMAGE)
 
         cover_image = generate_image(
             prompt=cover_image_prompt,
             model_name=GEMINI_IMAGE_GENERATION_MODEL,
-            reference_image=Image.open(self.character_sheet.image_path),
+            reference_image_path=self.character_sheet.image_path,
+            token=token,
         )
-        if cover_image:
-            cover_image_path = self.get_cover_image_path()
-            cover_image.save(cover_image_path)
-            self.cover_image.image_path = cover_image_path
-            self.save()
-        else:
-            print("Failed to generate cover image")
+        if not cover_image:
+            logger.warning("asset.failed", story=self.title, asset=Asset.COVER_IMAGE)
+        elif self.is_render_current(Asset.COVER_IMAGE, fingerprint, token):
+            self.apply_generated_image(Asset.COVER_IMAGE, cover_image, fingerprint)
         return self.cover_image.image_path
 
-    def generate_character_sheet(self, force: bool = False) -> Optional[str]:
+    def generate_character_sheet(
+        self, force: bool = False, token: Optional[CancellationToken] = None
+    ) -> Optional[str]:
         if (
             not force
             and self.character_sheet.image_path
             and os.path.exists(self.character_sheet.image_path)
         ):
-            print("Character sheet image already exists. Skipping generation.")
+            logger.debug("asset.exists", asset=Asset.CHARACTER_SHEET)
             return self.character_sheet.image_path
+        return self.run_asset_generation(
+            Asset.CHARACTER_SHEET,
+            lambda: self.render_character_sheet(token=token),
+            token=token,
+        )
+
+    def render_character_sheet(
+        self, token: Optional[CancellationToken] = None
+    ) -> Optional[str]:
         protagonist_image = None
         if self.image_path:
             protagonist_image = self.image_path
 
-        character_sheet_prompt = get_charactersheet_image_generation_prompt(
-            character_sheet_prompt=self.character_sheet.prompt,
-            style=self.style,
-            protagonist_image=protagonist_image,
-        )
+        character_sheet_prompt = self.get_asset_prompt(Asset.CHARACTER_SHEET)
+        fingerprint = self.get_asset_fingerprint(Asset.CHARACTER_SHEET)
+        entry = self.get_character_entry()
+        if entry and not self.has_entry_characters(entry):
+            # Only the other characters are new, extend the accepted sheet
+            character_sheet_prompt = get_charactersheet_delta_prompt(
+                character_sheet_prompt=self.character_sheet.prompt, style=self.style
+            )
+            protagonist_image = get_blob_path_from_name(entry.blob)
 
         character_sheet_image = generate_image(
             prompt=character_sheet_prompt,
             model_name=GEMINI_IMAGE_GENERATION_MODEL,
-            reference_image=(
-                Image.open(protagonist_image) if protagonist_image else None
-            ),
+            reference_image_path=protagonist_image,
+            token=token,
+        )
+        if not character_sheet_image:
+            logger.warning(
+                "asset.failed", story=self.title, asset=Asset.CHARACTER_SHEET
+            )
+        elif self.is_render_current(Asset.CHARACTER_SHEET, fingerprint, token):
+            self.apply_generated_image(
+                Asset.CHARACTER_SHEET, character_sheet_image, fingerprint
+            )
+        return self.character_sheet.image_path
+
+    def get_character_key(self) -> Optional[str]:
+        return get_character_key(self.image_path, self.style, self.protagonist_details)
+
+    def get_character_entry(self) -> Optional[CharacterEntry]:
+        return find_character_entry(self.character_sheet.library_key)
+
+    def has_entry_characters(self, entry: CharacterEntry) -> bool:
+        return has_entry_characters(
+            entry, self.character_sheet.characters, self.character_sheet.prompt
+        )
+
+    def link_character_library(self, reuse: bool) -> Optional[CharacterEntry]:
+        entry = find_character_entry(self.get_character_key())
+        if not entry:
+            return None
+        self.character_sheet.library_key = entry.key
+        if reuse and self.has_entry_characters(entry):
+            self.reuse_character_sheet(entry)
+        else:
+            self.save_asset(Asset.CHARACTER_SHEET)
+        return entry
+
+    def reuse_character_sheet(self, entry: CharacterEntry) -> Optional[str]:
+        def apply_entry() -> str:
+            record = self.character_sheet
+            extension = os.path.splitext(entry.blob)[1]
+            image_path = restore_file(
+                entry.blob,
+                f"{self.get_asset_path_stem(Asset.CHARACTER_SHEET)}{extension}",
+            )
+            if record.image_path and record.image_path != image_path:
+                if os.path.exists(record.image_path):
+                    os.remove(record.image_path)
+            record.image_path = image_path
+            # Accepted for this story as well, pages drawn from it are current
+            record.fingerprint = self.get_asset_fingerprint(Asset.CHARACTER_SHEET)
+            self.add_asset_version(Asset.CHARACTER_SHEET)
+            self.save_asset(Asset.CHARACTER_SHEET)
+            return image_path
+
+        return self.run_asset_generation(Asset.CHARACTER_SHEET, apply_entry)
+
+    def remember_character_sheet(self) -> Optional[CharacterEntry]:
+        key = self.get_character_key()
+        record = self.character_sheet
+        if not key or record.version is None:
+            return None
+        if self.is_asset_stale(Asset.CHARACTER_SHEET):
+            return None
+        blob = record.versions[record.version].blob
+        entry = find_character_entry(key)
+        if entry and entry.blob == blob:
+            return entry
+        return save_character_entry(
+            key, blob, record.characters, record.prompt, self.title
+        )
+
+    def generate_asset(
+        self,
+        asset: str,
+        force: bool = False,
+        session: Optional[ImageChatSession] = None,
+        token: Optional[CancellationToken] = None,
+    ) -> Optional[str]:
+        if asset == Asset.CHARACTER_SHEET:
+            return self.generate_character_sheet(force=force, token=token)
+        if asset == Asset.COVER_IMAGE:
+            return self.generate_cover_image(force=force, token=token)
+        return self.generate_illustration(
+            get_asset_page_index(asset), force=force, session=session, token=token
+        )
+
+    def generate_asset_with_deadline(
+        self,
+        asset: str,
+        force: bool = False,
+        session: Optional[ImageChatSession] = None,
+        token: Optional[CancellationToken] = None,
+        owner: Optional[str] = None,
+    ) -> Optional[str]:
+        asset_token = (
+            token.child(ASSET_DEADLINE_SECONDS)
+            if token
+            else CancellationToken(ASSET_DEADLINE_SECONDS)
+        )
+        # A newer request from the same owner for this asset cancels this one
+        key = (owner, self.get_story_file_path(), asset) if owner else None
+        if key:
+            supersede(key, asset_token)
+        try:
+            return self.generate_asset(
+                asset, force=force, session=session, token=asset_token
+            )
+        except GenerationCancelled as e:
+            if token and token.is_cancelled():
+                raise
+            logger.info("asset.stopped", story=self.title, asset=asset, reason=e)
+            return self.get_asset_record(asset).image_path
+        finally:
+            if key:
+                release(key, asset_token)
+
+    def generate_assets(
+        self,
+        assets: List[str],
+        force: bool = True,
+        token: Optional[CancellationToken] = None,
+        owner: Optional[str] = None,
+    ) -> Iterator[Tuple[str, Optional[str]]]:
+        session = None
+        deferred_assets = []
+        for asset in assets:
+            if asset.startswith(Asset.PAGE):
+                if session is None:
+                    # Opened once the character sheet and cover are final
+                    session = self.get_illustration_session()
+                if is_leased_by_other(self.get_story_file_path(), asset):
+                    # Another replica is rendering it, its render is picked up
+                    # under the lease after our share instead of being redone
+                    deferred_assets.append(asset)
+                    continue
+            yield asset, self.generate_asset_with_deadline(
+                asset, force=force, session=session, token=token, owner=owner
+            )
+        for asset in deferred_assets:
+            yield asset, self.generate_asset_with_deadline(
+                asset, force=force, session=session, token=token, owner=owner
+            )
+
+    def run_asset_generation(
+        self,
+        asset: str,
+        render: Callable[[], Optional[str]],
+        token: Optional[CancellationToken] = None,
+    ) -> Optional[str]:
+        # Job tokens carry the time the request was made, so a render another
+        # replica finished while this one was queued or deferred counts, as long
+        # as it still matches the story
+        requested_at = token.created_at if token else time.time()
+
+        story_path = self.get_story_file_path()
+        rendered = []
+
+        def render_once() -> Optional[str]:
+            rendered.append(True)
+            with hold_lease(story_path, asset, token=token):
+                # Another process or replica may have rendered it while we waited
+                self.reload_asset(asset)
+                record = self.get_asset_record(asset)
+                if (
+                    record.image_path
+                    and os.path.exists(record.image_path)
+                    and os.path.getmtime(record.image_path) >= requested_at
+                    and not self.is_asset_stale(asset)
+                ):
+                    logger.info("asset.reused", story=self.title, asset=asset)
+                    return record.image_path
+                if not record.versions and record.image_path:
+                    # Rendered before versions were kept, hold on to it
+                    self.add_asset_version(asset)
+                return render()
+
+        while True:
+            try:
+                image_path = single_flight(
+                    (story_path, asset), render_once, token=token
+                )
+            except GenerationCancelled:
+                if token is None or token.is_cancelled():
+                    raise
+                # The render we joined was cancelled by its caller, run our own
+                continue
+            # Callers that shared another caller's result pick up its record as well
+            self.reload_asset(asset)
+            if rendered or (image_path and not self.is_asset_stale(asset)):
+                return image_path
+            # The render we joined failed or was of older inputs, such as one of
+            # a request this one superseded, run our own
+
+    def is_render_current(
+        self,
+        asset: str,
+        fingerprint: str,
+        token: Optional[CancellationToken] = None,
+    ) -> bool:
+        # A response that arrives after its request was superseded or ran out of
+        # time is paid for, it is kept unless the story changed in the meantime
+        if token is None or not token.is_cancelled():
+            return True
+        story = Story.load(self.get_story_file_path())
+        if story.get_asset_fingerprint(asset) != fingerprint:
+            logger.info("asset.outdated", story=self.title, asset=asset)
+            return False
+        return True
+
+    def get_asset_path_stem(self, asset: str) -> str:
+        if asset == Asset.CHARACTER_SHEET:
+            return self.get_character_sheet_image_path(extension="")
+        if asset == Asset.COVER_IMAGE:
+            return self.get_cover_image_path(extension="")
+        return self.get_illustration_image_path(
+            get_asset_page_index(asset), extension=""
+        )
+
+    def apply_generated_image(
+        self, asset: str, image: GeneratedImage, fingerprint: str
+    ) -> str:
+        record = self.get_asset_record(asset)
+        record.image_path = save_generated_image(image, self.get_asset_path_stem(asset))
+        if hasattr(record, "placeholder"):
+            record.placeholder = get_image_placeholder(record.image_path)
+        record.fingerprint = fingerprint
+        self.add_asset_version(asset)
+        self.save_asset(asset)
+        return record.image_path
+
+    def add_asset_version(self, asset: str) -> int:
+        record = self.get_asset_record(asset)
+        if not record.image_path or not os.path.exists(record.image_path):
+            return record.version
+        blob = store_file(record.image_path)
+        for index, version in enumerate(record.versions):
+            if version.blob == blob:
+                # Rendered the exact same image again
+                record.version = index
+                return index
+        record.versions.append(
+            AssetVersion(
+                blob=blob,
+                fingerprint=record.fingerprint,
+                placeholder=getattr(record, "placeholder", None),
+                created_at=time.time(),
+            )
         )
-        if character_sheet_image:
-            character_sheet_image_path = self.get_character_sheet_image_path()
-            character_sheet_image.save(character_sheet_image_path)
-            self.character_sheet.image_path = character_sheet_image_path
-            self.save()
+        record.version = len(record.versions) - 1
+        return record.version
+
+    def revert_asset(self, asset: str, version_index: int) -> str:
+        self.reload_asset(asset)
+        record = self.get_asset_record(asset)
+        version = record.versions[version_index]
+        extension = os.path.splitext(version.blob)[1]
+        path_stem = self.get_asset_path_stem(asset)
+        image_path = restore_file(version.blob, f"{path_stem}{extension}")
+        if record.image_path and record.image_path != image_path:
+            if os.path.exists(record.image_path):
+                os.remove(record.image_path)
+        record.image_path = image_path
+        record.fingerprint = version.fingerprint
+        if hasattr(record, "placeholder"):
+            record.placeholder = version.placeholder
+        record.version = version_index
+        self.save_asset(asset)
+        return image_path
+
+    def get_blob_names(self) -> List[str]:
+        return [
+            version.blob
+            for asset in self.get_assets()
+            for version in self.get_asset_record(asset).versions
+        ]
+
+    def reload_asset(self, asset: str):
+        file_path = self.get_story_file_path()
+        if os.path.exists(file_path):
+            self.set_asset_record(asset, Story.load(file_path).get_asset_record(asset))
+
+    def save_asset(self, asset: str) -> str:
+        # Other sessions may have saved other assets in the meantime, merge into
+        # the latest version on disk instead of overwriting it.
+        file_path = self.get_story_file_path()
+        with file_lock((file_path,)):
+            if not os.path.exists(file_path):
+                return self.save(file_path)
+            story = Story.load(file_path)
+            story.set_asset_record(asset, self.get_asset_record(asset))
+            for other_asset in story.get_assets():
+                if other_asset != asset:
+                    self.set_asset_record(
+                        other_asset, story.get_asset_record(other_asset)
+                    )
+            return story.save(file_path)
+
+    def set_asset_record(
+        self, asset: str, record: Union[CharacterSheet, CoverImage, Page]
+    ):
+        if asset == Asset.CHARACTER_SHEET:
+            self.character_sheet = record
+        elif asset == Asset.COVER_IMAGE:
+            self.cover_image = record
         else:
-            print("Failed to generate character sheet image")
+            self.pages[get_asset_page_index(asset)] = record
+
+    def get_asset_record(self, asset: str) -> Union[CharacterSheet, CoverImage, Page]:
+        if asset == Asset.CHARACTER_SHEET:
+            return self.character_sheet
+        if asset == Asset.COVER_IMAGE:
+            return self.cover_image
+        return self.pages[get_asset_page_index(asset)]
+
+    def get_asset_prompt(self, asset: str) -> str:
+        if asset == Asset.CHARACTER_SHEET:
+            return get_charactersheet_image_generation_prompt(
+                character_sheet_prompt=self.character_sheet.prompt,
+                style=self.style,
+                protagonist_image=self.image_path,
+            )
+        if asset == Asset.COVER_IMAGE:
+            return get_cover_image_generation_prompt(
+                story_title=self.title, style=self.style
+            )
+        page = self.pages[get_asset_page_index(asset)]
+        return get_illustration_image_generation_prompt(
+            image_prompt=page.illustration_prompt, image_text=page.text
+        )
+
+    def get_asset_reference_image_path(self, asset: str) -> Optional[str]:
+        if asset == Asset.CHARACTER_SHEET:
+            return self.image_path
         return self.character_sheet.image_path
 
+    def get_asset_fingerprint(self, asset: str) -> str:
+        reference_image_path = self.get_asset_reference_image_path(asset)
+        inputs = {
+            "prompt": self.get_asset_prompt(asset),
+            "style": self.style.value,
+            "model": GEMINI_IMAGE_GENERATION_MODEL,
+            "reference_image": (
+                get_file_hash(reference_image_path)
+                if reference_image_path and os.path.exists(reference_image_path)
+                else None
+            ),
+        }
+        if asset.startswith(Asset.PAGE) and ILLUSTRATION_RENDER_MODE == RenderMode.CHAT:
+            # Chat renders depend on the earlier pages, switching modes redoes them
+            inputs["render_mode"] = ILLUSTRATION_RENDER_MODE.value
+        return hashlib.sha256(
+            json.dumps(inputs, sort_keys=True).encode("utf-8")
+        ).hexdigest()
+
+    def is_asset_stale(self, asset: str) -> bool:
+        record = self.get_asset_record(asset)
+        if not record.image_path or not os.path.exists(record.image_path):
+            return True
+        if record.fingerprint is None:
+            # Rendered before fingerprints were recorded, keep it
+            return False
+        return record.fingerprint != self.get_asset_fingerprint(asset)
+
+    def get_assets(self) -> List[str]:
+        return [Asset.CHARACTER_SHEET, Asset.COVER_IMAGE] + [
+            get_page_asset(i) for i in range(len(self.pages))
+        ]
+
+    def get_stale_assets(self) -> List[str]:
+        # Everything else is rendered from the character sheet, so a stale sheet
+        # makes the whole book stale.
+        if self.is_asset_stale(Asset.CHARACTER_SHEET):
+            return self.get_assets()
+        return [
+            asset
+            for asset in self.get_assets()
+            if asset != Asset.CHARACTER_SHEET and self.is_asset_stale(asset)
+        ]
+
     def get_orientation(self) -> Orientation:
+        image_paths = [
+            page.image_path
+            for page in self.pages
+            if page.image_path and os.path.exists(page.image_path)
+        ]
+        sizes = run_image_task(read_image_sizes, image_paths) if image_paths else []
         most_common = Counter(
-            [
-                classify_image_aspect(Image.open(page.image_path))
-                for page in self.pages
-                if page.image_path and os.path.exists(page.image_path)
-            ]
+            [classify_aspect(width, height) for width, height in sizes]
         ).most_common()
         return Orientation(most_common[0][0]) if most_common else Orientation.UNKNOWN
 
@@ -270,21 +817,26 @@ class Story(BaseModel):
         if not self.character_sheet.image_path or not os.path.exists(
             self.character_sheet.image_path
         ):
-            missing_assets.append("Character Sheet")
+            missing_assets.append(Asset.CHARACTER_SHEET)
         if not self.cover_image.image_path or not os.path.exists(
             self.cover_image.image_path
         ):
-            missing_assets.append("Cover Image")
+            missing_assets.append(Asset.COVER_IMAGE)
         for i, page in enumerate(self.pages):
             if not page.image_path or not os.path.exists(page.image_path):
-                missing_assets.append(f"Page {i + 1}")
+                missing_assets.append(get_page_asset(i))
         return missing_assets
 
 
-def get_stories(user_id: Optional[str] = None) -> List[Story]:
-    stories = []
+STORY_LOAD_EXECUTOR = ThreadPoolExecutor(
+    max_workers=STORY_LOAD_MAX_WORKERS, thread_name_prefix="story-load"
+)
+
+
+def get_story_file_paths() -> List[str]:
+    story_file_paths = []
     if not os.path.exists(STORIES_BASE_DIR):
-        return stories
+        return story_file_paths
     for story_dir in os.listdir(STORIES_BASE_DIR):
         story_path = os.path.join(STORIES_BASE_DIR, story_dir)
         if os.path.isdir(story_path):
@@ -294,10 +846,182 @@ def get_stories(user_id: Optional[str] = None) -> List[Story]:
                 if f.endswith(".json") and os.path.isfile(os.path.join(story_path, f))
             ]
             if story_files:
-                try:
-                    story = Story.load(os.path.join(story_path, story_files[0]))
-                    if story.user_id == user_id or story.user_id is None:
-                        stories.append(story)
-                except Exception as e:
-                    print(f"Error loading story from {story_files[0]}: {e}")
-    return stories
+                story_file_paths.append(os.path.join(story_path, story_files[0]))
+    return story_file_paths
+
+
+def load_story_or_none(story_file_path: str) -> Optional[Story]:
+    try:
+        return Story.load(story_file_path)
+    except Exception as e:
+        logger.warning("story.load_failed", path=story_file_path, error=e)
+        return None
+
+
+def load_stories(story_file_paths: List[str]) -> List[Optional[Story]]:
+    if len(story_file_paths) > STORY_LOAD_PARALLEL_THRESHOLD:
+        # Mostly waiting on the disk, threads overlap the reads
+        return list(STORY_LOAD_EXECUTOR.map(load_story_or_none, story_file_paths))
+    return [load_story_or_none(path) for path in story_file_paths]
+
+
+def get_story_file_stat(story_file_path: str) -> Optional[Tuple[int, int]]:
+    try:
+        stat = os.stat(story_file_path)
+    except FileNotFoundError:
+        return None
+    return stat.st_mtime_ns, stat.st_size
+
+
+def is_story_visible(story: Story, user_id: Optional[str]) -> bool:
+    return story.user_id == user_id or story.user_id is None
+
+
+class StoryIndexEntry:
+    def __init__(
+        self, stat: Tuple[int, int], story: Story, sequence: int, listed_sequence: int
+    ):
+        self.stat = stat
+        self.story = story
+        self.sequence = sequence
+        self.listed_sequence = listed_sequence
+
+
+# Parsed stories of the whole library. The library is scanned once, then the
+# story watcher keeps it current as this or any other process writes into
+# STORIES_BASE_DIR. Every change takes a new sequence number, so sessions can
+# tell whether the stories they show are still current. The library version
+# only moves when the list of stories does, a change within a story only moves
+# that story's version.
+class StoryIndex:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.entries: Dict[str, StoryIndexEntry] = {}
+        self.sequence = 0
+        self.removed_sequence = 0
+        self.loaded = False
+
+    def load(self):
+        with self.lock:
+            if self.loaded:
+                return
+            # Watch first, so nothing written during the scan is missed
+            subscribe(self.handle_change)
+            start_watcher()
+            story_file_paths = get_story_file_paths()
+            stats = [get_story_file_stat(path) for path in story_file_paths]
+            stories = load_stories(story_file_paths)
+            for path, stat, story in zip(story_file_paths, stats, stories):
+                if stat and story:
+                    self.entries[path] = StoryIndexEntry(stat, story, 0, 0)
+            self.loaded = True
+
+    def refresh(self, story_file_path: str) -> Optional[Story]:
+        stat = get_story_file_stat(story_file_path)
+        with self.lock:
+            entry = self.entries.get(story_file_path)
+            if entry and entry.stat == stat:
+                return entry.story
+            if stat is None:
+                if self.entries.pop(story_file_path, None):
+                    self.sequence += 1
+                    self.removed_sequence = self.sequence
+                return None
+        story = load_story_or_none(story_file_path)
+        if story is None:
+            # Keep serving the previous version of a file that failed to parse
+            return entry.story if entry else None
+        with self.lock:
+            self.sequence += 1
+            entry = self.entries.get(story_file_path)
+            listed_sequence = self.sequence
+            if (
+                entry
+                and entry.story.title == story.title
+                and entry.story.user_id == story.user_id
+            ):
+                # Still listed the same way, only views of the story are stale
+                listed_sequence = entry.listed_sequence
+            # Stat taken before the read, a write racing the read reloads again
+            self.entries[story_file_path] = StoryIndexEntry(
+                stat, story, self.sequence, listed_sequence
+            )
+        return story
+
+    def touch(self, story_dir: str):
+        # An asset changed without its story, views of the story are stale
+        with self.lock:
+            for path, entry in self.entries.items():
+                if os.path.dirname(path) == story_dir:
+                    self.sequence += 1
+                    entry.sequence = self.sequence
+
+    def handle_change(self, change: StoryFileChange):
+        if change.is_story:
+            self.refresh(change.path)
+        else:
+            self.touch(change.story_dir)
+
+    def get_version(self, user_id: Optional[str] = None) -> int:
+        self.load()
+        with self.lock:
+            return max(
+                [self.removed_sequence]
+                + [
+                    entry.listed_sequence
+                    for entry in self.entries.values()
+                    if is_story_visible(entry.story, user_id)
+                ]
+            )
+
+    def get_story_version(self, story_file_path: str) -> Optional[int]:
+        self.load()
+        self.refresh(story_file_path)
+        with self.lock:
+            entry = self.entries.get(story_file_path)
+            return entry.sequence if entry else None
+
+    def get_stories(self, user_id: Optional[str] = None) -> List[Story]:
+        self.load()
+        with self.lock:
+            return [
+                entry.story
+                for entry in self.entries.values()
+                if is_story_visible(entry.story, user_id)
+            ]
+
+    def get_story(self, story_file_path: str) -> Optional[Story]:
+        self.load()
+        story = self.refresh(story_file_path)
+        # Callers render into the story, they get a copy of their own
+        return story.model_copy(deep=True) if story else None
+
+
+STORY_INDEX = StoryIndex()
+
+
+def get_stories(user_id: Optional[str] = None) -> List[Story]:
+    return STORY_INDEX.get_stories(user_id)
+
+
+def get_story_index_version(user_id: Optional[str] = None) -> int:
+    return STORY_INDEX.get_version(user_id)
+
+
+def get_story_version(story_file_path: str) -> Optional[int]:
+    return STORY_INDEX.get_story_version(story_file_path)
+
+
+def get_story(story_file_path: str) -> Optional[Story]:
+    return STORY_INDEX.get_story(story_file_path)
+
+
+def collect_blob_garbage() -> List[str]:
+    # Only blobs that no version of any story refers to are removed
+    referenced = []
+    for story_file_path in get_story_file_paths():
+        referenced.extend(Story.load(story_file_path).get_blob_names())
+    referenced.extend(get_character_blob_names())
+    removed = collect_garbage(referenced)
+    logger.info("blobs.collected", removed=len(removed))
+    return removed
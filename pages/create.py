@@ -1,14 +1,18 @@
 import random
-import threading
 from typing import List, Optional
 
 import streamlit as st
-from PIL import Image
 
+from client import get_generation_client, wait_for_job
 from constants import Audience, Key, PageCount, Session, Style
-from models import Story
+from jobs import CreateStoryRequest, JobStatus
+from log import get_logger
+from models import STORY_INDEX, Story
 from pages.story import make_story_app
-from utils import get_image_as_bytesIO, get_state, set_state, set_states, to_kebab_case
+from uploads import get_upload_path, ingest_image, ingest_image_file
+from utils import get_state, set_state, set_states, to_kebab_case
+
+logger = get_logger(__name__)
 
 
 def auto_fill_example():
@@ -24,8 +28,16 @@ def auto_fill_example():
     set_state(Key.ART_STYLE, Style.CARTOON.value)
     set_state(Key.PAGE_COUNT, PageCount.TENish.value)
     set_state(
-        Key.PROTAGONIST_IMAGE_DISPLAY,
-        get_image_as_bytesIO("static/images/luna.jpeg"),
+        Session.PROTAGONIST_IMAGE_HASH,
+        ingest_image_file("static/images/luna.jpeg"),
+    )
+
+
+def handle_protagonist_image_upload():
+    uploaded_file = get_state(Key.PROTAGONIST_IMAGE)
+    set_state(
+        Session.PROTAGONIST_IMAGE_HASH,
+        ingest_image(uploaded_file.getvalue()) if uploaded_file else None,
     )
 
 
@@ -35,25 +47,28 @@ def generate_story(
     audience,
     style,
     page_count,
-    protagonist_image,
+    protagonist_image_hash,
     user_id,
 ) -> Optional[Story]:
-    print("(Thread) Starting story generation...")
-    audience = Audience(audience)
-    style = Style(style)
-    page_count = PageCount(page_count)
-    story: Story = Story.generate_story(
-        protagonist_details=protagonist_details,
-        premise=premise,
-        audience=audience,
-        style=style,
-        page_count=page_count,
-        protagonist_image=(
-            Image.open(protagonist_image) if protagonist_image else None
-        ),
-        user_id=user_id,
+    logger.info("create_story.submitted", user_id=user_id)
+    job = get_generation_client().create_story(
+        CreateStoryRequest(
+            protagonist_details=protagonist_details,
+            premise=premise,
+            audience=Audience(audience),
+            style=Style(style),
+            page_count=PageCount(page_count),
+            protagonist_image_hash=protagonist_image_hash,
+            user_id=user_id,
+        )
     )
-    return story
+    job = wait_for_job(job.id)
+    if job is None or job.status != JobStatus.DONE:
+        logger.warning(
+            "create_story.failed", user_id=user_id, error=job.error if job else None
+        )
+        return None
+    return Story.load(job.result)
 
 
 def switch_to_story_page(story: Story):
@@ -72,12 +87,9 @@ def render_create():
     st.header("Create Your Story")
     create_story_state = get_state(Session.CREATE_STORY_STATE)
     user_id = str(get_state(Session.ID))
-    print(
-        f"(render_create) Current create_story_state for {user_id}: {create_story_state}"
-    )
+    logger.debug("create_story.render", user_id=user_id, state=create_story_state)
     if create_story_state == "generating":
         with st.container(horizontal=True, horizontal_alignment="center"):
-            print(f"(render_create) Rendering your({user_id}) generating story...")
             st.write("Generating your story, please wait...")
             story: Story = generate_story(
                 protagonist_details=get_state(Key.PROTAGONIST_DETAILS),
@@ -85,7 +97,7 @@ def render_create():
                 audience=get_state(Key.AUDIENCE),
                 style=get_state(Key.ART_STYLE),
                 page_count=get_state(Key.PAGE_COUNT),
-                protagonist_image=get_state(Key.PROTAGONIST_IMAGE_DISPLAY),
+                protagonist_image_hash=get_state(Session.PROTAGONIST_IMAGE_HASH),
                 user_id=user_id,
             )
             if story is None:
@@ -93,6 +105,8 @@ def render_create():
                     "An error occurred while generating the story. Please try again."
                 )
                 return
+            # Index it now, the watcher may not have seen the new file yet
+            STORY_INDEX.refresh(story.get_story_file_path())
             stories: List[Story] = get_state(Session.ALL_STORIES) or []
             stories.append(story)
             set_states(
@@ -124,17 +138,19 @@ def render_create():
                 "Upload a reference image for the protagonist",
                 type=["png", "jpg", "jpeg"],
                 key="key_protagonist_image",
+                on_change=handle_protagonist_image_upload,
             )
             with st.container(
                 horizontal=True,
                 horizontal_alignment="center",
                 vertical_alignment="center",
             ):
-                image_file = get_state("key_protagonist_image") or get_state(
-                    "key_protagonist_image_display"
-                )
-                if image_file is not None:
-                    st.image(image_file, caption="Protagonist Reference Image")
+                protagonist_image_hash = get_state(Session.PROTAGONIST_IMAGE_HASH)
+                if protagonist_image_hash is not None:
+                    st.image(
+                        get_upload_path(protagonist_image_hash),
+                        caption="Protagonist Reference Image",
+                    )
 
         with st.container(horizontal=False, border=True):
             st.text_area(
@@ -161,7 +177,6 @@ def render_create():
 
     with st.container(horizontal=True, horizontal_alignment="right"):
         if st.button("Generate Story", type="primary"):
-            print("Starting story generation...")
             set_state(Session.CREATE_STORY_STATE, "generating")
             st.rerun()
 
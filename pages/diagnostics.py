@@ -0,0 +1,27 @@
+import tracemalloc
+
+import streamlit as st
+
+from constants import DIAGNOSTICS_TOP_ALLOCATIONS
+from profiling import get_memory_counters, take_allocation_snapshot
+
+st.title("Diagnostics")
+st.caption(
+    "Memory of this server process. The image pool workers run in their own processes and are not included."
+)
+
+counters = get_memory_counters()
+with st.container(horizontal=True):
+    st.metric("RSS (MB)", f"{(counters['rss_bytes'] or 0) / 2**20:.1f}")
+    st.metric("Open files", counters["open_fds"])
+    st.metric("Threads", counters["threads"])
+    st.metric("Open images", counters["image_handles_open"])
+    st.metric("Live PIL images", counters["live_pil_images"])
+st.json(counters, expanded=False)
+
+st.markdown("### Allocations")
+if not tracemalloc.is_tracing():
+    st.info("Start the app with `MEMORY_PROFILING=1` to trace allocations.")
+elif st.button("Take snapshot", type="primary"):
+    st.caption("Growth is against the previous snapshot taken by any session.")
+    st.dataframe(take_allocation_snapshot(DIAGNOSTICS_TOP_ALLOCATIONS))
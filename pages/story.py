@@ -1,48 +1,122 @@
 import json
-from typing import Dict
+import mimetypes
+import os
+import time
+from typing import Dict, List, Optional, Tuple
 
 import streamlit as st
 import streamlit.components.v1 as components
+from streamlit import runtime
 from streamlit_javascript import st_javascript
 
-from constants import HTML_TEMPLATE, Key, Session
-from models import Story, get_stories
+from constants import (
+    FLIPBOOK_CACHE_MAX_ENTRIES,
+    FLIPBOOK_IMAGE_CACHE_MAX_ENTRIES,
+    FLIPBOOK_PREFETCH_PAGES,
+    FLIPBOOK_WIDTH_BUCKETS,
+    FLIPBOOK_WIDTH_MAX_AGE_SECONDS,
+    HTML_TEMPLATE,
+    JOB_POLL_SECONDS,
+    PREVIEW_CACHE_MAX_ENTRIES,
+    PREVIEW_IMAGE_SIZE,
+    STORY_INDEX_REFRESH_SECONDS,
+    EXPORT_MIME_TYPES,
+    Asset,
+    ExportFormat,
+    Key,
+    Priority,
+    Session,
+)
+from blobs import get_blob_path_from_name
+from characters import CharacterEntry
+from client import get_generation_client
+from export import read_export
+from images import resize_image_bytes, run_image_task
+from jobs import Job, JobStatus, RenderAssetsRequest
+from models import (
+    Story,
+    get_asset_page_index,
+    get_page_asset,
+    get_stories,
+    get_story,
+    get_story_version,
+)
 from prompts import (
     get_charactersheet_image_generation_prompt,
     get_cover_image_generation_prompt,
 )
-from utils import get_b64_for_image_path, get_state, set_state
+from utils import (
+    get_state,
+    set_state,
+    set_states,
+    to_kebab_case,
+)
+
+
+@st.cache_resource(max_entries=FLIPBOOK_IMAGE_CACHE_MAX_ENTRIES, show_spinner=False)
+def read_page_image(image_path: str, mtime_ns: int) -> bytes:
+    # Not copied per call, the media storage holds on to the same bytes
+    with open(image_path, "rb") as f:
+        return f.read()
+
 
+def get_page_image_url(image_path: Optional[str], coordinates: str) -> str:
+    if not image_path or not os.path.exists(image_path):
+        return ""
+    # Served from the media endpoint, so the flipbook only downloads the images
+    # of the spreads it shows instead of carrying every page in its HTML. File
+    # ids are content hashes, the URL stays the same for the cached HTML.
+    # Streamlit drops a session's media at the start of every run, so the image
+    # is added again on every rerun, but only read from disk when it changed.
+    mimetype = mimetypes.guess_type(image_path)[0] or "application/octet-stream"
+    data = read_page_image(image_path, os.stat(image_path).st_mtime_ns)
+    url = runtime.get_instance().media_file_mgr.add(data, mimetype, coordinates)
+    # Relative, so it resolves under the app's base path from the iframe
+    return url.lstrip("/")
 
-def get_page_cover_image(story: Story) -> Dict[str, str]:
+
+def get_page_image_urls(story: Story) -> Tuple[str, ...]:
+    image_paths = [story.cover_image.image_path] + [
+        page.image_path for page in story.pages
+    ]
+    return tuple(
+        get_page_image_url(image_path, f"flipbook.{index}")
+        for index, image_path in enumerate(image_paths)
+    )
+
+
+def get_page_cover_image(story: Story, image_url: str) -> Dict[str, str]:
     return {
         "title": "",
-        "image": (
-            get_b64_for_image_path(story.cover_image.image_path)
-            if story.cover_image.image_path
-            else ""
-        ),
+        "image": image_url,
+        "placeholder": story.cover_image.placeholder or "",
         "text": "",
     }
 
 
-def get_page_content(story: Story, page_index: int) -> Dict[str, str]:
+def get_page_content(story: Story, page_index: int, image_url: str) -> Dict[str, str]:
     if page_index < 0 or page_index >= len(story.pages):
         return {"title": f"Page {page_index + 1}", "image": "", "text": "No content"}
 
     page = story.pages[page_index]
     return {
         "title": f"",
-        "image": get_b64_for_image_path(page.image_path) if page.image_path else "",
+        "image": image_url,
+        "placeholder": page.placeholder or "",
         "text": page.text if page.text else "",
     }
 
 
-def render_flipbook(story: Story):
-    pages_data = [
-        get_page_cover_image(story),
-        *[get_page_content(story, i) for i in range(len(story.pages))],
-    ]
+def get_width_bucket(width: int) -> int:
+    fitting_buckets = [bucket for bucket in FLIPBOOK_WIDTH_BUCKETS if bucket <= width]
+    return max(fitting_buckets) if fitting_buckets else min(FLIPBOOK_WIDTH_BUCKETS)
+
+
+def get_flipbook_width() -> int:
+    width, measured_at = get_state(Session.FLIPBOOK_WIDTH) or (None, 0)
+    if width and time.monotonic() - measured_at < FLIPBOOK_WIDTH_MAX_AGE_SECONDS:
+        return width
+
     container_key: str = "flipbook"
     # Insert a probe element to measure container width
     components.html(
@@ -57,85 +131,208 @@ def render_flipbook(story: Story):
         if (el) {{ return el.offsetWidth; }}
     """
     )
+    if not detected_width:
+        return width or get_width_bucket(600)
+
+    # 90% of container width, snapped so that the rendered flipbook can be cached
+    width = get_width_bucket(int(detected_width * 0.9))
+    set_state(Session.FLIPBOOK_WIDTH, (width, time.monotonic()))
+    return width
 
-    # Use detected width or default
-    width = (
-        int(detected_width * 0.9) if detected_width else 600
-    )  # 90% of container width
+
+@st.cache_data(max_entries=FLIPBOOK_CACHE_MAX_ENTRIES, show_spinner=False)
+def get_flipbook_html(
+    story_revision: str, width: int, image_urls: Tuple[str, ...], _story: Story
+) -> str:
+    pages_data = [
+        get_page_cover_image(_story, image_urls[0]),
+        *[
+            get_page_content(_story, i, image_urls[i + 1])
+            for i in range(len(_story.pages))
+        ],
+    ]
 
     # Calculate height if not provided (maintain aspect ratio)
     height = int(width * 1.4)  # Default aspect ratio
 
-    # HTML template with replacements
-
     # Replace template variables
     html_content = HTML_TEMPLATE.replace("{{WIDTH}}", str(width))
     html_content = html_content.replace("{{HEIGHT}}", str(height))
+    html_content = html_content.replace("{{PREFETCH}}", str(FLIPBOOK_PREFETCH_PAGES))
     html_content = html_content.replace("{{PAGES_DATA}}", json.dumps(pages_data))
+    return html_content
+
+
+def render_flipbook(story: Story):
+    width = get_flipbook_width()
+    height = int(width * 1.4)
+    # Registered on every run, the media files of a session are dropped otherwise
+    image_urls = get_page_image_urls(story)
+    html_content = get_flipbook_html(story.get_revision(), width, image_urls, story)
 
     # Render the flipbook
     components.html(html_content, height=height + 100)  # Extra height for controls
 
 
+def run_assets_generation(
+    story: Story, assets: Optional[List[str]], force: bool, priority: Priority
+):
+    job = get_generation_client().render_assets(
+        RenderAssetsRequest(
+            story_path=story.get_story_file_path(),
+            assets=assets,
+            force=force,
+            session_id=str(get_state(Session.ID)),
+            priority=priority,
+        )
+    )
+    # The progress fragment follows the job, the page stays interactive
+    asset_jobs = get_state(Session.ASSET_JOBS) or {}
+    set_states(
+        {
+            Session.ASSET_JOBS: {**asset_jobs, story.title: job.id},
+            Session.ASSET_JOB_SUBMITTED: True,
+        }
+    )
+
+
+def finish_assets_generation(story: Story, job: Optional[Job]):
+    if job is None or job.status not in (JobStatus.DONE, JobStatus.CANCELLED):
+        st.toast(f"Asset generation failed: {job.error if job else 'unknown job'}")
+    elif job.status == JobStatus.CANCELLED:
+        st.toast(f"Asset generation stopped: {job.error}")
+
+    set_states(
+        {
+            Session.CHARACTER_SHEET_ASSET_VALUE: story.character_sheet.image_path,
+            Session.COVER_IMAGE_ASSET_VALUE: story.cover_image.image_path,
+            Session.PAGE_ILLUSTRATION_ASSET_VALUES: [
+                page.image_path for page in story.pages
+            ],
+        }
+    )
+
+
+# Callbacks of widgets in a fragment run before it, their toasts are shown by it
+def queue_toast(message: str):
+    set_state(Session.TOASTS, [*(get_state(Session.TOASTS) or []), message])
+
+
+def show_toasts():
+    for message in get_state(Session.TOASTS) or []:
+        st.toast(message)
+    set_state(Session.TOASTS, [])
+
+
 def handle_single_asset_generation(selected_asset: str, story: Story):
-    if selected_asset == "Character Sheet":
-        st.toast("Generating Character Sheet...")
-        image_path = story.generate_character_sheet(force=True)
-        set_state(Session.CHARACTER_SHEET_ASSET_VALUE, image_path)
-    elif selected_asset == "Cover Image":
-        st.toast("Generating Cover Image...")
-        image_path = story.generate_cover_image(force=True)
-        set_state(Session.COVER_IMAGE_ASSET_VALUE, image_path)
-    elif selected_asset.startswith("Page"):
-        page_number = int(selected_asset.split(" ")[1])
-        page_index = page_number - 1
-        if 0 <= page_index < len(story.pages):
-            st.toast(f"Generating illustration for Page {page_number}.")
-            image_path = story.generate_illustration(page_index, force=True)
-            illustration_values = get_state(
-                Session.PAGE_ILLUSTRATION_ASSET_VALUES, None
-            )
-            if illustration_values is None:
-                illustration_values = [None] * len(story.pages)
-            illustration_values[page_index] = image_path
-            set_state(Session.PAGE_ILLUSTRATION_ASSET_VALUES, illustration_values)
-        else:
-            st.toast("Invalid page number selected.")
-    else:
-        st.toast("Unknown asset type selected.")
+    asset = selected_asset
+    if selected_asset.startswith(Asset.PAGE):
+        asset = get_page_asset(get_asset_page_index(selected_asset))
+    if asset not in story.get_assets():
+        queue_toast("Unknown asset type selected.")
+        return
+    queue_toast(f"Generating {asset}...")
+    run_assets_generation(
+        story, assets=[asset], force=True, priority=Priority.INTERACTIVE
+    )
 
 
 def handle_all_assets_generation(story: Story, force=False):
-    st.toast(f"Generating all assets for story: {story.title}")
+    queue_toast(f"Generating all assets for story: {story.title}")
+    # Only assets that are missing or whose inputs changed are regenerated
+    run_assets_generation(story, assets=None, force=force, priority=Priority.BATCH)
 
-    st.toast("Generating Character Sheet...")
-    character_sheet_path = story.generate_character_sheet(force=force)
-    set_state(Session.CHARACTER_SHEET_ASSET_VALUE, character_sheet_path)
-    st.toast("Character Sheet generated.")
 
-    st.toast("Generating Cover Image...")
-    cover_image_path = story.generate_cover_image(force=force)
-    set_state(Session.COVER_IMAGE_ASSET_VALUE, cover_image_path)
-    st.toast("Cover Image generated.")
+def handle_stop_assets_generation(job_id: str):
+    get_generation_client().cancel_job(job_id)
 
-    illustration_values = []
-    for i in range(len(story.pages)):
-        st.toast(f"Generating illustration for Page {i + 1}/{len(story.pages)}.")
-        illustration_path = story.generate_illustration(i, force=force)
-        illustration_values.append(illustration_path)
-        st.toast(f"Illustration for Page {i + 1}/{len(story.pages)} generated.")
-    set_state(Session.PAGE_ILLUSTRATION_ASSET_VALUES, illustration_values)
 
+def handle_asset_revert(story: Story, asset: str, version_key: str):
+    version_index = get_state(version_key)
+    story.revert_asset(asset, version_index)
+    queue_toast(f"{asset} reverted to version {version_index + 1}.")
 
-def get_story_by_name(story_name: str) -> Story:
-    stories = get_stories(user_id=str(get_state(Session.ID)))
+
+def handle_character_sheet_reuse(story: Story, entry: CharacterEntry):
+    story.reuse_character_sheet(entry)
+    queue_toast(f"Character sheet of '{entry.story_title}' is used.")
+
+
+def get_session_story(story_name: str) -> Optional[Story]:
+    stories = get_state(Session.ALL_STORIES) or get_stories(
+        user_id=str(get_state(Session.ID))
+    )
     for story in stories:
         if story.title == story_name:
             return story
     return None
 
 
+def get_story_by_name(story_name: str) -> Story:
+    # The index only reads the story again when its file changed
+    story = get_session_story(story_name)
+    if story is None:
+        return None
+    return get_story(story.get_story_file_path()) or story
+
+
+def get_story_version_by_name(story_name: str) -> Optional[int]:
+    story = get_session_story(story_name)
+    return get_story_version(story.get_story_file_path()) if story else None
+
+
+@st.fragment(run_every=STORY_INDEX_REFRESH_SECONDS)
+def watch_story(story_name: str, story_version: Optional[int]):
+    # Another session, process or replica changed the story or its assets. Jobs
+    # of this session rerun the page when they finish.
+    if story_name in (get_state(Session.ASSET_JOBS) or {}):
+        return
+    if get_story_version_by_name(story_name) != story_version:
+        st.rerun(scope="app")
+
+
+@st.cache_data(max_entries=PREVIEW_CACHE_MAX_ENTRIES, show_spinner=False)
+def get_preview_image(image_path: str, mtime_ns: int) -> bytes:
+    with open(image_path, "rb") as f:
+        data = f.read()
+    return run_image_task(resize_image_bytes, data, PREVIEW_IMAGE_SIZE, "JPEG")
+
+
+@st.fragment(run_every=JOB_POLL_SECONDS)
+def render_assets_progress(story_name: str):
+    job_id = (get_state(Session.ASSET_JOBS) or {}).get(story_name)
+    if not job_id:
+        return
+    job = get_generation_client().get_job(job_id)
+    reported = get_state(f"{Session.ASSET_JOBS}_{job_id}", 0)
+    for message in job.progress[reported:] if job else []:
+        st.toast(message)
+    set_state(f"{Session.ASSET_JOBS}_{job_id}", len(job.progress) if job else 0)
+    if job and not job.is_finished():
+        with st.container(horizontal=True, vertical_alignment="center"):
+            st.info(job.progress[-1] if job.progress else "Generating assets...")
+            st.button(
+                "Stop",
+                key=f"stop_{job_id}",
+                on_click=handle_stop_assets_generation,
+                kwargs={"job_id": job_id},
+            )
+        return
+
+    asset_jobs = dict(get_state(Session.ASSET_JOBS) or {})
+    asset_jobs.pop(story_name, None)
+    set_state(Session.ASSET_JOBS, asset_jobs)
+    finish_assets_generation(get_story_by_name(story_name), job)
+    # New images go to the preview and the flipbook
+    st.rerun()
+
+
+@st.fragment
 def render_generate_assets(story_name: str):
+    if get_state(Session.ASSET_JOB_SUBMITTED):
+        # Only a run of the whole page mounts the progress fragment
+        st.rerun(scope="app")
+    show_toasts()
     assets, assets_value = st.columns([3, 9])
     with assets:
         story: Story = get_story_by_name(story_name)
@@ -160,35 +357,108 @@ def render_generate_assets(story_name: str):
                 on_click=handle_single_asset_generation,
                 kwargs={"selected_asset": selected_asset, "story": story},
             )
-        selected_asset_path, selected_asset_prompt = None, ""
+        render_asset_preview(story, selected_asset)
+
 
-        if selected_asset == "Character Sheet":
-            selected_asset_prompt = get_charactersheet_image_generation_prompt(
-                character_sheet_prompt=story.character_sheet.prompt,
-                style=story.style,
-                protagonist_image=story.image_path,
+def render_character_library(story: Story):
+    entry = story.get_character_entry()
+    if not entry:
+        return
+    record = story.character_sheet
+    if (
+        record.version is not None
+        and record.versions[record.version].blob == entry.blob
+    ):
+        st.caption(f"Reused from '{entry.story_title}'.")
+    else:
+        st.button(
+            f"Use sheet from '{entry.story_title}'",
+            on_click=handle_character_sheet_reuse,
+            kwargs={"story": story, "entry": entry},
+            icon=":material/history:",
+        )
+
+
+def render_asset_preview(story: Story, selected_asset: str):
+    selected_asset_path, selected_asset_prompt = None, ""
+
+    if selected_asset == "Character Sheet":
+        selected_asset_prompt = get_charactersheet_image_generation_prompt(
+            character_sheet_prompt=story.character_sheet.prompt,
+            style=story.style,
+            protagonist_image=story.image_path,
+        )
+        selected_asset_path = story.character_sheet.image_path
+        render_character_library(story)
+    elif selected_asset == "Cover Image":
+        selected_asset_prompt = get_cover_image_generation_prompt(
+            style=story.style, story_title=story.title
+        )
+        selected_asset_path = story.cover_image.image_path
+    elif selected_asset.startswith("Page"):
+        page_number = int(selected_asset.split(" ")[1])
+        page_index = page_number - 1
+        illustration_values = get_state(
+            Session.PAGE_ILLUSTRATION_ASSET_VALUES, None
+        ) or [page.image_path for page in story.pages]
+        if illustration_values is not None:
+            selected_asset_prompt = story.pages[page_index].illustration_prompt
+            selected_asset_path = story.pages[page_index].image_path
+    # st.text_area("Asset Prompt", value=selected_asset_prompt, height=300)
+    asset = selected_asset
+    if selected_asset.startswith(Asset.PAGE):
+        asset = get_page_asset(get_asset_page_index(selected_asset))
+    record = story.get_asset_record(asset)
+    if len(record.versions) > 1:
+        version_key = f"asset_version_{asset}"
+        current_version = (
+            record.version if record.version is not None else len(record.versions) - 1
+        )
+        with st.container(horizontal=True, vertical_alignment="bottom"):
+            version_index = st.selectbox(
+                "Version",
+                range(len(record.versions)),
+                index=current_version,
+                format_func=lambda i: f"Version {i + 1}",
+                key=version_key,
             )
-            selected_asset_path = story.character_sheet.image_path
-        elif selected_asset == "Cover Image":
-            selected_asset_prompt = get_cover_image_generation_prompt(
-                style=story.style, story_title=story.title
+            st.button(
+                "Use this version",
+                on_click=handle_asset_revert,
+                kwargs={"story": story, "asset": asset, "version_key": version_key},
+                disabled=version_index == current_version,
             )
-            selected_asset_path = story.cover_image.image_path
-        elif selected_asset.startswith("Page"):
-            page_number = int(selected_asset.split(" ")[1])
-            page_index = page_number - 1
-            illustration_values = get_state(
-                Session.PAGE_ILLUSTRATION_ASSET_VALUES, None
-            ) or [page.image_path for page in story.pages]
-            if illustration_values is not None:
-                selected_asset_prompt = story.pages[page_index].illustration_prompt
-                selected_asset_path = story.pages[page_index].image_path
-        # st.text_area("Asset Prompt", value=selected_asset_prompt, height=300)
-        if selected_asset_path:
-            st.markdown(
-                "**If you do not like the below rendering, click the button again to re-generate.**"
+        if version_index != current_version:
+            # Compare against an earlier render before switching to it
+            selected_asset_path = get_blob_path_from_name(
+                record.versions[version_index].blob
+            )
+    if selected_asset_path and os.path.exists(selected_asset_path):
+        st.markdown(
+            "**If you do not like the below rendering, click the button again to re-generate.**"
+        )
+        st.image(
+            get_preview_image(
+                selected_asset_path, os.stat(selected_asset_path).st_mtime_ns
+            ),
+            caption=selected_asset,
+        )
+
+
+def render_export_downloads(story: Story):
+    with st.container(horizontal=True, horizontal_alignment="right"):
+        for export_format in ExportFormat:
+            # Deferred, the export is only built or read when clicked
+            st.download_button(
+                f"Download {export_format.name}",
+                data=lambda export_format=export_format: read_export(
+                    story, export_format
+                ),
+                file_name=f"{to_kebab_case(story.title)}.{export_format.value}",
+                mime=EXPORT_MIME_TYPES[export_format],
+                on_click="ignore",
+                icon=":material/download:",
             )
-            st.image(selected_asset_path, caption=selected_asset)
 
 
 def render_view_story(story_name: str):
@@ -204,7 +474,7 @@ def render_view_story(story_name: str):
                 "Generate Missing Assets",
                 type="primary",
                 on_click=handle_all_assets_generation,
-                kwargs={"story": story, "force": True},
+                kwargs={"story": story},
             )
         st.markdown("### Missing Assets")
         st.markdown(
@@ -217,11 +487,14 @@ def render_view_story(story_name: str):
             "To go to the next page you can either click 'Next' or click on the right side of the page. To go to the previous page you can either click 'Previous' or click on the left side of the page."
         )
         render_flipbook(story=story)
+        render_export_downloads(story=story)
         # st.success("All assets have been generated for this story!")
 
 
 def make_story_app(story_name: str):
     def story_app():
+        set_state(Session.ASSET_JOB_SUBMITTED, False)
+        story_version = get_story_version_by_name(story_name)
         st.title(f"Welcome to '{story_name}'!")
         st.info(
             "Select a tab to proceed. `Generate Assets` will provide you a list of assets to generate. Generate `Character Sheet` first (until the characters are to your liking), followed by the `Cover Image`, and then the page illustrations. The assets can be generated as many times as needed. Once all assets are generated, you can view the story in the `View Story` tab."
@@ -233,6 +506,11 @@ def make_story_app(story_name: str):
                 key="story_tab",
                 # default="Generate Assets",
             )
+        show_toasts()
+        if story_name in (get_state(Session.ASSET_JOBS) or {}):
+            # Polls every JOB_POLL_SECONDS, so it is only there while a job runs
+            render_assets_progress(story_name=story_name)
+        watch_story(story_name, story_version)
         with st.container():
             if selection == "Generate Assets":
                 render_generate_assets(story_name=story_name)
@@ -0,0 +1,91 @@
+import gc
+import os
+import threading
+import tracemalloc
+from typing import Dict, List, Optional
+
+from PIL import Image
+
+from constants import MEMORY_PROFILING, MEMORY_PROFILING_FRAMES
+from images import get_image_handle_stats
+
+_LAST_SNAPSHOT: Optional[tracemalloc.Snapshot] = None
+_SNAPSHOT_LOCK = threading.Lock()
+
+
+def start_memory_profiling():
+    if MEMORY_PROFILING and not tracemalloc.is_tracing():
+        tracemalloc.start(MEMORY_PROFILING_FRAMES)
+
+
+def get_rss_bytes() -> Optional[int]:
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+
+def get_open_fd_count() -> Optional[int]:
+    try:
+        return len(os.listdir("/proc/self/fd"))
+    except OSError:
+        return None
+
+
+def get_live_image_count() -> int:
+    # Walks every tracked object, only meant for the diagnostics page
+    return sum(1 for obj in gc.get_objects() if isinstance(obj, Image.Image))
+
+
+# Counters of this process only, the image pool workers are not included
+def get_memory_counters() -> Dict[str, Optional[int]]:
+    counters = {
+        "rss_bytes": get_rss_bytes(),
+        "open_fds": get_open_fd_count(),
+        "threads": threading.active_count(),
+        "live_pil_images": get_live_image_count(),
+    }
+    counters.update(
+        {
+            f"image_handles_{key}": value
+            for key, value in get_image_handle_stats().items()
+        }
+    )
+    # Block allocator of the PIL image buffers
+    counters.update(
+        {f"pil_{key}": value for key, value in Image.core.get_stats().items()}
+    )
+    if tracemalloc.is_tracing():
+        current, peak = tracemalloc.get_traced_memory()
+        counters.update({"traced_bytes": current, "traced_peak_bytes": peak})
+    return counters
+
+
+def take_allocation_snapshot(limit: int) -> List[Dict[str, object]]:
+    # Top allocation sites, with the growth since the previous snapshot
+    global _LAST_SNAPSHOT
+    snapshot = tracemalloc.take_snapshot().filter_traces(
+        [
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+        ]
+    )
+    with _SNAPSHOT_LOCK:
+        previous, _LAST_SNAPSHOT = _LAST_SNAPSHOT, snapshot
+    if previous:
+        stats = snapshot.compare_to(previous, "lineno")
+    else:
+        stats = snapshot.statistics("lineno")
+    return [
+        {
+            "location": str(stat.traceback[0]),
+            "size_kb": stat.size / 1024,
+            "size_diff_kb": getattr(stat, "size_diff", 0) / 1024,
+            "count": stat.count,
+        }
+        for stat in stats[:limit]
+    ]
@@ -35,6 +35,11 @@ Given a detailed character sheet prompt, you will generate a character sheet ima
 {character_sheet_prompt}
 """
 
+CHARACTERSHEET_DELTA_PROMPT = """
+The attached image is an existing character sheet in {style} style. Generate an updated character sheet that keeps every character already on it exactly as drawn, with the same faces, hair, clothes, colors and names, and adds any character from the details below that is not on it yet, drawn the same way. Keep the collage layout, the white background, the border around each character and the name under each character. Leave out characters that are not part of the details below. These are the character details:
+{character_sheet_prompt}
+"""
+
 COVER_IMAGE_GENERATION_PROMPT = """
 Given a detailed cover image prompt, you will generate a cover image for a children's story. The cover image should feature all the main characters in the story in a collage format. The title of the story should be prominently displayed on the cover. The characters should be depicted in a way that reflects their personalities and roles within the story. The cover should be visually appealing and engaging, capturing the essence of the story. The characters should be clearly visible and easily distinguishable from one another. The background should be vibrant and colorful, drawing attention to the cover. The characters should be portryed in {style} style. Used the attached character sheet as a reference for the characters' appearances. The only text on the cover should be the title of the story. No other text should be present on the cover e.g Autor's name, illustrator's name, tagline, etc.
 The title of the story is: {story_title}
@@ -46,6 +51,10 @@ The text corresponding to the image is {image_text}.
 Integrate the text seamlessly into the image composition. The text should be clearly legible, placed to avoid covering key visual elements or focal points. Use a bold, energetic comic book font in superhero style typography. The text should appear naturally as part of the scene, with appropriate lighting, perspective, and color contrast to maintain readability without disrupting the image's visual flow.”
 """
 
+ILLUSTRATION_SESSION_SEED_PROMPT = """
+You will illustrate the pages of the children's story "{story_title}", one page per message. The attached image is the character sheet of the story. Every illustration must keep the characters' faces, hair, clothes, and colors exactly as they appear in the character sheet, while the scenes, poses, lighting, and backgrounds follow each page's description. The illustrations should be in {style} style. Respond to every following message with the illustration for that page.
+"""
+
 
 def get_illustration_image_generation_prompt(image_prompt: str, image_text: str) -> str:
     return (
@@ -57,6 +66,10 @@ def get_illustration_image_generation_prompt(image_prompt: str, image_text: str)
     )
 
 
+def get_illustration_session_seed_prompt(story_title: str, style: str) -> str:
+    return ILLUSTRATION_SESSION_SEED_PROMPT.format(story_title=story_title, style=style)
+
+
 def get_story_generation_system_prompt(story_schema: str) -> str:
     return STORY_GENERATOR_PROMPT_SP.format(story_schema=story_schema)
 
@@ -81,7 +94,6 @@ def get_charactersheet_image_generation_prompt(
         protagonist_image_prompt = (
             f" The protagonist should resemble the attached reference image"
         )
-    print(protagonist_image_prompt)
     return CHARACTERSHEET_IMAGE_GENERATION_PROMPT.format(
         character_sheet_prompt=character_sheet_prompt,
         style=style,
@@ -89,5 +101,11 @@ def get_charactersheet_image_generation_prompt(
     )
 
 
+def get_charactersheet_delta_prompt(character_sheet_prompt: str, style: str) -> str:
+    return CHARACTERSHEET_DELTA_PROMPT.format(
+        character_sheet_prompt=character_sheet_prompt, style=style
+    )
+
+
 def get_cover_image_generation_prompt(style: str, story_title: str) -> str:
     return COVER_IMAGE_GENERATION_PROMPT.format(style=style, story_title=story_title)
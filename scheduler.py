@@ -0,0 +1,128 @@
+import itertools
+import threading
+from collections import Counter
+from contextlib import contextmanager
+from contextvars import ContextVar
+from dataclasses import dataclass, field
+from typing import Dict, Iterator, List, Optional, Tuple
+
+from cancellation import CancellationToken
+from constants import (
+    GEMINI_MAX_CONCURRENCY,
+    INTERACTIVE_RESERVED_SLOTS,
+    USER_MAX_CONCURRENCY,
+    Priority,
+)
+
+PRIORITY_WEIGHTS = {
+    Priority.INTERACTIVE: 4.0,
+    Priority.BATCH: 1.0,
+    Priority.SPECULATIVE: 0.5,
+}
+PRIORITY_ORDER = {Priority.INTERACTIVE: 0, Priority.BATCH: 1, Priority.SPECULATIVE: 2}
+
+# Who the current thread is generating for, set by the job running it
+_SCHEDULING: ContextVar[Tuple[str, Priority]] = ContextVar(
+    "scheduling", default=("anonymous", Priority.INTERACTIVE)
+)
+
+
+def set_scheduling(user_id: Optional[str], priority: Priority):
+    _SCHEDULING.set((user_id or "anonymous", priority))
+
+
+def get_scheduling() -> Tuple[str, Priority]:
+    return _SCHEDULING.get()
+
+
+@dataclass(order=True)
+class SlotRequest:
+    sort_key: Tuple[int, float, int]
+    user_id: str = field(compare=False)
+    priority: Priority = field(compare=False)
+    start_tag: float = field(compare=False)
+
+
+# Weighted fair queueing of model calls. Interactive requests go before batch
+# ones and always have a few slots batch work can not take. Within a priority,
+# users are served by virtual finish time, so one user's 30 page book does not
+# starve everyone else, and nobody runs more than USER_MAX_CONCURRENCY calls.
+class FairScheduler:
+    def __init__(
+        self,
+        max_concurrency: int = GEMINI_MAX_CONCURRENCY,
+        user_max_concurrency: int = USER_MAX_CONCURRENCY,
+        interactive_reserved_slots: int = INTERACTIVE_RESERVED_SLOTS,
+    ):
+        self.max_concurrency = max_concurrency
+        self.user_max_concurrency = user_max_concurrency
+        self.interactive_reserved_slots = interactive_reserved_slots
+        self.condition = threading.Condition()
+        self.waiting: List[SlotRequest] = []
+        self.running = 0
+        self.running_by_user: Counter = Counter()
+        self.virtual_time = 0.0
+        self.user_finish_tags: Dict[str, float] = {}
+        self.sequence = itertools.count()
+
+    def enqueue(self, user_id: str, priority: Priority) -> SlotRequest:
+        start_tag = max(self.virtual_time, self.user_finish_tags.get(user_id, 0.0))
+        finish_tag = start_tag + 1.0 / PRIORITY_WEIGHTS[priority]
+        self.user_finish_tags[user_id] = finish_tag
+        request = SlotRequest(
+            sort_key=(PRIORITY_ORDER[priority], finish_tag, next(self.sequence)),
+            user_id=user_id,
+            priority=priority,
+            start_tag=start_tag,
+        )
+        self.waiting.append(request)
+        return request
+
+    def can_run(self, request: SlotRequest) -> bool:
+        if self.running_by_user[request.user_id] >= self.user_max_concurrency:
+            return False
+        limit = self.max_concurrency
+        if request.priority != Priority.INTERACTIVE:
+            limit -= self.interactive_reserved_slots
+        return self.running < limit
+
+    def get_next(self) -> Optional[SlotRequest]:
+        for request in sorted(self.waiting):
+            if self.can_run(request):
+                return request
+        return None
+
+    @contextmanager
+    def slot(
+        self,
+        user_id: str,
+        priority: Priority,
+        token: Optional[CancellationToken] = None,
+    ) -> Iterator[None]:
+        with self.condition:
+            request = self.enqueue(user_id, priority)
+            try:
+                while self.get_next() is not request:
+                    if token:
+                        token.raise_if_cancelled()
+                    self.condition.wait(timeout=1)
+            except BaseException:
+                self.waiting.remove(request)
+                self.condition.notify_all()
+                raise
+            self.waiting.remove(request)
+            self.running += 1
+            self.running_by_user[user_id] += 1
+            self.virtual_time = max(self.virtual_time, request.start_tag)
+        try:
+            yield
+        finally:
+            with self.condition:
+                self.running -= 1
+                self.running_by_user[user_id] -= 1
+                if not self.running_by_user[user_id]:
+                    del self.running_by_user[user_id]
+                self.condition.notify_all()
+
+
+SCHEDULER = FairScheduler()
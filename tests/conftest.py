@@ -0,0 +1,87 @@
+import io
+import os
+import time
+
+import pytest
+
+# The model client is created at import time, the tests never call it
+os.environ.setdefault("GEMINI_API_KEY", "test")
+
+
+@pytest.fixture(autouse=True)
+def data_dir(tmp_path, monkeypatch):
+    # Every `.data` path is relative to the working directory
+    monkeypatch.chdir(tmp_path)
+    yield tmp_path
+    # Pool workers keep the working directory they were started in
+    import images
+
+    with images._IMAGE_EXECUTOR_LOCK:
+        if images._IMAGE_EXECUTOR is not None:
+            images._IMAGE_EXECUTOR.shutdown()
+            images._IMAGE_EXECUTOR = None
+
+
+def make_image_bytes(color: str = "red") -> bytes:
+    from PIL import Image
+
+    buffer = io.BytesIO()
+    Image.new("RGB", (64, 64), color).save(buffer, format="JPEG")
+    return buffer.getvalue()
+
+
+def make_story(title: str = "Test Story", page_count: int = 2):
+    from constants import Audience, PageCount, Style
+    from models import CharacterSheet, CoverImage, Page, Story
+
+    story = Story(
+        protagonist="Luna, six years old",
+        page_count=list(PageCount)[0],
+        style=list(Style)[0],
+        premise="Luna finds a locket",
+        audience=list(Audience)[0],
+        title=title,
+        moral="Be kind",
+        character_sheet=CharacterSheet(prompt="Luna with curly hair"),
+        cover_image=CoverImage(prompt="Luna on the cover"),
+        pages=[
+            Page(text=f"Page {i}", illustration_prompt=f"Luna on page {i}")
+            for i in range(page_count)
+        ],
+    )
+    story.save()
+    return story
+
+
+def wait_for_job(job_id: str, timeout: float = 5):
+    from jobs import get_job
+
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        job = get_job(job_id)
+        if job.is_finished():
+            return job
+        time.sleep(0.01)
+    raise AssertionError(f"Job {job_id} did not finish: {get_job(job_id)}")
+
+
+@pytest.fixture
+def story(data_dir):
+    return make_story()
+
+
+@pytest.fixture
+def generate_image_calls(monkeypatch):
+    import models
+    from images import GeneratedImage
+
+    calls = []
+
+    def generate_image(prompt, **kwargs):
+        calls.append(prompt)
+        time.sleep(0.3)
+        return GeneratedImage(data=make_image_bytes("blue"), mime_type="image/jpeg")
+
+    monkeypatch.setattr(models, "generate_image", generate_image)
+    monkeypatch.setattr(models.Story, "get_illustration_session", lambda self: None)
+    return calls
@@ -0,0 +1,49 @@
+import os
+import shutil
+import time
+
+from blobs import get_blob_path_from_name
+from conftest import make_image_bytes, make_story
+from constants import BLOB_GC_GRACE_SECONDS, Asset
+from images import GeneratedImage, save_generated_image
+from maintenance import run_maintenance
+
+
+def render_cover(story, color: str) -> str:
+    story.cover_image.image_path = save_generated_image(
+        GeneratedImage(data=make_image_bytes(color), mime_type="image/jpeg"),
+        story.get_cover_image_path(extension=""),
+    )
+    story.cover_image.fingerprint = story.get_asset_fingerprint(Asset.COVER_IMAGE)
+    story.add_asset_version(Asset.COVER_IMAGE)
+    story.save_asset(Asset.COVER_IMAGE)
+    blob_path = get_blob_path_from_name(story.cover_image.versions[-1].blob)
+    # Past the grace period given to renders whose story is not saved yet
+    expired = time.time() - BLOB_GC_GRACE_SECONDS - 1
+    os.utime(blob_path, (expired, expired))
+    return blob_path
+
+
+def test_blob_of_deleted_story_is_collected():
+    kept_story = make_story("Kept Story")
+    deleted_story = make_story("Deleted Story")
+    kept_blob_path = render_cover(kept_story, "red")
+    deleted_blob_path = render_cover(deleted_story, "blue")
+
+    shutil.rmtree(deleted_story.get_base_dir())
+    run_maintenance()
+
+    assert not os.path.exists(deleted_blob_path)
+    assert os.path.exists(kept_blob_path)
+
+
+def test_blob_of_earlier_version_is_kept():
+    story = make_story()
+    first_blob_path = render_cover(story, "red")
+    render_cover(story, "blue")
+
+    # Only a version refers to it, the cover file links the second render
+    assert os.stat(first_blob_path).st_nlink == 1
+    run_maintenance()
+
+    assert os.path.exists(first_blob_path)
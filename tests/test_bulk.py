@@ -0,0 +1,12 @@
+from bulk import run_bulk_render
+from models import Story
+
+
+def test_fake_backend_renders_every_missing_asset(story):
+    story_path = story.get_story_file_path()
+
+    applied = run_bulk_render([story_path], backend_name="fake", poll_seconds=0.01)
+
+    # Character sheet, cover and both pages
+    assert applied == 4
+    assert Story.load(story_path).get_stale_assets() == []
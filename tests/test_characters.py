@@ -0,0 +1,94 @@
+from conftest import make_image_bytes, make_story, wait_for_job
+
+from blobs import get_blob_path_from_name
+from characters import find_character_entry
+from constants import Asset
+from jobs import JobStatus, RenderAssetsRequest, submit_render_assets
+
+
+def make_cast_story(title, prompt, characters):
+    with open("luna.jpeg", "wb") as f:
+        f.write(make_image_bytes("red"))
+    story = make_story(title=title)
+    story.image_path = "luna.jpeg"
+    story.protagonist_details = "Luna, six years old"
+    story.character_sheet.prompt = prompt
+    story.character_sheet.characters = characters
+    story.save()
+    return story
+
+
+def accept_character_sheet(story):
+    list(story.generate_assets([Asset.CHARACTER_SHEET]))
+    return story.remember_character_sheet()
+
+
+def test_same_cast_described_differently_is_reused(generate_image_calls):
+    accept_character_sheet(
+        make_cast_story(
+            "First", "Luna with curly hair and her owl Pip", ["Luna", "Pip"]
+        )
+    )
+    calls = len(generate_image_calls)
+    story = make_cast_story(
+        "Second", "Curly haired Luna, next to Pip the little owl", ["Luna", "pip"]
+    )
+
+    entry = story.link_character_library(reuse=True)
+
+    assert entry.story_title == "First"
+    assert story.character_sheet.image_path
+    assert not story.is_asset_stale(Asset.CHARACTER_SHEET)
+    assert len(generate_image_calls) == calls
+
+
+def test_new_character_extends_the_accepted_sheet(monkeypatch, generate_image_calls):
+    import models
+
+    entry = accept_character_sheet(
+        make_cast_story(
+            "First", "Luna with curly hair and her owl Pip", ["Luna", "Pip"]
+        )
+    )
+    story = make_cast_story(
+        "Second", "Luna with curly hair, her owl Pip and a fox", ["Luna", "Pip", "Fox"]
+    )
+
+    assert story.link_character_library(reuse=True) == entry
+    assert not story.character_sheet.image_path
+
+    delta_prompts = []
+    monkeypatch.setattr(
+        models,
+        "get_charactersheet_delta_prompt",
+        lambda character_sheet_prompt, style: delta_prompts.append(
+            character_sheet_prompt
+        )
+        or "delta",
+    )
+    references = []
+    generate_image = models.generate_image
+
+    def record_reference(prompt, reference_image_path=None, **kwargs):
+        references.append(reference_image_path)
+        return generate_image(
+            prompt, reference_image_path=reference_image_path, **kwargs
+        )
+
+    monkeypatch.setattr(models, "generate_image", record_reference)
+    list(story.generate_assets([Asset.CHARACTER_SHEET]))
+
+    assert delta_prompts == ["Luna with curly hair, her owl Pip and a fox"]
+    assert references == [get_blob_path_from_name(entry.blob)]
+
+
+def test_sheet_is_remembered_once_the_book_is_drawn_from_it(generate_image_calls):
+    story = make_cast_story("First", "Luna with curly hair", ["Luna"])
+
+    # The whole book in one job, sheet included
+    job = submit_render_assets(
+        RenderAssetsRequest(story_path=story.get_story_file_path())
+    )
+
+    assert wait_for_job(job.id, timeout=10).status == JobStatus.DONE
+    assert find_character_entry(story.get_character_key()).story_title == "First"
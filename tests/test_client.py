@@ -0,0 +1,52 @@
+import http.client
+
+import pytest
+
+from client import HttpGenerationClient
+from constants import Audience, PageCount, Style
+from jobs import CreateStoryRequest
+
+
+class DroppedConnection:
+    def __init__(self, requests: list):
+        self.requests = requests
+
+    def request(self, method, path, **kwargs):
+        self.requests.append((method, path))
+
+    def getresponse(self):
+        raise http.client.RemoteDisconnected("closed")
+
+    def close(self):
+        pass
+
+
+def make_client(monkeypatch, requests: list) -> HttpGenerationClient:
+    client = HttpGenerationClient("http://worker:8600")
+    monkeypatch.setattr(client, "get_connection", lambda: DroppedConnection(requests))
+    return client
+
+
+def test_dropped_status_request_is_retried(monkeypatch):
+    requests = []
+    client = make_client(monkeypatch, requests)
+
+    with pytest.raises(ConnectionError):
+        client.request("GET", "/jobs/1")
+    assert requests == [("GET", "/jobs/1"), ("GET", "/jobs/1")]
+
+
+def test_dropped_submission_is_not_sent_twice(monkeypatch):
+    requests = []
+    client = make_client(monkeypatch, requests)
+    request = CreateStoryRequest(
+        protagonist_details="Luna",
+        premise="A trip to the moon",
+        audience=list(Audience)[0],
+        style=list(Style)[0],
+        page_count=list(PageCount)[0],
+    )
+
+    with pytest.raises(ConnectionError):
+        client.create_story(request)
+    assert requests == [("POST", "/stories")]
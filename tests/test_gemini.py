@@ -0,0 +1,73 @@
+import pytest
+from google.genai import types
+
+import gemini
+from cancellation import CancellationToken, GenerationCancelled
+from conftest import make_image_bytes
+from gemini import ImageChatSession
+
+
+def count_images(contents) -> int:
+    return sum(1 for content in contents for part in content.parts if part.inline_data)
+
+
+def test_chat_session_keeps_past_turns_as_text(data_dir, monkeypatch):
+    requests = []
+
+    def generate_content(**kwargs):
+        requests.append(kwargs["contents"])
+        return types.GenerateContentResponse(
+            candidates=[
+                types.Candidate(
+                    content=types.Content(
+                        role="model",
+                        parts=[
+                            types.Part.from_bytes(
+                                data=make_image_bytes(), mime_type="image/jpeg"
+                            )
+                        ],
+                    )
+                )
+            ]
+        )
+
+    monkeypatch.setattr(gemini.CLIENT.models, "generate_content", generate_content)
+    sheet_path = data_dir / "character_sheet.jpeg"
+    sheet_path.write_bytes(make_image_bytes("green"))
+    session_path = str(data_dir / "sessions" / "story.json")
+
+    def open_session():
+        return ImageChatSession(
+            seed_prompt="Illustrate the story",
+            seed_image_paths=[str(sheet_path)],
+            session_path=session_path,
+        )
+
+    session = open_session()
+    for page in range(3):
+        assert session.generate_image(f"Page {page}") is not None
+    # Only the seed's character sheet, generated pages are not sent back
+    assert [count_images(contents) for contents in requests] == [1, 1, 1]
+    assert len(requests[-1]) == 2 + 4 + 1
+
+    # A later job of the story continues the conversation
+    assert len(open_session().turns) == 6
+    # A new character sheet starts it over
+    sheet_path.write_bytes(make_image_bytes("yellow"))
+    assert open_session().turns == []
+
+
+def test_response_after_cancellation_is_returned(monkeypatch):
+    token = CancellationToken()
+
+    def generate_content(**kwargs):
+        # Superseded while the request was in flight
+        token.cancel("superseded")
+        return types.GenerateContentResponse()
+
+    monkeypatch.setattr(gemini.CLIENT.models, "generate_content", generate_content)
+
+    assert gemini.generate_content(token=token, model="model", contents=[]) is not None
+
+    with pytest.raises(GenerationCancelled):
+        gemini.generate_content(token=token, model="model", contents=[])
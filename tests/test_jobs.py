@@ -0,0 +1,180 @@
+import threading
+import time
+
+import pytest
+
+import jobs
+from conftest import wait_for_job
+from constants import JOB_MAX_WORKERS, SPECULATION_BUDGET_PER_USER, Asset, Priority
+from jobs import (
+    Job,
+    JobStatus,
+    RenderAssetsRequest,
+    cancel_job,
+    claim_speculated_assets,
+    get_connection,
+    get_job,
+    get_speculation_budget,
+    save_job,
+    start_speculation,
+    submit_job,
+    submit_render_assets,
+)
+from models import Story, get_page_asset
+
+
+@pytest.fixture
+def prefetch(monkeypatch):
+    # Off by default
+    monkeypatch.setattr(jobs, "SPECULATIVE_PREFETCH_PAGES", 2)
+
+
+def test_failed_job_is_marked_failed():
+    def fail(job, token):
+        raise ValueError("model unavailable")
+
+    job = wait_for_job(submit_job("test", fail, timeout=5).id)
+    assert job.status == JobStatus.FAILED
+    assert job.error == "model unavailable"
+
+
+def test_cancelled_job_is_marked_cancelled():
+    started = threading.Event()
+
+    def run_until_cancelled(job, token):
+        started.set()
+        while True:
+            token.raise_if_cancelled()
+            time.sleep(0.01)
+
+    job_id = submit_job("test", run_until_cancelled, timeout=5).id
+    assert started.wait(5)
+    cancel_job(job_id)
+    job = wait_for_job(job_id)
+    assert job.status == JobStatus.CANCELLED
+    assert job.error == "cancelled"
+
+
+def test_job_past_its_deadline_is_cancelled():
+    def run_until_cancelled(job, token):
+        while True:
+            token.raise_if_cancelled()
+            time.sleep(0.01)
+
+    job = wait_for_job(submit_job("test", run_until_cancelled, timeout=0.05).id)
+    assert job.status == JobStatus.CANCELLED
+    assert job.error == "deadline exceeded"
+
+
+def test_interactive_job_runs_while_batch_jobs_fill_the_executor():
+    release = threading.Event()
+
+    def run_batch(job, token):
+        release.wait(5)
+
+    batch_job_ids = [
+        submit_job("test", run_batch, timeout=5).id for _ in range(JOB_MAX_WORKERS)
+    ]
+    try:
+        interactive_job = submit_job(
+            "test", lambda job, token: "done", timeout=5, priority=Priority.INTERACTIVE
+        )
+        job = wait_for_job(interactive_job.id, timeout=1)
+        assert job.status == JobStatus.DONE
+        assert all(not get_job(job_id).is_finished() for job_id in batch_job_ids)
+    finally:
+        release.set()
+    for job_id in batch_job_ids:
+        wait_for_job(job_id)
+
+
+def test_job_is_cancelled_through_the_store():
+    started = threading.Event()
+
+    def run_until_cancelled(job, token):
+        started.set()
+        while True:
+            token.raise_if_cancelled()
+            time.sleep(0.01)
+
+    job_id = submit_job("test", run_until_cancelled, timeout=5).id
+    assert started.wait(5)
+    # As cancel_job does on a replica that is not running the job
+    connection = get_connection()
+    connection.execute("UPDATE jobs SET cancel_requested = 1 WHERE id = ?", (job_id,))
+    connection.close()
+
+    assert wait_for_job(job_id).status == JobStatus.CANCELLED
+
+
+def test_job_whose_worker_stopped_is_failed():
+    save_job(Job(id="orphaned", kind="test", status=JobStatus.RUNNING))
+    connection = get_connection()
+    connection.execute("UPDATE jobs SET updated_at = 0 WHERE id = 'orphaned'")
+    connection.close()
+
+    job = get_job("orphaned")
+    assert job.status == JobStatus.FAILED
+    assert get_job("unknown") is None
+
+
+def prefetch_pages(story, session_id: str):
+    story.generate_asset(Asset.CHARACTER_SHEET)
+    speculation = start_speculation(session_id, story)
+    assert speculation is not None
+    assert wait_for_job(speculation.id).status == JobStatus.DONE
+    assert get_speculation_budget(session_id) == SPECULATION_BUDGET_PER_USER - 2
+
+
+def test_page_joined_while_speculating_is_not_handed_out_again(
+    story, generate_image_calls, prefetch
+):
+    story.generate_asset(Asset.CHARACTER_SHEET)
+    speculation = start_speculation("joining-session", story)
+    assert speculation is not None
+    time.sleep(0.1)
+
+    # Joins the speculative render of the page
+    user_job = submit_render_assets(
+        RenderAssetsRequest(
+            story_path=story.get_story_file_path(),
+            assets=[get_page_asset(0)],
+            session_id="joining-session",
+            priority=Priority.INTERACTIVE,
+        )
+    )
+    assert wait_for_job(user_job.id).status == JobStatus.DONE
+    assert wait_for_job(speculation.id).status == JobStatus.DONE
+
+    # Sheet and the prefetched pages, the joined page was not rendered twice
+    assert len(generate_image_calls) == 3
+    # The user got it already, asking again regenerates it
+    story = Story.load(story.get_story_file_path())
+    assert claim_speculated_assets("joining-session", story, [get_page_asset(0)]) == []
+
+
+def test_rendering_all_missing_assets_releases_prefetched_pages(
+    story, generate_image_calls, prefetch
+):
+    prefetch_pages(story, "bulk-session")
+
+    job = submit_render_assets(
+        RenderAssetsRequest(
+            story_path=story.get_story_file_path(), session_id="bulk-session"
+        )
+    )
+
+    assert wait_for_job(job.id).status == JobStatus.DONE
+    assert get_speculation_budget("bulk-session") == SPECULATION_BUDGET_PER_USER
+
+
+def test_unclaimed_prefetched_pages_expire(
+    story, generate_image_calls, prefetch, monkeypatch
+):
+    prefetch_pages(story, "leaving-session")
+    monkeypatch.setattr(jobs, "SPECULATION_TTL_SECONDS", 0)
+
+    # Nothing is left to prefetch, but expired pages are forgotten on the way
+    story = Story.load(story.get_story_file_path())
+    assert start_speculation("leaving-session", story) is None
+    assert get_speculation_budget("leaving-session") == SPECULATION_BUDGET_PER_USER
@@ -0,0 +1,187 @@
+import os
+import threading
+import time
+
+import models
+from cancellation import CancellationToken
+from conftest import make_image_bytes, make_story
+from constants import Asset, RenderMode
+from images import GeneratedImage, save_generated_image
+from leases import claim_lease, release_lease
+from models import Story, get_page_asset
+
+
+def render_as_other_replica(story_path: str, page_index: int):
+    story = Story.load(story_path)
+    asset = get_page_asset(page_index)
+    page = story.pages[page_index]
+    page.image_path = save_generated_image(
+        GeneratedImage(data=make_image_bytes(), mime_type="image/jpeg"),
+        story.get_illustration_image_path(page_index, extension=""),
+    )
+    page.fingerprint = story.get_asset_fingerprint(asset)
+    story.save_asset(asset)
+
+
+def test_render_by_other_replica_after_request_is_reused(story, generate_image_calls):
+    token = CancellationToken()
+    render_as_other_replica(story.get_story_file_path(), 0)
+
+    image_path = story.generate_asset(get_page_asset(0), force=True, token=token)
+
+    assert generate_image_calls == []
+    assert image_path == Story.load(story.get_story_file_path()).pages[0].image_path
+
+
+def test_outdated_render_after_request_is_redone(story, generate_image_calls):
+    token = CancellationToken()
+    render_as_other_replica(story.get_story_file_path(), 0)
+    story.pages[0].illustration_prompt = "Luna on page 0, at night"
+    story.save()
+
+    story.generate_asset(get_page_asset(0), force=True, token=token)
+
+    assert len(generate_image_calls) == 1
+
+
+def test_page_leased_by_other_replica_is_not_rendered_again(
+    story, generate_image_calls
+):
+    story_path = story.get_story_file_path()
+    leased_asset = get_page_asset(0)
+    assert claim_lease(story_path, leased_asset, owner="other-replica")
+
+    def finish_other_render():
+        time.sleep(0.1)
+        render_as_other_replica(story_path, 0)
+        release_lease(story_path, leased_asset, owner="other-replica")
+
+    thread = threading.Thread(target=finish_other_render)
+    thread.start()
+    token = CancellationToken(timeout=10)
+    results = dict(
+        story.generate_assets([leased_asset, get_page_asset(1)], token=token)
+    )
+    thread.join()
+
+    # The other replica finished while our own page was rendering
+    assert len(generate_image_calls) == 1
+    assert results[leased_asset] == Story.load(story_path).pages[0].image_path
+
+
+def test_concurrent_stories_with_the_same_title_are_kept_apart(monkeypatch):
+    cached_story = make_story()
+    monkeypatch.setattr(
+        models, "generate_text", lambda **kwargs: cached_story.model_copy(deep=True)
+    )
+    save = Story.save
+
+    def slow_save(self, file_path=None):
+        # Widens the window between finding a free title and taking it
+        time.sleep(0.1)
+        return save(self, file_path)
+
+    monkeypatch.setattr(Story, "save", slow_save)
+    stories = []
+
+    def generate_story():
+        stories.append(
+            Story.generate_story(
+                protagonist_details="Luna",
+                page_count=cached_story.page_count,
+                style=cached_story.style,
+                premise=cached_story.premise,
+                audience=cached_story.audience,
+                protagonist_image_path=None,
+            )
+        )
+
+    threads = [threading.Thread(target=generate_story) for _ in range(3)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    titles = {story.title for story in stories}
+    assert titles == {"Test Story 2", "Test Story 3", "Test Story 4"}
+
+
+def test_switching_render_mode_makes_pages_stale(
+    story, generate_image_calls, monkeypatch
+):
+    story.generate_asset(Asset.CHARACTER_SHEET)
+    story.generate_asset(Asset.COVER_IMAGE)
+    story.generate_asset(get_page_asset(0))
+    assert not story.is_asset_stale(get_page_asset(0))
+
+    monkeypatch.setattr(models, "ILLUSTRATION_RENDER_MODE", RenderMode.CHAT)
+
+    assert story.is_asset_stale(get_page_asset(0))
+    assert not story.is_asset_stale(Asset.COVER_IMAGE)
+
+
+def render_page_superseded(story, edit_prompt: bool):
+    story.generate_asset(Asset.CHARACTER_SHEET)
+    results = {}
+
+    def render_first():
+        results["first"] = story.generate_asset_with_deadline(
+            get_page_asset(0), force=True, token=CancellationToken(), owner="session"
+        )
+
+    thread = threading.Thread(target=render_first)
+    thread.start()
+    time.sleep(0.1)
+    newer = Story.load(story.get_story_file_path())
+    if edit_prompt:
+        newer.pages[0].illustration_prompt = "Luna on page 0, at night"
+        newer.save()
+    # The newer request of the same session supersedes the one in flight
+    results["newer"] = newer.generate_asset_with_deadline(
+        get_page_asset(0), force=True, token=CancellationToken(), owner="session"
+    )
+    thread.join()
+    return results
+
+
+def test_superseded_render_is_kept_and_shared(story, generate_image_calls):
+    results = render_page_superseded(story, edit_prompt=False)
+
+    # Sheet and one page, the response of the superseded request was used
+    assert len(generate_image_calls) == 2
+    assert results["newer"] is not None
+    assert results["newer"] == results["first"]
+
+
+def test_superseded_render_of_an_older_prompt_is_discarded(story, generate_image_calls):
+    results = render_page_superseded(story, edit_prompt=True)
+
+    assert "Luna on page 0, at night" in generate_image_calls[-1]
+    assert len(generate_image_calls) == 3
+    story = Story.load(story.get_story_file_path())
+    assert not story.is_asset_stale(get_page_asset(0))
+    assert results["newer"] == story.pages[0].image_path
+
+
+def test_library_version_only_moves_when_stories_are_added_or_removed(
+    story, monkeypatch
+):
+    monkeypatch.setattr(models, "start_watcher", lambda: None)
+    monkeypatch.setattr(models, "subscribe", lambda callback: None)
+    index = models.StoryIndex()
+    story_path = story.get_story_file_path()
+    library_version = index.get_version()
+    story_version = index.get_story_version(story_path)
+
+    # An asset write and a change of the story itself
+    index.touch(os.path.dirname(story_path))
+    story.pages[0].text = "Page 0, rewritten"
+    story.save()
+    index.refresh(story_path)
+
+    assert index.get_version() == library_version
+    assert index.get_story_version(story_path) > story_version
+
+    other_story = make_story("Other Story")
+    index.refresh(other_story.get_story_file_path())
+    assert index.get_version() > library_version
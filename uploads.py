@@ -0,0 +1,40 @@
+import functools
+import hashlib
+import os
+import threading
+
+from constants import UPLOAD_IMAGE_MAX_SIZE, UPLOAD_IMAGE_QUALITY, UPLOADS_DIR
+from images import normalize_image_bytes, run_image_task
+
+
+# Reference images are stored once per content hash, already rotated and
+# downscaled. Sessions, jobs and stories only pass the hash or path around.
+def get_upload_path(upload_hash: str) -> str:
+    return os.path.join(UPLOADS_DIR, f"{upload_hash}.jpeg")
+
+
+def ingest_image(data: bytes) -> str:
+    upload_hash = hashlib.sha256(data).hexdigest()
+    upload_path = get_upload_path(upload_hash)
+    if os.path.exists(upload_path):
+        return upload_hash
+    normalized = run_image_task(
+        normalize_image_bytes, data, UPLOAD_IMAGE_MAX_SIZE, UPLOAD_IMAGE_QUALITY
+    )
+    os.makedirs(UPLOADS_DIR, exist_ok=True)
+    temp_path = f"{upload_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(temp_path, "wb") as f:
+        f.write(normalized)
+    os.replace(temp_path, upload_path)
+    return upload_hash
+
+
+@functools.lru_cache(maxsize=32)
+def _ingest_image_file(file_path: str, mtime_ns: int, size: int) -> str:
+    with open(file_path, "rb") as f:
+        return ingest_image(f.read())
+
+
+def ingest_image_file(file_path: str) -> str:
+    stat = os.stat(file_path)
+    return _ingest_image_file(file_path, stat.st_mtime_ns, stat.st_size)
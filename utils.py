@@ -1,17 +1,19 @@
-import base64
-import io
 import mimetypes
 import re
-from io import BytesIO
 from pathlib import Path
 from typing import Any, Dict
 
 import streamlit as st
 from PIL import Image
 
+from images import encode_file_b64, run_image_task
+
 
 def classify_image_aspect(image: Image.Image, threshold: float = 0.2) -> str:
-    width, height = image.size
+    return classify_aspect(*image.size, threshold=threshold)
+
+
+def classify_aspect(width: int, height: int, threshold: float = 0.2) -> str:
     aspect_ratio = width / height
 
     if abs(aspect_ratio - 1.0) < threshold:  # Within threshold of square
@@ -32,8 +34,7 @@ def get_b64_for_image_path(image_path):
     if not mime_type or not mime_type.startswith("image/"):
         raise ValueError(f"Unsupported or unrecognized image type: {mime_type}")
 
-    with open(path, "rb") as img_file:
-        encoded = base64.b64encode(img_file.read()).decode("utf-8")
+    encoded = run_image_task(encode_file_b64, str(path))
 
     return f"data:{mime_type};base64,{encoded}"
 
@@ -50,14 +51,6 @@ def get_state(key: str, default: Any = None) -> Any:
     return st.session_state.get(key, default)
 
 
-def get_image_as_bytesIO(image_path: str) -> BytesIO:
-    with Image.open(image_path) as img:
-        img_bytes = io.BytesIO()
-        img.save(img_bytes, format=img.format)  # Preserve original format
-        img_bytes.seek(0)
-        return img_bytes
-
-
 def to_kebab_case(input_string: str, limit=50) -> str:
     input_string = str(input_string)
     cleaned_string = re.sub(r"[^a-zA-Z0-9\s_]", "", input_string)
@@ -0,0 +1,144 @@
+import os
+import threading
+from dataclasses import dataclass
+from typing import Callable, Dict, List, Optional, Tuple
+
+from watchdog.events import FileSystemEvent, FileSystemEventHandler
+from watchdog.observers import Observer
+
+from constants import STORIES_BASE_DIR, STORY_WATCH_MODE, STORY_WATCH_POLL_SECONDS
+from log import get_logger
+
+logger = get_logger(__name__)
+
+
+# A file under STORIES_BASE_DIR was written, replaced or removed. Temporary
+# files of in-flight atomic writes are never reported.
+@dataclass(frozen=True)
+class StoryFileChange:
+    path: str
+    story_dir: str
+    is_story: bool
+    deleted: bool
+
+
+_SUBSCRIBERS: List[Callable[[StoryFileChange], None]] = []
+_SUBSCRIBERS_LOCK = threading.Lock()
+_WATCHER: Optional[object] = None
+_WATCHER_LOCK = threading.Lock()
+
+
+def subscribe(callback: Callable[[StoryFileChange], None]):
+    with _SUBSCRIBERS_LOCK:
+        _SUBSCRIBERS.append(callback)
+
+
+def publish(path: str, deleted: bool):
+    if path.endswith(".tmp"):
+        return
+    story_dir = os.path.dirname(path)
+    if os.path.dirname(story_dir) != STORIES_BASE_DIR:
+        return
+    change = StoryFileChange(
+        path=path, story_dir=story_dir, is_story=path.endswith(".json"), deleted=deleted
+    )
+    with _SUBSCRIBERS_LOCK:
+        subscribers = list(_SUBSCRIBERS)
+    for callback in subscribers:
+        try:
+            callback(change)
+        except Exception:
+            logger.exception("watcher.subscriber_failed", path=path)
+
+
+class StoryEventHandler(FileSystemEventHandler):
+    def on_any_event(self, event: "FileSystemEvent"):
+        if event.is_directory or event.event_type in ("opened", "closed_no_write"):
+            return
+        # Paths are made relative again, so they match the ones stories use
+        src_path = os.path.relpath(os.fsdecode(event.src_path))
+        if event.event_type == "moved":
+            publish(src_path, deleted=True)
+            publish(os.path.relpath(os.fsdecode(event.dest_path)), deleted=False)
+        else:
+            publish(src_path, deleted=event.event_type == "deleted")
+
+
+# Needed where inotify does not see the writes, such as replicas sharing the
+# data directory over a network filesystem. Only story directories whose mtime
+# moved are listed again, every save renames into the directory.
+class PollingWatcher(threading.Thread):
+    def __init__(self, interval: float):
+        super().__init__(name="story-watcher", daemon=True)
+        self.interval = interval
+        self.stop_event = threading.Event()
+        self.dir_mtimes: Dict[str, int] = {}
+        self.files: Dict[str, Dict[str, Tuple[int, int]]] = {}
+
+    def scan_dir(self, story_dir: str) -> Dict[str, Tuple[int, int]]:
+        files = {}
+        try:
+            with os.scandir(story_dir) as entries:
+                for entry in entries:
+                    if entry.is_file() and not entry.name.endswith(".tmp"):
+                        stat = entry.stat()
+                        files[entry.path] = (stat.st_mtime_ns, stat.st_size)
+        except FileNotFoundError:
+            pass
+        return files
+
+    def poll(self, publish_changes: bool = True):
+        story_dirs = set()
+        if os.path.isdir(STORIES_BASE_DIR):
+            with os.scandir(STORIES_BASE_DIR) as entries:
+                story_dirs = {entry.path for entry in entries if entry.is_dir()}
+        for story_dir in set(self.files) - story_dirs:
+            for path in self.files.pop(story_dir):
+                publish(path, deleted=True)
+            self.dir_mtimes.pop(story_dir, None)
+        for story_dir in story_dirs:
+            try:
+                mtime = os.stat(story_dir).st_mtime_ns
+            except FileNotFoundError:
+                continue
+            previous = self.files.get(story_dir, {})
+            files = previous
+            if self.dir_mtimes.get(story_dir) != mtime:
+                self.dir_mtimes[story_dir] = mtime
+                files = self.scan_dir(story_dir)
+            self.files[story_dir] = files
+            if not publish_changes:
+                continue
+            for path, stat in files.items():
+                if previous.get(path) != stat:
+                    publish(path, deleted=False)
+            for path in set(previous) - set(files):
+                publish(path, deleted=True)
+
+    def run(self):
+        self.poll(publish_changes=False)
+        while not self.stop_event.wait(self.interval):
+            try:
+                self.poll()
+            except OSError as e:
+                logger.warning("watcher.poll_failed", error=e)
+
+    def stop(self):
+        self.stop_event.set()
+
+
+def start_watcher():
+    global _WATCHER
+    with _WATCHER_LOCK:
+        if _WATCHER is not None:
+            return
+        os.makedirs(STORIES_BASE_DIR, exist_ok=True)
+        if STORY_WATCH_MODE != "poll":
+            watcher = Observer()
+            watcher.schedule(StoryEventHandler(), STORIES_BASE_DIR, recursive=True)
+        else:
+            watcher = PollingWatcher(STORY_WATCH_POLL_SECONDS)
+        watcher.daemon = True
+        watcher.start()
+        logger.info("watcher.started", watcher=type(watcher).__name__)
+        _WATCHER = watcher
@@ -0,0 +1,96 @@
+import asyncio
+import json
+from http import HTTPStatus
+from typing import Any, Tuple
+
+from pydantic import ValidationError
+
+from constants import WORKER_HOST, WORKER_PORT
+from jobs import (
+    CreateStoryRequest,
+    RenderAssetsRequest,
+    cancel_job,
+    get_job,
+    submit_create_story,
+    submit_render_assets,
+)
+from log import get_logger
+from maintenance import start_maintenance
+
+logger = get_logger(__name__)
+
+# Standalone generation service. Run with `python worker.py` next to the shared
+# `.data` directory and point the Streamlit app at it with WORKER_URL.
+
+
+def route(method: str, path: str, body: bytes) -> Tuple[int, Any]:
+    if method == "GET" and path == "/health":
+        return HTTPStatus.OK, {"status": "ok"}
+    if method == "POST" and path.startswith("/jobs/") and path.endswith("/cancel"):
+        job = cancel_job(path.removeprefix("/jobs/").removesuffix("/cancel"))
+        if job is None:
+            return HTTPStatus.NOT_FOUND, {"error": "Unknown job"}
+        return HTTPStatus.OK, job.model_dump(mode="json")
+    if method == "GET" and path.startswith("/jobs/"):
+        job = get_job(path.removeprefix("/jobs/"))
+        if job is None:
+            return HTTPStatus.NOT_FOUND, {"error": "Unknown job"}
+        return HTTPStatus.OK, job.model_dump(mode="json")
+    try:
+        if method == "POST" and path == "/stories":
+            job = submit_create_story(CreateStoryRequest.model_validate_json(body))
+            return HTTPStatus.ACCEPTED, job.model_dump(mode="json")
+        if method == "POST" and path == "/assets":
+            job = submit_render_assets(RenderAssetsRequest.model_validate_json(body))
+            return HTTPStatus.ACCEPTED, job.model_dump(mode="json")
+    except ValidationError as e:
+        return HTTPStatus.BAD_REQUEST, {"error": str(e)}
+    return HTTPStatus.NOT_FOUND, {"error": f"No route for {method} {path}"}
+
+
+async def handle_connection(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+    try:
+        # Connections are kept alive until the client closes them
+        while True:
+            request_line = await reader.readline()
+            if not request_line:
+                break
+            method, path, _ = request_line.decode("latin-1").split(" ", 2)
+            headers = {}
+            while True:
+                line = await reader.readline()
+                if line in (b"\r\n", b"\n", b""):
+                    break
+                name, value = line.decode("latin-1").split(":", 1)
+                headers[name.strip().lower()] = value.strip()
+            body = await reader.readexactly(int(headers.get("content-length", 0)))
+
+            status, payload = route(method, path, body)
+            data = json.dumps(payload).encode("utf-8")
+            writer.write(
+                (
+                    f"HTTP/1.1 {status.value} {status.phrase}\r\n"
+                    "Content-Type: application/json\r\n"
+                    f"Content-Length: {len(data)}\r\n\r\n"
+                ).encode("latin-1")
+                + data
+            )
+            await writer.drain()
+            if headers.get("connection", "").lower() == "close":
+                break
+    except (asyncio.IncompleteReadError, ConnectionError, ValueError) as e:
+        logger.info("worker.connection_dropped", error=e)
+    finally:
+        writer.close()
+
+
+async def serve(host: str = WORKER_HOST, port: int = WORKER_PORT):
+    start_maintenance()
+    server = await asyncio.start_server(handle_connection, host, port)
+    logger.info("worker.listening", host=host, port=port)
+    async with server:
+        await server.serve_forever()
+
+
+if __name__ == "__main__":
+    asyncio.run(serve())